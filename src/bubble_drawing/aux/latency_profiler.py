@@ -0,0 +1,158 @@
+import os
+import csv
+import json
+import time
+import numpy as np
+from collections import OrderedDict
+
+_profiler = None # active LatencyProfiler. None means that profiling is disabled
+HISTOGRAM_BIN_EDGES = np.logspace(-5, 1, 25) # (s) from 10us to 10s, log spaced
+
+
+class LatencyProfiler(object):
+    """
+    Records the duration of named spans of the control loop (observation, model forward, icp, cost,...).
+    Spans are opened with profile_span(name), which does nothing when no profiler is enabled.
+    """
+    def __init__(self, synchronize_cuda=False, bin_edges=None):
+        """
+        :param synchronize_cuda: if True, wait for the cuda kernels at the end of each span, so the span measures the gpu
+            work done on it and not only the kernel launches. It slows down the loop, use it only to locate the gpu stages.
+        :param bin_edges: histogram bin edges (s). Default: HISTOGRAM_BIN_EDGES
+        """
+        self.synchronize_cuda = synchronize_cuda
+        self.bin_edges = HISTOGRAM_BIN_EDGES if bin_edges is None else np.asarray(bin_edges)
+        self.durations = OrderedDict() # span name -> list of durations (s)
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def record(self, name, duration):
+        if name not in self.durations:
+            self.durations[name] = []
+        self.durations[name].append(duration)
+
+    def reset(self):
+        self.durations = OrderedDict()
+
+    def get_stats(self):
+        """
+        :return: dict span name -> dict with the count, total, mean, std, min, percentiles, max and histogram of the durations (s)
+        """
+        stats = OrderedDict()
+        for name, durations in self.durations.items():
+            durations = np.asarray(durations)
+            counts, _ = np.histogram(durations, bins=np.concatenate([[0.], self.bin_edges, [np.inf]]))
+            stats[name] = {
+                'count': int(durations.shape[0]),
+                'total': float(np.sum(durations)),
+                'mean': float(np.mean(durations)),
+                'std': float(np.std(durations)),
+                'min': float(np.min(durations)),
+                'p50': float(np.percentile(durations, 50)),
+                'p90': float(np.percentile(durations, 90)),
+                'p99': float(np.percentile(durations, 99)),
+                'max': float(np.max(durations)),
+                'histogram': counts.tolist(), # counts on [0, e_0), [e_0, e_1), ..., [e_n, inf)
+            }
+        return stats
+
+    def save(self, save_path):
+        """
+        Save the span statistics. The format is given by the extension: .json (stats, histograms and bin edges) or .csv (one row per span, no histograms)
+        """
+        save_dir = os.path.dirname(save_path)
+        if save_dir:
+            os.makedirs(save_dir, exist_ok=True)
+        stats = self.get_stats()
+        extension = os.path.splitext(save_path)[-1]
+        if extension == '.json':
+            with open(save_path, 'w') as f:
+                json.dump({'bin_edges': self.bin_edges.tolist(), 'spans': stats}, f, indent=2)
+        elif extension == '.csv':
+            column_names = ['span', 'count', 'total', 'mean', 'std', 'min', 'p50', 'p90', 'p99', 'max']
+            with open(save_path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(column_names)
+                for name, stats_i in stats.items():
+                    writer.writerow([name] + [stats_i[cn] for cn in column_names[1:]])
+        else:
+            raise ValueError('Latency profile format {} not supported. Available options: .json, .csv'.format(extension))
+
+    def summary(self):
+        lines = ['{:<24} {:>6} {:>10} {:>10} {:>10}'.format('span', 'count', 'mean (ms)', 'p90 (ms)', 'total (s)')]
+        for name, stats_i in self.get_stats().items():
+            lines.append('{:<24} {:>6} {:>10.3f} {:>10.3f} {:>10.3f}'.format(name, stats_i['count'], 1e3 * stats_i['mean'], 1e3 * stats_i['p90'], stats_i['total']))
+        return '\n'.join(lines)
+
+
+class _Span(object):
+    __slots__ = ['profiler', 'name', 'start_time']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start_time = None
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profiler.synchronize_cuda:
+            _cuda_synchronize()
+        self.profiler.record(self.name, time.perf_counter() - self.start_time)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_null_span = _NullSpan() # shared, so disabled spans do not allocate
+
+
+def profile_span(name):
+    """
+    Context manager measuring the duration of the enclosed code as the span name. No-op if profiling is disabled.
+        with profile_span('icp'):
+            ...
+    """
+    if _profiler is None:
+        return _null_span
+    return _profiler.span(name)
+
+
+def enable_profiling(profiler=None):
+    """
+    Set the active profiler.
+    :param profiler: LatencyProfiler. If None, a new one is created
+    :return: the active profiler
+    """
+    global _profiler
+    if profiler is None:
+        profiler = LatencyProfiler()
+    _profiler = profiler
+    return _profiler
+
+
+def disable_profiling():
+    global _profiler
+    _profiler = None
+
+
+def get_profiler():
+    # active profiler (None if disabled)
+    return _profiler
+
+
+def _cuda_synchronize():
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
@@ -21,6 +21,7 @@ from bubble_drawing.aux.drawing_evaluator import DrawingEvaluator
 from bubble_drawing.bubble_model_control.aux.format_observation import format_observation_sample
 from bubble_drawing.bubble_model_control.cost_functions import vertical_tool_cost_function
 from bubble_drawing.bubble_model_control.aux.bubble_model_control_utils import batched_tensor_sample, convert_all_tfs_to_tensors
+from bubble_drawing.aux.latency_profiler import LatencyProfiler, enable_profiling, profile_span
 
 
 from bubble_utils.bubble_data_collection.data_collector_base import DataCollectorBase
@@ -32,7 +33,12 @@ from mmint_camera_utils.recording_utils.data_recording_wrappers import ActionSel
 class DrawingEvaluationDataCollection(DataCollectorBase):
 
     def __init__(self, *args, model_name='random', load_version=0, scene_name='drawing_evaluation', imprint_selection='percentile',
-                                                     imprint_percentile=0.005,  object_name='marker', debug=False, max_num_steps=40, ope='icp', **kwargs):
+                                                     imprint_percentile=0.005,  object_name='marker', debug=False, max_num_steps=40, ope='icp',
+                 profile_latency=False, latency_profile_format='json', **kwargs):
+        """
+        :param profile_latency: if True, the control loop stages are timed and their statistics saved for each evaluation on data_path/latency_profiles
+        :param latency_profile_format: 'json' (statistics and histograms) or 'csv' (statistics)
+        """
         self.scene_name = scene_name
         self.object_name = object_name
         self.num_samples = 100
@@ -47,6 +53,10 @@ class DrawingEvaluationDataCollection(DataCollectorBase):
         self.imprint_selection = imprint_selection
         self.imprint_percentile = imprint_percentile
         self.debug = debug
+        self.latency_profile_format = latency_profile_format
+        self.latency_profiler = None
+        if profile_latency:
+            self.latency_profiler = enable_profiling(LatencyProfiler())
         self.model_data_path = '/home/mmint/Desktop/drawing_models' # THIS is the path where we expect to load the model. Inside contains tb_logs/{model_name}/version_{version}/....
         self.reference_fc = None
         self.bubble_ref_obs = None
@@ -105,6 +115,9 @@ class DrawingEvaluationDataCollection(DataCollectorBase):
 
         actions_self_saved = ActionSelfSavedWrapper(actions, data_params=self.data_save_params)
         actions_self_saved.save_fc(fc)
+        if self.latency_profiler is not None:
+            self.latency_profiler.save(os.path.join(self.data_path, 'latency_profiles', '{:06d}.{}'.format(fc, self.latency_profile_format)))
+            print(self.latency_profiler.summary())
 
         # Evaluate
         self.env.med.set_control_mode(ControlMode.JOINT_POSITION, vel=0.1)
@@ -182,13 +195,14 @@ class DrawingEvaluationDataCollection(DataCollectorBase):
         return env
 
     def _get_controller(self):
-        if isinstance(self.model, ObjectPoseDynamicsModel):
+        # select by name: the loaded model may be an ExportedModel (see load_model_version)
+        if self.model_name == ObjectPoseDynamicsModel.get_name():
             grasp_pose_correction = None # get default one which does not correct the pose since it is direclty predicted corrected.
         else:
             grasp_pose_correction = drawing_one_dir_grasp_pose_correction
 
         # SELECT THE End2EndModelOutputObjectPoseEstimation if we have object_pose_dynamics_model, since the MPPI does not need to estimate pose from imprints
-        if self.model_name in ['object_pose_dynamics_model']:
+        if self.model_name == ObjectPoseDynamicsModel.get_name():
             # We do not need to estimate the pose from imprints since the model predicts directly the object pose.
             ope = End2EndModelOutputObjectPoseEstimation()
         else:
@@ -231,10 +245,13 @@ class DrawingEvaluationDataCollection(DataCollectorBase):
         obs_fcs.append(fc_init)
         obs_sample_raw = init_obs_sample.copy()
         step_i = 0
+        if self.latency_profiler is not None:
+            self.latency_profiler.reset() # one profile per evaluation
         for step_i in tqdm(range(num_steps)):
             random_action, valid_action = self.env.get_action()  # this is a
-            obs_sample = self.format_raw_observation(obs_sample_raw)    # Downsample the sample
-            if self.model_name in ['object_pose_dynamics_model']:
+            with profile_span('format_observation'):
+                obs_sample = self.format_raw_observation(obs_sample_raw)    # Downsample the sample
+            if self.model_name == ObjectPoseDynamicsModel.get_name():
                 # NEED TO ESTIMATE THE INITIAL POSE:
                 batched_obs_sample = obs_sample.copy()
                 batched_obs_sample['all_tfs'] = convert_all_tfs_to_tensors(batched_obs_sample['all_tfs'])
@@ -244,7 +261,8 @@ class DrawingEvaluationDataCollection(DataCollectorBase):
                 init_object_pose = homogeneous_pose_to_axis_angle(gf_X_objpose)[0].detach().cpu().numpy()
                 obs_sample['init_object_pose'] = init_object_pose
             if not self.model_name == 'random':
-                action = self.controller.control(obs_sample) # it is already an action dictionary
+                with profile_span('control'):
+                    action = self.controller.control(obs_sample) # it is already an action dictionary
                 # This is a test to see how random grasp width effect the performace.
                 if self.model_name == 'fixed_model':
                     action['grasp_width'] = random_action['grasp_width'] # random grasp_width
@@ -253,7 +271,8 @@ class DrawingEvaluationDataCollection(DataCollectorBase):
                 action = random_action
             # print('Action:', action)
             actions.append(action)
-            obs_sample_raw, reward, done, info = self.env.step(action)
+            with profile_span('action_execution'):
+                obs_sample_raw, reward, done, info = self.env.step(action) # includes the capture of the next observation
             fc_i = self.get_new_filecode()
             obs_sample_raw.modify_data_params(self.data_save_params)
             obs_sample_raw.save_fc(fc_i)
@@ -20,8 +20,10 @@ from bubble_drawing.bubble_contact_point_estimation.contact_point_marker_publish
 
 class BubbleDrawer(BubbleMed):
 
-    def __init__(self, *args, object_topic='estimated_object', drawing_frame='med_base', force_threshold=5., reactive=False, adjust_lift=False, compensate_xy_point=False, impedance_mode=True, **kwargs):
+    def __init__(self, *args, object_topic='estimated_object', drawing_frame='med_base', force_threshold=5., reactive=False, adjust_lift=False, compensate_xy_point=False, impedance_mode=True, pose_source=None, max_pose_age=0.5, **kwargs):
         self.object_topic = object_topic
+        self.pose_source = pose_source # (optional) streaming reconstructor (see BubblePCReconstructorROSBase.start_streaming). Its latest pose is used instead of waiting for the object_topic
+        self.max_pose_age = max_pose_age # (s) streamed poses older than this are not used, the object_topic is read instead
         self.drawing_frame = drawing_frame
         self.reactive = reactive # adjust drawing at keypoints/
         self.adjust_lift = adjust_lift
@@ -70,6 +72,14 @@ class BubbleDrawer(BubbleMed):
         return plane_pose
 
     def get_marker_pose(self):
+        if self.pose_source is not None:
+            latest_pose = self.pose_source.get_latest_pose(max_age=self.max_pose_age) # non-blocking. None if stale or not streaming
+            if latest_pose is not None:
+                marker_pose = {
+                    'pose': list(self._matrix_to_pose(latest_pose)),
+                    'frame': self.pose_source.reconstruction_frame,
+                }
+                return marker_pose
         data = self.pose_listener.get(block_until_data=True)
         pose = [data.pose.position.x,
                 data.pose.position.y,
@@ -3,6 +3,7 @@ import copy
 
 from mmint_camera_utils.aux.wrapping_utils import AttributeWrapper
 from bubble_drawing.aux.action_spaces import DiscreteElementSpace
+from bubble_drawing.aux.latency_profiler import profile_span
 
 
 class ControlledEnvWrapper(AttributeWrapper):
@@ -48,8 +49,10 @@ class ControlledEnvWrapper(AttributeWrapper):
             return random_action, valid_random_action
         else:
             # Use the controller
-            self.observation = self.env.get_observation()
-            controlled_action = self.controller.control(self.observation)
+            with profile_span('observation'):
+                self.observation = self.env.get_observation()
+            with profile_span('control'):
+                controlled_action = self.controller.control(self.observation)
             # NOTE: Some controllers like MPPI have internal parameters that store previously computed information to improve sample efficiency.
             #       Here, we will not update any information when we have random actions.
             # pack the action with the right order
@@ -1,13 +1,47 @@
 import os
 
+from bubble_drawing.bubble_learning.aux.model_export import export_model
+from bubble_drawing.bubble_learning.aux.model_registry import get_model_registry
 
-def load_model_version(Model, data_name, load_version):
-    model_name = Model.get_name()
-    version_chkp_path = os.path.join(data_name, 'tb_logs', '{}'.format(model_name),
-                                     'version_{}'.format(load_version), 'checkpoints')
-    checkpoints_fs = [f for f in os.listdir(version_chkp_path) if
-                      os.path.isfile(os.path.join(version_chkp_path, f))]
-    checkpoint_path = os.path.join(version_chkp_path, checkpoints_fs[0])
 
-    model = Model.load_from_checkpoint(checkpoint_path, dataset_params={'data_name': data_name})
-    return model
\ No newline at end of file
+def get_version_path(Model, data_name, load_version):
+    return get_model_registry().get_version_path(Model, data_name, load_version)
+
+
+def get_exported_model_path(Model, data_name, load_version):
+    return get_model_registry().get_exported_model_path(Model, data_name, load_version)
+
+
+def load_model_version(Model, data_name, load_version, prefer_exported=False, selection='best', use_cache=True):
+    """
+    Load a trained model version through the process model registry (see ModelRegistry), so models already loaded are not
+    loaded again from disk.
+    The returned model is shared with the other callers that load the same version: callers must not modify it (e.g. .to(),
+    train(), changing attributes). Use use_cache=False to get a private instance that can be modified.
+    :param prefer_exported: if True and the version has been exported (see export_model_version), load the exported
+        inference artifact instead of the Lightning checkpoint. Artifacts older than the checkpoints are ignored.
+        Exported models do not cache the object embeddings, so models with object models are usually faster eager.
+    :param selection: checkpoint to load: 'best' (lowest monitored val_loss) or 'last'
+    :param use_cache: if False, load a new instance that is not shared with other callers
+    :return: model (or ExportedModel)
+    """
+    model = get_model_registry().load(Model, data_name, load_version, selection=selection, prefer_exported=prefer_exported,
+                                      use_cache=use_cache)
+    return model
+
+
+def export_model_version(Model, data_name, load_version, device=None, example_sample=None, selection='best'):
+    """
+    Export a trained model version as a standalone inference artifact (see export_model). load_model_version loads it
+    with prefer_exported=True.
+    :param device: device where the model is traced. It should be the one used at control time.
+    :return: path of the exported artifact
+    """
+    # private instance: moving it and tracing it (eval mode, cache disabled) must not affect the models of other consumers
+    model = load_model_version(Model, data_name, load_version, prefer_exported=False, selection=selection, use_cache=False)
+    if device is not None:
+        model = model.to(device)
+    exported_path = get_exported_model_path(Model, data_name, load_version)
+    os.makedirs(os.path.dirname(exported_path), exist_ok=True)
+    export_model(model, exported_path, example_sample=example_sample)
+    return exported_path
@@ -0,0 +1,175 @@
+import json
+import copy
+import zipfile
+import torch
+
+from bubble_drawing.bubble_learning.models.dynamics_model_base import DynamicsModelBase
+
+LATENT_KEY = 'imprint_emb' # example input key for the methods that take the imprint embedding
+
+
+def get_export_methods(model):
+    """
+    Methods traced for each model and the keys of their inputs (in order).
+    :return: dict method_name -> list of input keys
+    """
+    input_keys = model.get_input_keys()
+    if not isinstance(model, DynamicsModelBase):
+        # e.g. ICPApproximationModel: model(imprint)
+        return {'forward': list(input_keys)}
+    # Dynamics models are called as model(*model_input, action)
+    methods = {'forward': list(input_keys) + ['action']}
+    if all(hasattr(model, m) for m in ['encode', 'decode', 'latent_forward']):
+        methods['encode'] = [input_keys[0]]
+        methods['decode'] = [LATENT_KEY]
+        methods['latent_forward'] = [LATENT_KEY] + list(input_keys[1:]) + ['action']
+    return methods
+
+
+def export_model(model, save_path, example_sample=None, batch_size=2, check_batch_size=5):
+    """
+    Trace the inference methods (forward and, if available, encode, decode and latent_forward) of the model and save them
+    as a standalone TorchScript artifact, together with the metadata needed by the controllers (keys, name, sizes).
+    The batch size is kept dynamic: the traces are checked against inputs with a different batch size.
+    Export the model on the device it is going to be used, since device constants may be recorded on the trace.
+    The object embedding cache of the dynamics models is not traceable, so the exported models run the pointnet on every
+    call. For the MPPI rollouts (the same object model repeated num_samples times) the eager model is usually faster.
+    :param model: trained model (e.g. BubbleDynamicsModel, ObjectPoseDynamicsModel, ICPApproximationModel)
+    :param save_path: path of the exported artifact (.pt)
+    :param example_sample: (optional) sample dict (without batch dimension) used to get the input shapes. If None, they
+        are taken from model.input_sizes
+    :param batch_size: batch size of the traced inputs
+    :param check_batch_size: batch size of the inputs used to check the traces
+    :return: ExportedModel
+    """
+    methods = get_export_methods(model)
+    was_training = model.training
+    model.eval()
+    object_embedding_cache_size = getattr(model, 'object_embedding_cache_size', None)
+    if object_embedding_cache_size is not None:
+        model.object_embedding_cache_size = 0 # the object embedding cache is not traceable, trace the pointnet
+    try:
+        inputs = {m: _get_example_inputs(model, keys, batch_size, example_sample) for m, keys in methods.items()}
+        check_inputs = [{m: _get_example_inputs(model, keys, check_batch_size, example_sample) for m, keys in methods.items()}]
+        with torch.no_grad():
+            traced_model = torch.jit.trace_module(model, inputs, check_inputs=check_inputs)
+    finally:
+        if object_embedding_cache_size is not None:
+            model.object_embedding_cache_size = object_embedding_cache_size
+        model.train(was_training)
+    metadata = {
+        'name': model.name,
+        'methods': list(methods.keys()),
+        'input_keys': list(model.get_input_keys()),
+        'model_output_keys': list(model.get_model_output_keys()),
+        'device': str(model.device),
+    }
+    if hasattr(model, 'get_state_keys'):
+        metadata['state_keys'] = list(model.get_state_keys())
+    if hasattr(model, 'get_next_state_map'):
+        metadata['next_state_map'] = dict(model.get_next_state_map())
+    if hasattr(model, 'img_embedding_size'):
+        metadata['img_embedding_size'] = int(model.img_embedding_size)
+    torch.jit.save(traced_model, save_path, _extra_files={'metadata.json': json.dumps(metadata)})
+    return ExportedModel(traced_model, metadata)
+
+
+def load_exported_model(load_path, device=None):
+    """
+    :param load_path: path of the artifact saved with export_model
+    :param device: device where the model is loaded. Default: the device it was exported on (cpu if cuda is not available)
+    :return: ExportedModel
+    """
+    if device is None:
+        exported_device = read_exported_metadata(load_path)['device']
+        device = torch.device(exported_device if 'cuda' not in exported_device or torch.cuda.is_available() else 'cpu')
+    extra_files = {'metadata.json': ''}
+    traced_model = torch.jit.load(load_path, map_location=device, _extra_files=extra_files)
+    metadata = json.loads(extra_files['metadata.json'])
+    return ExportedModel(traced_model, metadata)
+
+
+def read_exported_metadata(load_path):
+    # read the metadata without loading the model. TorchScript artifacts are zip files with the extra files in <archive>/extra/
+    with zipfile.ZipFile(load_path) as f:
+        metadata_name = [name for name in f.namelist() if name.endswith('/extra/metadata.json')][0]
+        metadata = json.loads(f.read(metadata_name))
+    return metadata
+
+
+class ExportedModel(object):
+    """
+    Inference-only model loaded from an exported artifact. It exposes the interface used by the controllers and the
+    object pose estimators (call, encode, decode, latent_forward, the key getters, name, device,...) without Lightning.
+    """
+    def __init__(self, traced_model, metadata):
+        self.traced_model = traced_model
+        self.metadata = metadata
+        for param in self.traced_model.parameters():
+            param.requires_grad_(False) # inference only
+        for method_name in self.metadata['methods']:
+            if method_name != 'forward':
+                setattr(self, method_name, getattr(self.traced_model, method_name))
+        if 'img_embedding_size' in self.metadata:
+            self.img_embedding_size = self.metadata['img_embedding_size']
+
+    def __call__(self, *args):
+        return self.traced_model(*args)
+
+    def forward(self, *args):
+        return self.traced_model(*args)
+
+    def get_name(self):
+        return self.metadata['name']
+
+    @property
+    def name(self):
+        return self.get_name()
+
+    @property
+    def device(self):
+        return next(self.traced_model.parameters()).device
+
+    def eval(self):
+        # the traces are recorded in eval mode
+        return self
+
+    def to(self, device):
+        self.traced_model.to(device)
+        return self
+
+    def get_input_keys(self):
+        return copy.deepcopy(self.metadata['input_keys'])
+
+    def get_state_keys(self):
+        return copy.deepcopy(self.metadata['state_keys'])
+
+    def get_model_output_keys(self):
+        return copy.deepcopy(self.metadata['model_output_keys'])
+
+    def get_next_state_map(self):
+        return copy.deepcopy(self.metadata['next_state_map'])
+
+    def get_model_input(self, sample):
+        model_input = tuple([sample[key] for key in self.get_input_keys()])
+        return model_input
+
+    def get_model_output(self, sample):
+        output_keys = self.get_model_output_keys()
+        next_state_map = self.metadata.get('next_state_map', {key: key for key in output_keys})
+        model_output = tuple([sample[next_state_map[key]] for key in output_keys])
+        return model_output
+
+
+def _get_example_inputs(model, keys, batch_size, example_sample=None):
+    example_inputs = []
+    for key in keys:
+        if key == LATENT_KEY:
+            shape = (model.img_embedding_size,)
+        elif example_sample is not None:
+            shape = tuple(torch.as_tensor(example_sample[key]).shape)
+        else:
+            size = model.input_sizes[key]
+            shape = (size,) if isinstance(size, int) else tuple(size)
+        example_inputs.append(torch.rand((batch_size,) + shape, device=model.device, dtype=model.dtype))
+    return tuple(example_inputs)
@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import torch
+from collections import OrderedDict
+
+from bubble_drawing.bubble_learning.aux.model_export import load_exported_model
+
+INDEX_FILE_NAME = 'checkpoint_index.json'
+SLIM_CHECKPOINTS_DIR = 'slim_checkpoints'
+SLIM_CHECKPOINT_KEYS = ['state_dict', 'hyper_parameters', 'pytorch-lightning_version', 'epoch', 'global_step']
+
+
+class ModelRegistry(object):
+    """
+    Indexes the checkpoints of the trained models (data_name/tb_logs/{model_name}/version_*/checkpoints) and loads them.
+     - Checkpoints are selected by their monitored metric ('best') or by their training step ('last') instead of the listing order.
+     - The index (epoch, step and score of each checkpoint) is stored on each version directory, so each checkpoint is only read once.
+     - Models are loaded from a slim copy of the checkpoint that only keeps the weights and hyperparameters (no optimizer state).
+     - Loaded models are kept in an in-process LRU, so loading the same model again (e.g. switching controllers or object
+       pose estimators) does not read from disk. The same model instance is returned to all the consumers, so they must not
+       modify it; load with use_cache=False to get a private instance.
+    """
+    def __init__(self, max_loaded_models=4):
+        """
+        :param max_loaded_models: number of models kept loaded. 0 disables the LRU.
+        """
+        self.max_loaded_models = max_loaded_models
+        self.loaded_models = OrderedDict() # Key: (model_name, checkpoint_path, checkpoint mtime, prefer_exported). Value: model
+
+    def get_version_path(self, Model, data_name, load_version):
+        return os.path.join(data_name, 'tb_logs', '{}'.format(Model.get_name()), 'version_{}'.format(load_version))
+
+    def get_versions(self, Model, data_name):
+        # trained versions of the model, sorted
+        model_path = os.path.join(data_name, 'tb_logs', '{}'.format(Model.get_name()))
+        if not os.path.isdir(model_path):
+            return []
+        versions = [int(d.split('_')[-1]) for d in os.listdir(model_path) if re.fullmatch(r'version_\d+', d)]
+        return sorted(versions)
+
+    def get_checkpoints(self, Model, data_name, load_version):
+        """
+        :return: list of dicts with the 'name', 'path', 'mtime', 'epoch', 'step', 'score' (monitored metric, None if not monitored) and 'monitor' of each checkpoint
+        """
+        version_path = self.get_version_path(Model, data_name, load_version)
+        checkpoints_path = os.path.join(version_path, 'checkpoints')
+        checkpoint_names = sorted([f for f in os.listdir(checkpoints_path) if os.path.isfile(os.path.join(checkpoints_path, f))])
+        if not checkpoint_names:
+            raise FileNotFoundError('No checkpoints found on {}'.format(checkpoints_path))
+        index = self._load_index(version_path)
+        index_updated = False
+        checkpoints = []
+        for checkpoint_name in checkpoint_names:
+            checkpoint_path = os.path.join(checkpoints_path, checkpoint_name)
+            stat = os.stat(checkpoint_path)
+            entry = index.get(checkpoint_name)
+            if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+                entry = self._index_checkpoint(checkpoint_path)
+                entry.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+                index[checkpoint_name] = entry
+                index_updated = True
+            checkpoint_info = {'name': checkpoint_name, 'path': checkpoint_path}
+            checkpoint_info.update(entry)
+            checkpoints.append(checkpoint_info)
+        if index_updated or set(index.keys()) != set(checkpoint_names):
+            self._save_index(version_path, {cp['name']: index[cp['name']] for cp in checkpoints})
+        return checkpoints
+
+    def get_checkpoint(self, Model, data_name, load_version, selection='best'):
+        """
+        :param selection: 'best' (lowest monitored score, e.g. val_loss; the last one if no score is monitored) or 'last' (highest epoch and step)
+        :return: checkpoint info dict (see get_checkpoints)
+        """
+        checkpoints = self.get_checkpoints(Model, data_name, load_version)
+        # last.ckpt goes after the checkpoint with the same epoch and step
+        last_key = lambda cp: (cp['epoch'], cp['step'], cp['name'] == 'last.ckpt')
+        if selection == 'last':
+            return max(checkpoints, key=last_key)
+        elif selection == 'best':
+            scored_checkpoints = [cp for cp in checkpoints if cp['score'] is not None]
+            if not scored_checkpoints:
+                return max(checkpoints, key=last_key)
+            return min(scored_checkpoints, key=lambda cp: (cp['score'], -cp['epoch'], -cp['step']))
+        else:
+            raise ValueError('Checkpoint selection {} not supported. Available options: best, last'.format(selection))
+
+    def load(self, Model, data_name, load_version, selection='best', prefer_exported=False, use_cache=True):
+        """
+        The returned model may be shared with other consumers (see use_cache). Do not modify it (device, train/eval mode, attributes).
+        :param selection: checkpoint selection (see get_checkpoint)
+        :param prefer_exported: if True and the version has been exported (see export_model_version), load the exported
+            inference artifact instead of the checkpoint. Artifacts older than the checkpoints are ignored. The exported
+            models run the pointnet on every call (they do not have the object embedding cache, see export_model).
+        :param use_cache: if False, load a new instance that is not shared (nor kept on the LRU), so it can be modified
+        :return: model (or ExportedModel)
+        """
+        checkpoints = self.get_checkpoints(Model, data_name, load_version)
+        checkpoint = self.get_checkpoint(Model, data_name, load_version, selection=selection)
+        exported_path = self.get_exported_model_path(Model, data_name, load_version)
+        use_exported = False
+        if prefer_exported and os.path.isfile(exported_path):
+            use_exported = os.path.getmtime(exported_path) >= max([cp['mtime'] for cp in checkpoints])
+            if not use_exported:
+                print('Exported model {} is older than the checkpoints. Loading the checkpoint instead. Export it again to use it.'.format(exported_path))
+        if use_exported:
+            model_key = (Model.get_name(), os.path.abspath(exported_path), os.path.getmtime(exported_path), True)
+        else:
+            model_key = (Model.get_name(), os.path.abspath(checkpoint['path']), checkpoint['mtime'], False)
+        if use_cache and model_key in self.loaded_models:
+            self.loaded_models.move_to_end(model_key) # least recently used first
+            return self.loaded_models[model_key]
+        if use_exported:
+            model = load_exported_model(exported_path)
+        else:
+            slim_checkpoint_path = self._get_slim_checkpoint(checkpoint)
+            model = Model.load_from_checkpoint(slim_checkpoint_path, dataset_params={'data_name': data_name})
+        if use_cache and self.max_loaded_models > 0:
+            self.loaded_models[model_key] = model
+            while len(self.loaded_models) > self.max_loaded_models:
+                self.loaded_models.popitem(last=False)
+        return model
+
+    def get_exported_model_path(self, Model, data_name, load_version):
+        return os.path.join(self.get_version_path(Model, data_name, load_version), 'exported', '{}.pt'.format(Model.get_name()))
+
+    def clear(self):
+        self.loaded_models = OrderedDict()
+
+    def _index_checkpoint(self, checkpoint_path):
+        checkpoint = torch.load(checkpoint_path, map_location='cpu')
+        entry = {
+            'epoch': int(checkpoint.get('epoch', -1)),
+            'step': int(checkpoint.get('global_step', -1)),
+            'score': None,
+            'monitor': None,
+        }
+        # the ModelCheckpoint callback state stores the monitored metric of the checkpoint being saved
+        for callback_state in checkpoint.get('callbacks', {}).values():
+            if isinstance(callback_state, dict) and callback_state.get('current_score') is not None:
+                entry['score'] = float(callback_state['current_score'])
+                entry['monitor'] = callback_state.get('monitor')
+                break
+        return entry
+
+    def _get_slim_checkpoint(self, checkpoint):
+        # weights-only copy of the checkpoint. It is created the first time the checkpoint is loaded
+        checkpoints_path = os.path.dirname(checkpoint['path'])
+        slim_checkpoint_path = os.path.join(os.path.dirname(checkpoints_path), SLIM_CHECKPOINTS_DIR, checkpoint['name'])
+        if not os.path.isfile(slim_checkpoint_path) or os.path.getmtime(slim_checkpoint_path) < checkpoint['mtime']:
+            full_checkpoint = torch.load(checkpoint['path'], map_location='cpu')
+            slim_checkpoint = {k: full_checkpoint[k] for k in SLIM_CHECKPOINT_KEYS if k in full_checkpoint}
+            os.makedirs(os.path.dirname(slim_checkpoint_path), exist_ok=True)
+            tmp_path = slim_checkpoint_path + '.tmp'
+            torch.save(slim_checkpoint, tmp_path)
+            os.replace(tmp_path, slim_checkpoint_path) # atomic, so other processes never read a partial copy
+        return slim_checkpoint_path
+
+    def _load_index(self, version_path):
+        index_path = os.path.join(version_path, INDEX_FILE_NAME)
+        if not os.path.isfile(index_path):
+            return {}
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _save_index(self, version_path, index):
+        index_path = os.path.join(version_path, INDEX_FILE_NAME)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_path, index_path)
+
+
+_model_registry = None
+
+
+def get_model_registry():
+    # registry shared by all the consumers of the process
+    global _model_registry
+    if _model_registry is None:
+        _model_registry = ModelRegistry()
+    return _model_registry
@@ -0,0 +1,62 @@
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+
+
+class PoseEstimationCache(object):
+    """
+    Persistent on-disk cache of object poses estimated from the bubble imprints.
+    Each pose is stored on its own file named after the hash of its key, and written atomically, so several processes
+    can share the same cache.
+    """
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        os.makedirs(self.cache_path, exist_ok=True)
+
+    def get_key(self, scene_name, undef_fc, def_fc, estimator_params):
+        """
+        :param scene_name: scene of the sample
+        :param undef_fc: file code of the undeformed (reference) depth images
+        :param def_fc: file code of the deformed depth images
+        :param estimator_params: dict containing the pose estimation parameters
+        :return: key (str)
+        """
+        key_dict = {
+            'scene_name': scene_name,
+            'undef_fc': int(undef_fc),
+            'def_fc': int(def_fc),
+            'estimator_params': estimator_params,
+        }
+        key_str = json.dumps(key_dict, sort_keys=True, default=str)
+        key = hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+        return key
+
+    def load(self, key):
+        """
+        :return: cached pose or None if not cached
+        """
+        pose_path = self._get_pose_path(key)
+        if not os.path.isfile(pose_path):
+            return None
+        try:
+            pose = np.load(pose_path)
+        except (ValueError, OSError, EOFError):
+            # corrupted file, estimate it again
+            return None
+        return pose
+
+    def save(self, key, pose):
+        pose_path = self._get_pose_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(pose))
+            os.replace(tmp_path, pose_path)  # atomic
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _get_pose_path(self, key):
+        return os.path.join(self.cache_path, '{}.npy'.format(key))
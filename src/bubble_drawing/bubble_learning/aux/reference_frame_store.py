@@ -0,0 +1,128 @@
+import os
+import pickle
+import hashlib
+import tempfile
+
+REFERENCE_KEYS = ['undef_depth_r', 'undef_depth_l', 'camera_info_r', 'camera_info_l']
+
+_stores = {} # stores opened on this process. Key: store_path
+
+
+class ReferenceFrameStore(object):
+    """
+    Content-addressed store for the reference (undeformed) depth images and camera info.
+    Samples sharing the same reference only keep a ReferenceFrame pointing to it. References are stored on disk
+    (if store_path is provided) and kept in memory once loaded.
+    """
+    def __init__(self, store_path=None):
+        """
+        :param store_path: directory where the references are saved. If None, references are only kept in memory.
+        """
+        self.store_path = store_path
+        if self.store_path is not None:
+            os.makedirs(self.store_path, exist_ok=True)
+        self.references = {} # loaded references. Key: ref_id
+        _stores[self._get_store_key()] = self
+
+    def put(self, reference):
+        """
+        Add a reference to the store
+        :param reference: dict containing the REFERENCE_KEYS values
+        :return: ReferenceFrame pointing to the stored reference
+        """
+        reference = {k: reference[k] for k in REFERENCE_KEYS}
+        ref_id = hashlib.sha1(pickle.dumps(reference)).hexdigest()
+        if ref_id not in self.references:
+            self.references[ref_id] = reference
+            if self.store_path is not None and not os.path.isfile(self._get_reference_path(ref_id)):
+                self._save(ref_id, reference)
+        return ReferenceFrame(ref_id, store=self)
+
+    def get(self, ref_id):
+        if ref_id not in self.references:
+            if self.store_path is None:
+                raise KeyError('Reference {} not found on the in-memory store'.format(ref_id))
+            with open(self._get_reference_path(ref_id), 'rb') as f:
+                self.references[ref_id] = pickle.load(f)
+        return self.references[ref_id]
+
+    def _save(self, ref_id, reference):
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(reference, f)
+            os.replace(tmp_path, self._get_reference_path(ref_id))  # atomic
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _get_reference_path(self, ref_id):
+        return os.path.join(self.store_path, '{}.pkl'.format(ref_id))
+
+    def _get_store_key(self):
+        if self.store_path is None:
+            return 'memory_{}'.format(id(self))
+        return os.path.abspath(self.store_path)
+
+
+def get_reference_frame_store(store_path):
+    store_key = os.path.abspath(store_path)
+    if store_key not in _stores:
+        ReferenceFrameStore(store_path)
+    return _stores[store_key]
+
+
+class ReferenceFrame(object):
+    """
+    Lazy pointer to a reference stored on a ReferenceFrameStore. It is resolved only when the reference values are needed.
+    It is not a tensor, so batched_tensor_sample passes it as it is (no copies).
+    """
+    def __init__(self, ref_id, store):
+        self.ref_id = ref_id
+        self.store = store
+
+    def resolve(self):
+        """
+        :return: dict containing the reference values (REFERENCE_KEYS)
+        """
+        return self.store.get(self.ref_id)
+
+    def __eq__(self, other):
+        return isinstance(other, ReferenceFrame) and other.ref_id == self.ref_id
+
+    def __hash__(self):
+        return hash(self.ref_id)
+
+    def __repr__(self):
+        return 'ReferenceFrame({})'.format(self.ref_id)
+
+    def __getstate__(self):
+        # Only the id and the store path are pickled, the referenced data is stored once on the store
+        if self.store.store_path is None:
+            raise pickle.PicklingError('ReferenceFrame from an in-memory store can not be pickled. Provide a store_path to the ReferenceFrameStore')
+        return {'ref_id': self.ref_id, 'store_path': self.store.store_path}
+
+    def __setstate__(self, state):
+        self.ref_id = state['ref_id']
+        self.store = get_reference_frame_store(state['store_path'])
+
+
+def compress_reference_frame(sample, store):
+    """
+    Replace the reference values of the sample by a ReferenceFrame (key 'reference_frame')
+    """
+    reference = {k: sample.pop(k) for k in REFERENCE_KEYS}
+    sample['reference_frame'] = store.put(reference)
+    return sample
+
+
+def resolve_reference_frame(sample):
+    """
+    Return a (shallow) copy of the sample with the reference values instead of the ReferenceFrame
+    """
+    if 'reference_frame' not in sample:
+        return sample
+    resolved_sample = sample.copy()
+    reference_frame = resolved_sample.pop('reference_frame')
+    resolved_sample.update(reference_frame.resolve())
+    return resolved_sample
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import tf.transformations as tr
 
@@ -5,12 +6,14 @@ from bubble_utils.bubble_datasets.bubble_dataset_base import BubbleDatasetBase
 from bubble_drawing.bubble_learning.aux.img_trs.block_downsampling_tr import BlockDownSamplingTr
 from bubble_drawing.aux.load_confs import load_object_models
 from bubble_drawing.bubble_pose_estimation.bubble_pc_reconstruction import BubblePCReconstructorOfflineDepth
+from bubble_drawing.bubble_learning.aux.pose_estimation_cache import PoseEstimationCache
+from bubble_drawing.bubble_learning.aux.reference_frame_store import ReferenceFrameStore, compress_reference_frame
 from mmint_camera_utils.ros_utils.utils import matrix_to_pose, pose_to_matrix
 
 
 class BubbleDrawingDataset(BubbleDatasetBase):
 
-    def __init__(self, *args, wrench_frame=None, tf_frame='grasp_frame', view=False,  downsample_factor_x=1, downsample_factor_y=1, downsample_reduction='mean', **kwargs):
+    def __init__(self, *args, wrench_frame=None, tf_frame='grasp_frame', view=False,  downsample_factor_x=1, downsample_factor_y=1, downsample_reduction='mean', pose_cache=True, reference_frames=False, **kwargs):
         self.downsample_factor_x = downsample_factor_x
         self.downsample_factor_y = downsample_factor_y
         self.downsample_reduction = downsample_reduction
@@ -23,6 +26,18 @@ class BubbleDrawingDataset(BubbleDatasetBase):
         self.wrench_frame = wrench_frame
         self.tf_frame = tf_frame
         self.view = view
+        self.pose_cache = pose_cache # If True, the estimated object poses are stored on disk and reused when the data is processed again
+        self.pose_estimation_params = {
+            'object_name': 'marker',
+            'estimation_type': 'icp2d',
+            'percentile': 0.005,
+            'threshold': 0.,
+        }
+        self._reconstructors = {} # reconstructors are reused across samples. Key: pose estimation params
+        self._pose_estimation_cache = None
+        self.reference_frames = reference_frames # If True, samples keep a ReferenceFrame (key 'reference_frame') instead of a copy of the reference depths and camera infos. Changing it requires to process the data again.
+        self._reference_frame_store = None
+        self._object_models = None # loaded once
         super().__init__(*args, **kwargs)
 
     @classmethod
@@ -74,8 +89,10 @@ class BubbleDrawingDataset(BubbleDatasetBase):
 
         object_code = self._get_object_code(sample_code)
         object_model = self._get_object_model(object_code)
-        init_object_pose = self._estimate_object_pose(init_def_depth_r, init_def_depth_l, undef_depth_r, undef_depth_l, camera_info_r, camera_info_l, all_tfs)
-        final_object_pose = self._estimate_object_pose(final_def_depth_r, final_def_depth_l, undef_depth_r, undef_depth_l, camera_info_r, camera_info_l, all_tfs)
+        init_object_pose = self._estimate_object_pose(init_def_depth_r, init_def_depth_l, undef_depth_r, undef_depth_l, camera_info_r, camera_info_l, all_tfs,
+                                                      scene_name=scene_name, undef_fc=undef_fc, def_fc=init_fc)
+        final_object_pose = self._estimate_object_pose(final_def_depth_r, final_def_depth_l, undef_depth_r, undef_depth_l, camera_info_r, camera_info_l, all_tfs,
+                                                       scene_name=scene_name, undef_fc=undef_fc, def_fc=final_fc)
         sample_simple = {
             'init_imprint': init_imprint,
             'init_wrench': init_wrench,
@@ -98,6 +115,8 @@ class BubbleDrawingDataset(BubbleDatasetBase):
         }
         sample = self._reshape_sample(sample_simple)
         sample = self._compute_delta_sample(sample) # Add delta values to sample
+        if self.reference_frames:
+            sample = compress_reference_frame(sample, self._get_reference_frame_store())
 
         return sample
 
@@ -111,9 +130,18 @@ class BubbleDrawingDataset(BubbleDatasetBase):
         # action_i = length * np.array([np.cos(direction), np.sin(direction)])
         return action_i
 
-    def _estimate_object_pose(self, def_r, def_l, ref_r, ref_l, camera_info_r, camera_info_l, all_tfs):
-        reconstructor = BubblePCReconstructorOfflineDepth(object_name='marker', estimation_type='icp2d', view=self.view, percentile=0.005)
-        reconstructor.threshold = 0.
+    def _estimate_object_pose(self, def_r, def_l, ref_r, ref_l, camera_info_r, camera_info_l, all_tfs, scene_name=None, undef_fc=None, def_fc=None):
+        """
+        Estimate the object pose from the depth images. If scene_name, undef_fc and def_fc are provided, the pose is looked up on the pose cache first.
+        """
+        cache_key = None
+        pose_cache = self._get_pose_estimation_cache()
+        if pose_cache is not None and not self.view and None not in [scene_name, undef_fc, def_fc]:
+            cache_key = pose_cache.get_key(scene_name, undef_fc, def_fc, self.pose_estimation_params)
+            pose = pose_cache.load(cache_key)
+            if pose is not None:
+                return pose
+        reconstructor = self._get_reconstructor()
         reconstructor.references['left'] = ref_l
         reconstructor.references['right'] = ref_r
         reconstructor.references['left_frame'] = 'pico_flexx_left_optical_frame'
@@ -124,19 +152,49 @@ class BubbleDrawingDataset(BubbleDatasetBase):
         reconstructor.depth_l['img'] = def_l
         reconstructor.depth_r['frame'] = 'pico_flexx_right_optical_frame'
         reconstructor.depth_l['frame'] = 'pico_flexx_left_optical_frame'
+        reconstructor.reset_tfs()
         reconstructor.add_tfs(all_tfs)
-        pose_matrix = reconstructor.estimate_pose(threshold=0, view=self.view) # Homogeneous
+        reconstructor.pose_estimator.last_tr = None # estimate each sample independently
+        pose_matrix = reconstructor.estimate_pose(threshold=self.pose_estimation_params['threshold'], view=self.view) # Homogeneous
         pose = matrix_to_pose(pose_matrix)
+        if cache_key is not None:
+            pose_cache.save(cache_key, pose)
         return pose
 
+    def _get_reconstructor(self):
+        # Creating a reconstructor is expensive (it loads the object models and initializes ros), so we reuse them.
+        reconstructor_key = tuple(sorted(self.pose_estimation_params.items()))
+        if reconstructor_key not in self._reconstructors:
+            reconstructor = BubblePCReconstructorOfflineDepth(object_name=self.pose_estimation_params['object_name'],
+                                                              estimation_type=self.pose_estimation_params['estimation_type'],
+                                                              view=self.view, percentile=self.pose_estimation_params['percentile'])
+            reconstructor.threshold = self.pose_estimation_params['threshold']
+            self._reconstructors[reconstructor_key] = reconstructor
+        return self._reconstructors[reconstructor_key]
+
+    def _get_pose_estimation_cache(self):
+        if self.pose_cache and self._pose_estimation_cache is None:
+            # stored next to the processed data (not inside) so it survives reprocessing the dataset
+            cache_path = os.path.join(os.path.dirname(os.path.normpath(self.processed_data_path)), 'pose_estimation_cache')
+            self._pose_estimation_cache = PoseEstimationCache(cache_path)
+        return self._pose_estimation_cache
+
+    def _get_reference_frame_store(self):
+        if self._reference_frame_store is None:
+            # all samples recorded with the same undeformed state point to the same reference
+            store_path = os.path.join(os.path.dirname(os.path.normpath(self.processed_data_path)), 'reference_frames')
+            self._reference_frame_store = ReferenceFrameStore(store_path)
+        return self._reference_frame_store
+
     def _get_object_code(self, fc):
         dl_line = self.dl.iloc[fc]
         object_code = dl_line['marker_init']
         return object_code
 
     def _get_object_model(self, object_code):
-        object_models = load_object_models() # TODO: Consdier doing this more efficient to avoid having to load every time
-        object_model_pcd = object_models[object_code]
+        if self._object_models is None:
+            self._object_models = load_object_models()
+        object_model_pcd = self._object_models[object_code]
         object_model = np.asarray(object_model_pcd.points)
         return object_model
 
@@ -0,0 +1,172 @@
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+STATIC_KEYS = ['undef_depth_r', 'undef_depth_l', 'camera_info_r', 'camera_info_l', 'object_model', 'all_tfs']
+
+
+def export_columnar_dataset(dataset, save_path, static_keys=None):
+    """
+    Export the processed samples of a dataset to a columnar format:
+     - fixed-shape numeric fields (imprints, wrenches, poses, actions,...) are packed into one memory-mapped array per key (num_samples, *shape)
+     - static fields (reference depths, camera info, object models, tfs,...) are stored once and referenced by index.
+     - any other field (e.g. strings) is also treated as static.
+    :param dataset: dataset returning sample dicts
+    :param save_path: directory where the columnar dataset is saved
+    :param static_keys: keys to store deduplicated. Default: STATIC_KEYS
+    :return: ColumnarDataset
+    """
+    if static_keys is None:
+        static_keys = STATIC_KEYS
+    os.makedirs(save_path, exist_ok=True)
+    num_samples = len(dataset)
+    sample_0 = dataset[0]
+    array_keys = [k for k, v in sample_0.items() if k not in static_keys and _is_array(v)]
+    static_keys = [k for k in sample_0.keys() if k not in array_keys]
+    metadata = {
+        'num_samples': num_samples,
+        'array_keys': {k: {'dtype': str(_to_numpy(sample_0[k]).dtype), 'shape': list(_to_numpy(sample_0[k]).shape), 'is_tensor': torch.is_tensor(sample_0[k])} for k in array_keys},
+        'static_keys': static_keys,
+    }
+    arrays = {}
+    for key, array_info in metadata['array_keys'].items():
+        arrays[key] = np.lib.format.open_memmap(_get_array_path(save_path, key), mode='w+', dtype=np.dtype(array_info['dtype']),
+                                                shape=(num_samples, *array_info['shape']))
+    static_values = {k: [] for k in static_keys}
+    static_hashes = {k: {} for k in static_keys}
+    static_indxs = {k: np.zeros(num_samples, dtype=np.int64) for k in static_keys}
+    for i in tqdm(range(num_samples)):
+        sample_i = sample_0 if i == 0 else dataset[i]
+        for key in array_keys:
+            value_i = _to_numpy(sample_i[key])
+            if list(value_i.shape) != metadata['array_keys'][key]['shape']:
+                raise ValueError('Sample {} key {} has shape {} but expected {}. Only fixed-shape fields can be stored as arrays; add it to the static_keys'.format(i, key, value_i.shape, metadata['array_keys'][key]['shape']))
+            arrays[key][i] = value_i
+        for key in static_keys:
+            value_i = sample_i[key]
+            hash_i = hashlib.sha1(pickle.dumps(value_i)).hexdigest()
+            if hash_i not in static_hashes[key]:
+                static_hashes[key][hash_i] = len(static_values[key])
+                static_values[key].append(value_i)
+            static_indxs[key][i] = static_hashes[key][hash_i]
+    for key in array_keys:
+        arrays[key].flush()
+    with open(_get_static_data_path(save_path), 'wb') as f:
+        pickle.dump({'values': static_values, 'indxs': static_indxs}, f)
+    with open(os.path.join(save_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return ColumnarDataset(save_path)
+
+
+class ColumnarDataset(Dataset):
+    """
+    Dataset reading the samples exported with export_columnar_dataset.
+    Arrays are memory-mapped, so opening the dataset is instant and samples (or slices of samples) are views on the files.
+    """
+    def __init__(self, data_path, keys=None):
+        """
+        :param data_path: path to the exported columnar dataset
+        :param keys: keys to return on the samples. Default: all keys
+        """
+        self.data_path = data_path
+        with open(os.path.join(self.data_path, 'metadata.json'), 'r') as f:
+            self.metadata = json.load(f)
+        self.num_samples = self.metadata['num_samples']
+        self.array_keys = list(self.metadata['array_keys'].keys())
+        self.static_keys = self.metadata['static_keys']
+        if keys is not None:
+            self.array_keys = [k for k in self.array_keys if k in keys]
+            self.static_keys = [k for k in self.static_keys if k in keys]
+        self._arrays = None # opened lazily so each worker process maps its own files
+        self._static_data = None
+
+    @classmethod
+    def get_name(cls):
+        return 'columnar_dataset'
+
+    @property
+    def name(self):
+        return self.get_name()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, item):
+        """
+        :param item: sample index or slice. Slices return a batched sample where the array values are views on the memory-mapped files.
+        :return: sample dict
+        """
+        arrays, static_data = self._get_data()
+        sample = {}
+        for key in self.array_keys:
+            value = np.asarray(arrays[key][item]) # view, no copy
+            if self.metadata['array_keys'][key]['is_tensor']:
+                value = torch.from_numpy(value)
+            sample[key] = value
+        for key in self.static_keys:
+            static_indxs = static_data['indxs'][key][item]
+            if np.ndim(static_indxs) == 0:
+                sample[key] = static_data['values'][key][static_indxs]
+            else:
+                sample[key] = [static_data['values'][key][indx] for indx in static_indxs]
+        return sample
+
+    def get_static_indxs(self, key):
+        # Index of the static value referenced by each sample (num_samples,)
+        arrays, static_data = self._get_data()
+        return static_data['indxs'][key]
+
+    def get_static_values(self, key):
+        # Unique values stored for key
+        arrays, static_data = self._get_data()
+        return static_data['values'][key]
+
+    def _get_data(self):
+        if self._arrays is None:
+            # copy-on-write mapping: zero-copy reads and the returned tensors are writable without modifying the files
+            self._arrays = {key: np.load(_get_array_path(self.data_path, key), mmap_mode='c') for key in self.array_keys}
+            with open(_get_static_data_path(self.data_path), 'rb') as f:
+                self._static_data = pickle.load(f)
+        return self._arrays, self._static_data
+
+
+def _get_array_path(save_path, key):
+    return os.path.join(save_path, '{}.npy'.format(key))
+
+
+def _get_static_data_path(save_path):
+    return os.path.join(save_path, 'static_data.pkl')
+
+
+def _is_array(value):
+    if torch.is_tensor(value):
+        return True
+    if isinstance(value, np.ndarray):
+        return value.dtype != object
+    return isinstance(value, (int, float, np.number, bool, np.bool_))
+
+
+def _to_numpy(value):
+    if torch.is_tensor(value):
+        return value.detach().cpu().numpy()
+    return np.asarray(value)
+
+
+# DEBUG
+if __name__ == '__main__':
+    import time
+    from bubble_drawing.bubble_learning.datasets.bubble_drawing_dataset import BubbleDrawingDataset
+    data_name = '/home/mmint/Desktop/drawing_data_one_direction'
+    dataset = BubbleDrawingDataset(data_name=data_name, wrench_frame='med_base', tf_frame='grasp_frame', downsample_factor_x=7,
+                                   downsample_factor_y=7, downsample_reduction='mean')
+    columnar_path = os.path.join(data_name, 'columnar_data', dataset.name)
+    export_columnar_dataset(dataset, columnar_path)
+    start_time = time.time()
+    columnar_dataset = ColumnarDataset(columnar_path)
+    batch = columnar_dataset[0:len(columnar_dataset)]
+    print('Loaded {} samples in {:.4f} s'.format(len(columnar_dataset), time.time() - start_time))
@@ -0,0 +1,136 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from tqdm import tqdm
+
+IMPRINT_KEYS = ['init_imprint', 'final_imprint']
+
+
+def get_encoder_hash(autoencoder):
+    """
+    Hash of the autoencoder weights (and normalization statistics), so latents computed with a different autoencoder version are not reused.
+    :param autoencoder: BubbleAutoEncoderModel
+    :return: hex string
+    """
+    sha = hashlib.sha1()
+    for key, value in autoencoder.state_dict().items():
+        sha.update(key.encode())
+        sha.update(value.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def get_latent_imprints_path(dataset, encoder_hash):
+    # the latents are stored next to the processed data of the dataset
+    return os.path.join(dataset.data_path, 'latent_imprints', '{}_{}'.format(dataset.name, encoder_hash[:16]))
+
+
+def precompute_latent_imprints(dataset, autoencoder, save_path=None, imprint_keys=None, batch_size=100, device=None):
+    """
+    Encode the imprints of all the dataset samples once with the autoencoder and store the latent codes as one array per key (num_samples, img_embedding_size).
+    The latent of sample_i[key] is saved as '{key}_emb'.
+    :param dataset: dataset returning sample dicts with the imprint_keys
+    :param autoencoder: BubbleAutoEncoderModel
+    :param save_path: directory where the latents are saved. Default: get_latent_imprints_path(dataset, encoder_hash)
+    :param imprint_keys: keys of the imprints to encode. Default: IMPRINT_KEYS
+    :param batch_size: number of imprints encoded at once
+    :param device: device where the encoding is done. Default: the autoencoder device
+    :return: path where the latents are saved
+    """
+    if imprint_keys is None:
+        imprint_keys = IMPRINT_KEYS
+    encoder_hash = get_encoder_hash(autoencoder)
+    if save_path is None:
+        save_path = get_latent_imprints_path(dataset, encoder_hash)
+    if device is None:
+        device = autoencoder.device
+    os.makedirs(save_path, exist_ok=True)
+    num_samples = len(dataset)
+    was_training = autoencoder.training
+    autoencoder.eval()
+    latents = {key: [] for key in imprint_keys}
+    with torch.no_grad():
+        for start_indx in tqdm(range(0, num_samples, batch_size)):
+            samples = [dataset[i] for i in range(start_indx, min(start_indx + batch_size, num_samples))]
+            for key in imprint_keys:
+                imprints = torch.stack([torch.as_tensor(sample_i[key]) for sample_i in samples], dim=0).to(device=device, dtype=autoencoder.dtype)
+                latents[key].append(autoencoder.encode(imprints).cpu().numpy()) # (batch_size, img_embedding_size)
+    autoencoder.train(was_training)
+    for key in imprint_keys:
+        np.save(_get_latent_path(save_path, key), np.concatenate(latents[key], axis=0))
+    metadata = {
+        'num_samples': num_samples,
+        'imprint_keys': imprint_keys,
+        'encoder_hash': encoder_hash,
+        'dataset_name': dataset.name,
+    }
+    # written last, so an interrupted run is not mistaken for a complete one
+    with open(os.path.join(save_path, 'metadata.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return save_path
+
+
+class LatentImprintDataset(Dataset):
+    """
+    Wraps a dataset adding the precomputed latent imprints ('init_imprint_emb', 'final_imprint_emb') to its samples.
+    Models that accept them (e.g. BubbleDynamicsModel) skip the imprint encoding. BubbleDynamicsModel keeps its loss on the
+    decoded imprints (keep_imprints=True) unless it is trained with latent_loss=True, which does not run the autoencoder.
+    The latents are computed on the first use for each autoencoder version and reused afterwards.
+    """
+    def __init__(self, dataset, autoencoder, imprint_keys=None, keep_imprints=False, batch_size=100):
+        """
+        :param dataset: wrapped dataset
+        :param autoencoder: BubbleAutoEncoderModel used to encode the imprints (the one loaded by the dynamics model)
+        :param imprint_keys: keys of the imprints to encode. Default: IMPRINT_KEYS
+        :param keep_imprints: if False, the imprints are removed from the samples, so they are not batched
+        :param batch_size: number of imprints encoded at once when the latents are computed
+        """
+        self.dataset = dataset
+        self.imprint_keys = IMPRINT_KEYS if imprint_keys is None else imprint_keys
+        self.keep_imprints = keep_imprints
+        self.encoder_hash = get_encoder_hash(autoencoder)
+        self.data_path = dataset.data_path
+        self.latents_path = get_latent_imprints_path(dataset, self.encoder_hash)
+        if not self._latents_available():
+            precompute_latent_imprints(dataset, autoencoder, save_path=self.latents_path, imprint_keys=self.imprint_keys, batch_size=batch_size)
+        self._latents = None # memory-mapped when first needed, so each worker process maps its own files
+
+    @classmethod
+    def get_name(cls):
+        return 'latent_imprint_dataset'
+
+    @property
+    def name(self):
+        return '{}_latent_imprints'.format(self.dataset.name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, item):
+        sample = self.dataset[item]
+        latents = self._get_latents()
+        for key in self.imprint_keys:
+            sample['{}_emb'.format(key)] = torch.from_numpy(np.array(latents[key][item]))
+            if not self.keep_imprints:
+                sample.pop(key, None)
+        return sample
+
+    def _latents_available(self):
+        metadata_path = os.path.join(self.latents_path, 'metadata.json')
+        if not os.path.isfile(metadata_path):
+            return False
+        with open(metadata_path, 'r') as f:
+            metadata = json.load(f)
+        return metadata['encoder_hash'] == self.encoder_hash and metadata['num_samples'] == len(self.dataset) and \
+               all(key in metadata['imprint_keys'] for key in self.imprint_keys)
+
+    def _get_latents(self):
+        if self._latents is None:
+            self._latents = {key: np.load(_get_latent_path(self.latents_path, key), mmap_mode='r') for key in self.imprint_keys}
+        return self._latents
+
+
+def _get_latent_path(save_path, key):
+    return os.path.join(save_path, '{}_emb.npy'.format(key))
@@ -0,0 +1,124 @@
+import os
+import time
+import tempfile
+import multiprocessing
+import numpy as np
+import torch
+from tqdm import tqdm
+
+_worker_dataset = None
+_worker_trs = None
+
+
+def process_dataset_parallel(dataset, num_workers=None, shard_size=50, trs=None, indxs=None):
+    """
+    Compute the processed samples (data_{i}.pt) of a dataset in parallel.
+    The sample indxs are split in shards that are processed by a pool of workers. Each worker owns a copy of the dataset
+    (and therefore its own reconstructors and object models). Samples are written atomically and each completed shard
+    is recorded, so a crashed run resumes from the last completed shards.
+    :param dataset: dataset implementing _get_sample (e.g. BubbleDrawingDataset). Create it with contribute_mode=True so it does not process all the data on init.
+    :param num_workers: number of processes. Default: number of cpus
+    :param shard_size: number of samples per shard
+    :param trs: list of transformations to apply to the samples before saving them (the ones applied by the dataset when processing)
+    :param indxs: indxs of the samples to process. Default: all samples
+    :return: number of processed samples
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    if indxs is None:
+        indxs = np.arange(len(dataset.sample_codes))
+    if trs is None:
+        trs = []
+    os.makedirs(dataset.processed_data_path, exist_ok=True)
+    shards_path = _get_shards_path(dataset)
+    os.makedirs(shards_path, exist_ok=True)
+    shards = [indxs[i:i + shard_size] for i in range(0, len(indxs), shard_size)]
+    pending_shards = [(shard_i, shard) for shard_i, shard in enumerate(shards) if not _is_shard_done(shards_path, shard_i, shard)]
+    num_pending_samples = int(np.sum([len(shard) for _, shard in pending_shards]))
+    print('Processing {} samples ({} of {} shards pending) with {} workers'.format(num_pending_samples, len(pending_shards), len(shards), num_workers))
+
+    start_time = time.time()
+    num_processed = 0
+    # fork so workers inherit the dataset without pickling it
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(processes=num_workers, initializer=_init_worker, initargs=(dataset, trs)) as pool:
+        with tqdm(total=num_pending_samples) as pbar:
+            for shard_i, num_samples_i in pool.imap_unordered(_process_shard, pending_shards):
+                num_processed += num_samples_i
+                pbar.update(num_samples_i)
+                pbar.set_postfix(samples_per_s='{:.2f}'.format(num_processed / (time.time() - start_time)))
+    elapsed_time = time.time() - start_time
+    print('Processed {} samples in {:.1f} s ({:.2f} samples/s)'.format(num_processed, elapsed_time, num_processed / max(elapsed_time, 1e-9)))
+    return num_processed
+
+
+def _init_worker(dataset, trs):
+    global _worker_dataset, _worker_trs
+    _worker_dataset = dataset
+    _worker_trs = trs
+    # make sure no state is shared with the parent process
+    if hasattr(_worker_dataset, '_reconstructors'):
+        _worker_dataset._reconstructors = {}
+    torch.set_num_threads(1)
+
+
+def _process_shard(shard_args):
+    shard_i, shard = shard_args
+    dataset = _worker_dataset
+    for indx in shard:
+        save_path_i = os.path.join(dataset.processed_data_path, 'data_{}.pt'.format(indx))
+        if os.path.isfile(save_path_i):
+            continue # already processed on a previous run (writes are atomic, so the file is complete)
+        sample_i = dataset._get_sample(dataset.sample_codes[indx])
+        for tr_i in _worker_trs:
+            sample_i = tr_i(sample_i)
+        _save_atomic(sample_i, save_path_i, tmp_dir=_get_shards_path(dataset))
+    _mark_shard_done(_get_shards_path(dataset), shard_i, shard)
+    return shard_i, len(shard)
+
+
+def _save_atomic(sample, save_path, tmp_dir):
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            torch.save(sample, f)
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _get_shards_path(dataset):
+    # Outside the processed data directory, so it only contains the processed samples
+    return '{}_shards'.format(os.path.normpath(dataset.processed_data_path))
+
+
+def _get_shard_file(shards_path, shard_i):
+    return os.path.join(shards_path, 'shard_{}.done'.format(shard_i))
+
+
+def _is_shard_done(shards_path, shard_i, shard):
+    shard_file = _get_shard_file(shards_path, shard_i)
+    if not os.path.isfile(shard_file):
+        return False
+    with open(shard_file, 'r') as f:
+        done_indxs = f.read().split()
+    # the shard is only valid if it was computed for the same indxs
+    return done_indxs == ['{}'.format(indx) for indx in shard]
+
+
+def _mark_shard_done(shards_path, shard_i, shard):
+    shard_file = _get_shard_file(shards_path, shard_i)
+    fd, tmp_path = tempfile.mkstemp(dir=shards_path, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(' '.join(['{}'.format(indx) for indx in shard]))
+    os.replace(tmp_path, shard_file)
+
+
+# DEBUG
+if __name__ == '__main__':
+    from bubble_drawing.bubble_learning.datasets.bubble_drawing_dataset import BubbleDrawingDataset
+    data_name = '/home/mmint/Desktop/drawing_data_one_direction'
+    dataset = BubbleDrawingDataset(data_name=data_name, wrench_frame='med_base', tf_frame='grasp_frame',
+                                   downsample_factor_x=7, downsample_factor_y=7, downsample_reduction='mean', contribute_mode=True)
+    process_dataset_parallel(dataset, num_workers=8, shard_size=50, trs=[dataset.block_mean_downsampling_tr])
@@ -37,7 +37,7 @@ class BubbleEnd2EndDynamicsModel(BubbleDynamicsModelBase):
     def forward(self, imprint, wrench, pos, ori, object_model, action):
         sizes = self._get_sizes()
         imprint_input_emb = self.autoencoder.encode(imprint)
-        obj_model_emb = self.object_embedding_module(object_model)  # (B, imprint_emb_size)
+        obj_model_emb = self.get_object_embedding(object_model)  # (B, imprint_emb_size)
         dyn_input = torch.cat([imprint_input_emb, wrench, pos, ori, obj_model_emb, action], dim=-1)
         dyn_output = self.dyn_model(dyn_input)
         output_sizes = [self.img_embedding_size, sizes['init_wrench'], sizes['init_object_pose']]
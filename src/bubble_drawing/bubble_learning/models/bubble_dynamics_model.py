@@ -18,8 +18,16 @@ from bubble_drawing.bubble_learning.models.bubble_dynamics_model_base import Bub
 
 class BubbleDynamicsModel(BubbleDynamicsModelBase):
 
-    def __init__(self, *args, input_batch_norm=True, **kwargs):
+    def __init__(self, *args, input_batch_norm=True, latent_loss=False, **kwargs):
+        """
+        :param input_batch_norm: if True, normalize the dynamics model input with a batch norm layer
+        :param latent_loss: (only for batches with precomputed latent imprints, see LatentImprintDataset) if True, the loss is
+            the MSE between the predicted and the precomputed next imprint embeddings, so the imprints are not decoded.
+            If False (default), the predicted embedding is decoded and compared with final_imprint as in the original
+            loss, so the dataset must keep the imprints (keep_imprints=True).
+        """
         self.input_batch_norm = input_batch_norm
+        self.latent_loss = latent_loss
         super().__init__(*args, **kwargs)
         sizes = self._get_sizes()
         self.dyn_input_batch_norm = nn.BatchNorm1d(num_features=sizes['dyn_input_size']) # call eval() to freeze the mean and std estimation
@@ -39,18 +47,35 @@ class BubbleDynamicsModel(BubbleDynamicsModelBase):
         return dyn_output_size
 
     def forward(self, imprint, wrench, pos, ori, object_model, action):
+        imprint_input_emb = self.encode(imprint) # (B, imprint_emb_size)
+        imprint_emb_next, wrench_next = self.latent_forward(imprint_input_emb, wrench, pos, ori, object_model, action)
+        imprint_next = self.decode(imprint_emb_next)
+        return imprint_next, wrench_next
+
+    def encode(self, imprint):
+        imprint_emb = self.autoencoder.encode(imprint) # (B, imprint_emb_size)
+        return imprint_emb
+
+    def decode(self, imprint_emb):
+        imprint = self.autoencoder.decode(imprint_emb)
+        return imprint
+
+    def latent_forward(self, imprint_emb, wrench, pos, ori, object_model, action):
+        """
+        Dynamics on the imprint embedding space. It allows to roll out several steps without decoding the imprints.
+        :param imprint_emb: (B, imprint_emb_size)
+        :return: imprint_emb_next (B, imprint_emb_size), wrench_next (B, wrench_size)
+        """
         sizes = self._get_sizes()
-        imprint_input_emb = self.autoencoder.encode(imprint) # (B, imprint_emb_size)
-        obj_model_emb = self.object_embedding_module(object_model) # (B, imprint_emb_size)
-        state_dyn_input = torch.cat([imprint_input_emb, wrench], dim=-1)
+        obj_model_emb = self.get_object_embedding(object_model) # (B, imprint_emb_size)
+        state_dyn_input = torch.cat([imprint_emb, wrench], dim=-1)
         dyn_input = torch.cat([state_dyn_input, pos, ori, obj_model_emb, action], dim=-1)
         if self.input_batch_norm:
             dyn_input = self.dyn_input_batch_norm(dyn_input)
         state_dyn_output_delta = self.dyn_model(dyn_input)
         state_dyn_output = state_dyn_input + state_dyn_output_delta
         imprint_emb_next, wrench_next = torch.split(state_dyn_output, (self.img_embedding_size, sizes['init_wrench']), dim=-1)
-        imprint_next = self.autoencoder.decode(imprint_emb_next)
-        return imprint_next, wrench_next
+        return imprint_emb_next, wrench_next
 
     def get_state_keys(self):
         state_keys = ['init_imprint', 'init_wrench', 'init_pos', 'init_quat',
@@ -74,6 +99,39 @@ class BubbleDynamicsModel(BubbleDynamicsModelBase):
         }
         return next_state_map
 
+    def _step(self, batch, batch_idx, phase='train'):
+        if 'init_imprint_emb' not in batch:
+            return super()._step(batch, batch_idx, phase=phase)
+        # Precomputed latent imprints (see LatentImprintDataset): the imprints are not encoded
+        imprint_emb_next, wrench_next = self.latent_forward(batch['init_imprint_emb'], batch['init_wrench'], batch['init_pos'],
+                                                            batch['init_quat'], batch['object_model'], batch['action'])
+        model_output = None
+        if self.latent_loss:
+            # loss on the imprint embedding space, so the autoencoder is not run
+            loss = self._compute_latent_loss(imprint_emb_next, wrench_next, batch['final_imprint_emb'], batch['final_wrench'])
+        else:
+            if 'final_imprint' not in batch:
+                raise ValueError('The loss is computed on the decoded imprints but the batch has no final_imprint. '
+                                 'Keep the imprints on the LatentImprintDataset (keep_imprints=True) or set latent_loss=True')
+            model_output = (self.decode(imprint_emb_next), wrench_next)
+            loss = self._compute_loss(*model_output, *self.get_model_output(batch))
+
+        # Log the results: -------------------------
+        self.log('{}_batch'.format(phase), batch_idx)
+        self.log('{}_loss'.format(phase), loss)
+        if batch_idx == 0 and 'init_imprint' in batch and 'final_imprint' in batch:
+            if model_output is None:
+                # only decode the logged imprints
+                model_output = (self.decode(imprint_emb_next[:self.num_imprints_to_log]), wrench_next)
+            self._log_imprints(batch=batch, model_output=model_output, batch_idx=batch_idx, phase=phase)
+        return loss
+
+    def _compute_latent_loss(self, imprint_emb_rec, wrench_rec, imprint_emb_gth, wrench_gth):
+        imprint_emb_reconstruction_loss = self.mse_loss(imprint_emb_rec, imprint_emb_gth)
+        wrench_reconstruction_loss = self.mse_loss(wrench_rec, wrench_gth)
+        loss = imprint_emb_reconstruction_loss + 0.000001 * wrench_reconstruction_loss
+        return loss
+
     def _compute_loss(self, imprint_rec, wrench_rec, imprint_gth, wrench_gth):
         imprint_reconstruction_loss = self.mse_loss(imprint_rec, imprint_gth)
         wrench_reconstruction_loss = self.mse_loss(wrench_rec, wrench_gth)
@@ -9,6 +9,9 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 import torchvision
 import abc
+import hashlib
+import weakref
+from collections import OrderedDict
 
 from bubble_drawing.bubble_learning.models.aux.fc_module import FCModule
 from bubble_drawing.bubble_learning.models.aux.img_encoder import ImageEncoder
@@ -22,7 +25,7 @@ from bubble_drawing.bubble_learning.models.pointnet.pointnet_object_embedding im
 class DynamicsModelBase(pl.LightningModule):
     def __init__(self, input_sizes, object_embedding_size=10, num_fcs=2, fc_h_dim=100,
                  skip_layers=None, lr=1e-4, dataset_params=None, load_norm=False, activation='relu',
-                 freeze_object_module=True):
+                 freeze_object_module=True, object_embedding_cache_size=100, eval_frozen_object_module=False):
         super().__init__()
         self.input_sizes = input_sizes
         self.object_embedding_size = object_embedding_size
@@ -34,9 +37,14 @@ class DynamicsModelBase(pl.LightningModule):
         self.activation = activation
         self.load_norm = load_norm
         self.freeze_object_module = freeze_object_module
+        self.object_embedding_cache_size = object_embedding_cache_size
+        self.eval_frozen_object_module = eval_frozen_object_module # keep the frozen pointnet in eval mode while training, so its features are also cached when training
 
         self.object_embedding_module = self._load_object_embedding_module(
-            object_embedding_size=self.object_embedding_size, freeze=self.freeze_object_module)
+            object_embedding_size=self.object_embedding_size, freeze=self.freeze_object_module,
+            eval_frozen=self.eval_frozen_object_module)
+        self.object_features_cache = OrderedDict() # Key: object model point cloud hash. Value: (256,) pointnet features
+        self.object_model_keys = OrderedDict() # Key: object model tensor (see _get_object_model_tensor_key). Value: (tensor weakref, point cloud hashes of its different object models, inverse indxs)
 
         self.mse_loss = nn.MSELoss()
 
@@ -101,6 +109,105 @@ class DynamicsModelBase(pl.LightningModule):
         optimizer = torch.optim.Adam(self.parameters(), lr=self.lr)
         return optimizer
 
+    def train(self, mode=True):
+        super().train(mode)
+        if mode and self.object_embedding_module.pointnet_classifier.training:
+            # the pointnet weights or batch norm statistics are going to change
+            self.clear_object_embedding_cache()
+        return self
+
+    def get_object_embedding(self, object_model):
+        """
+        Embed the object models.
+        When the pointnet is in eval mode (the model is in eval mode, or eval_frozen_object_module), the pointnet features
+        of each object model are computed once and cached (key: point cloud hash), so known tools skip the pointnet pass.
+        The point cloud hashes of each object model tensor are also kept, so passing the same tensor again (e.g. the
+        broadcasted object model of the MPPI rollouts) does not read its values.
+        :param object_model: (..., N, 3) object model point clouds
+        :return: (..., object_embedding_size) object embeddings
+        """
+        if self.object_embedding_cache_size <= 0 or self.object_embedding_module.pointnet_classifier.training:
+            return self.object_embedding_module(object_model)
+        batch_shape = object_model.shape[:-2]
+        object_model = object_model.reshape(-1, *object_model.shape[-2:]) # (B, N, 3)
+        features = self._get_object_features(object_model) # (B, num_features)
+        obj_model_emb = self.object_embedding_module.embedding_fc(features) # (B, object_embedding_size)
+        return obj_model_emb.reshape(*batch_shape, -1)
+
+    def clear_object_embedding_cache(self):
+        self.object_features_cache = OrderedDict()
+        self.object_model_keys = OrderedDict()
+
+    def _get_object_features(self, object_model):
+        # object_model: (B, N, 3) object models -> (B, num_features) pointnet features
+        keys, inverse_indxs = self._get_object_model_keys(object_model)
+        if any(key_i not in self.object_features_cache for key_i in keys):
+            # new object models
+            unique_object_models = object_model[:1] if inverse_indxs is None else object_model[self._get_first_indxs(inverse_indxs, len(keys))]
+            missing_indxs = [i for i, key_i in enumerate(keys) if key_i not in self.object_features_cache]
+            with torch.no_grad():
+                missing_features = self.object_embedding_module.get_features(unique_object_models[missing_indxs])
+            for i, features_i in zip(missing_indxs, missing_features):
+                self.object_features_cache[keys[i]] = features_i
+        features = []
+        for key_i in keys:
+            self.object_features_cache.move_to_end(key_i) # least recently used first
+            features.append(self.object_features_cache[key_i].to(device=object_model.device, dtype=object_model.dtype))
+        while len(self.object_features_cache) > max(self.object_embedding_cache_size, len(keys)):
+            self.object_features_cache.popitem(last=False)
+        features = torch.stack(features, dim=0) # (M, num_features)
+        if inverse_indxs is None:
+            # all samples share the object model
+            return features.expand(object_model.shape[0], -1)
+        return features[inverse_indxs]
+
+    def _get_object_model_keys(self, object_model):
+        """
+        Point cloud hashes of the different object models of the batch. They are computed once per object model tensor.
+        :param object_model: (B, N, 3) object models
+        :return: keys (list of M point cloud hashes), inverse_indxs (B,) index of each sample on keys. None if all the samples share the object model
+        """
+        tensor_key = self._get_object_model_tensor_key(object_model)
+        if tensor_key is not None and tensor_key in self.object_model_keys:
+            tensor_ref, keys, inverse_indxs = self.object_model_keys[tensor_key]
+            if tensor_ref() is not None:
+                # the tensor memory has not been released and its version did not change, so neither did its values
+                self.object_model_keys.move_to_end(tensor_key)
+                return keys, inverse_indxs
+        if object_model.shape[0] == 1 or object_model.stride(0) == 0 or torch.all(object_model == object_model[:1]):
+            # all samples share the object model (stride 0: broadcasted)
+            unique_object_models, inverse_indxs = object_model[:1], None
+        else:
+            unique_object_models, inverse_indxs = torch.unique(object_model, dim=0, return_inverse=True)
+        keys = [self._get_object_model_key(object_model_i) for object_model_i in unique_object_models]
+        if tensor_key is None:
+            return keys, inverse_indxs
+        base_tensor = object_model if object_model._base is None else object_model._base # owner of the memory (views, e.g. reshapes, are temporary)
+        self.object_model_keys[tensor_key] = (weakref.ref(base_tensor), keys, inverse_indxs)
+        while len(self.object_model_keys) > self.object_embedding_cache_size:
+            self.object_model_keys.popitem(last=False)
+        return keys, inverse_indxs
+
+    def _get_object_model_tensor_key(self, object_model):
+        # identifies the tensor memory and its values without reading them. The version counter changes with in-place
+        # torch operations (values modified outside torch, e.g. through a shared numpy array, are not detected).
+        # None for inference tensors, which have no version counter.
+        if object_model.is_inference():
+            return None
+        return (object_model.data_ptr(), object_model._version, tuple(object_model.shape), object_model.stride(),
+                object_model.dtype, object_model.device)
+
+    def _get_first_indxs(self, inverse_indxs, num_unique):
+        # index of the first sample of each different object model
+        sample_indxs = torch.arange(inverse_indxs.shape[0], device=inverse_indxs.device)
+        first_indxs = torch.full((num_unique,), inverse_indxs.shape[0], dtype=torch.long, device=inverse_indxs.device)
+        return first_indxs.scatter_reduce(0, inverse_indxs, sample_indxs, reduce='amin')
+
+    def _get_object_model_key(self, object_model):
+        object_model_ar = object_model.detach().cpu().numpy()
+        key = hashlib.sha1(object_model_ar.tobytes()).hexdigest() + str(object_model_ar.shape) + str(object_model_ar.dtype)
+        return key
+
     def get_model_input(self, sample):
         input_key = self.get_input_keys()
         model_input = [sample[key] for key in input_key]
@@ -140,8 +247,9 @@ class DynamicsModelBase(pl.LightningModule):
 
     # Loading Functionalities: -----------------------------------------------------------------------------------------
 
-    def _load_object_embedding_module(self, object_embedding_size, freeze=True):
-        pointnet_model = PointNetObjectEmbedding(obj_embedding_size=object_embedding_size, freeze_pointnet=freeze)
+    def _load_object_embedding_module(self, object_embedding_size, freeze=True, eval_frozen=False):
+        pointnet_model = PointNetObjectEmbedding(obj_embedding_size=object_embedding_size, freeze_pointnet=freeze,
+                                                 eval_frozen_pointnet=eval_frozen)
         # Expected input shape (BatchSize, NumPoints, NumChannels), where NumChannels=3 (xyz)
         return pointnet_model
 
@@ -66,7 +66,7 @@ class ObjectPoseDynamicsModel(DynamicsModelBase):
         # obj_pos_size = sizes['object_position']
         # obj_quat_size = sizes['object_orientation']
         # obj_pose_size = obj_pos_size + obj_quat_size
-        obj_model_emb = self.object_embedding_module(object_model)  # (B, imprint_emb_size)
+        obj_model_emb = self.get_object_embedding(object_model)  # (B, imprint_emb_size)
         dyn_input = torch.cat([obj_pose, pos, ori, obj_model_emb, action], dim=-1)
         if self.input_batch_norm:
             dyn_input = self.dyn_input_batch_norm(dyn_input)
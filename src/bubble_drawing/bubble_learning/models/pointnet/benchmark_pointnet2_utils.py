@@ -0,0 +1,78 @@
+import time
+import torch
+
+from bubble_drawing.bubble_learning.models.pointnet.pointnet2_utils import farthest_point_sample, query_ball_point, square_distance
+
+
+def reference_farthest_point_sample(xyz, npoint):
+    # original implementation (one masked update per sampled point)
+    device = xyz.device
+    B, N, C = xyz.shape
+    centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
+    distance = torch.ones(B, N).to(device) * 1e10
+    farthest = torch.randint(0, N, (B,), dtype=torch.long).to(device)
+    batch_indices = torch.arange(B, dtype=torch.long).to(device)
+    for i in range(npoint):
+        centroids[:, i] = farthest
+        centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
+        dist = torch.sum((xyz - centroid) ** 2, -1)
+        mask = dist < distance
+        distance[mask] = dist[mask]
+        farthest = torch.max(distance, -1)[1]
+    return centroids
+
+
+def reference_query_ball_point(radius, nsample, xyz, new_xyz):
+    # original implementation (full sort of the (B, S, N) indexes)
+    device = xyz.device
+    B, N, C = xyz.shape
+    _, S, _ = new_xyz.shape
+    group_idx = torch.arange(N, dtype=torch.long).to(device).view(1, 1, N).repeat([B, S, 1])
+    sqrdists = square_distance(new_xyz, xyz)
+    group_idx[sqrdists > radius ** 2] = N
+    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
+    group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
+    mask = group_idx == N
+    group_idx[mask] = group_first[mask]
+    return group_idx
+
+
+def time_function(function, *args, num_repetitions=5, seed=0):
+    # mean time per call (s). The seed is reset before each call, so all calls return the same result
+    torch.manual_seed(seed)
+    out = function(*args)  # warm up
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for i in range(num_repetitions):
+        torch.manual_seed(seed)
+        out = function(*args)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / num_repetitions, out
+
+
+if __name__ == '__main__':
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    # (B, N, npoint) typical of the set abstraction layers (sa1: N=1024 -> 512, sa2: 512 -> 128)
+    fps_configs = [(1, 1024, 512), (8, 1024, 512), (32, 1024, 512), (8, 512, 128), (32, 512, 128), (4, 4096, 1024)]
+    # (B, N, S, radius, nsample) of PointNet2 MSG sa1 and sa2 on unit scaled clouds
+    ball_query_configs = [(8, 1024, 512, 0.1, 16), (8, 1024, 512, 0.2, 32), (8, 1024, 512, 0.4, 128),
+                          (32, 1024, 512, 0.4, 128), (32, 512, 128, 0.8, 128)]
+
+    print('farthest_point_sample on {}'.format(device))
+    print('{:>4} {:>6} {:>7} {:>14} {:>14} {:>10} {:>10}'.format('B', 'N', 'npoint', 'reference (s)', 'new (s)', 'speedup', 'identical'))
+    for B, N, npoint in fps_configs:
+        xyz = torch.rand(B, N, 3, device=device)
+        ref_time, ref_idxs = time_function(reference_farthest_point_sample, xyz, npoint)
+        new_time, new_idxs = time_function(farthest_point_sample, xyz, npoint)
+        print('{:>4} {:>6} {:>7} {:>14.4f} {:>14.4f} {:>10.2f} {:>10}'.format(B, N, npoint, ref_time, new_time, ref_time / new_time, str(torch.equal(ref_idxs, new_idxs))))
+
+    print('\nquery_ball_point on {}'.format(device))
+    print('{:>4} {:>6} {:>5} {:>7} {:>8} {:>14} {:>14} {:>10} {:>10}'.format('B', 'N', 'S', 'radius', 'nsample', 'reference (s)', 'new (s)', 'speedup', 'identical'))
+    for B, N, S, radius, nsample in ball_query_configs:
+        xyz = torch.rand(B, N, 3, device=device)
+        new_xyz = xyz[:, torch.randperm(N, device=device)[:S]]
+        ref_time, ref_idxs = time_function(reference_query_ball_point, radius, nsample, xyz, new_xyz)
+        new_time, new_idxs = time_function(query_ball_point, radius, nsample, xyz, new_xyz)
+        print('{:>4} {:>6} {:>5} {:>7} {:>8} {:>14.4f} {:>14.4f} {:>10.2f} {:>10}'.format(B, N, S, radius, nsample, ref_time, new_time, ref_time / new_time, str(torch.equal(ref_idxs, new_idxs))))
@@ -69,6 +69,9 @@ def farthest_point_sample(xyz, npoint):
     Return:
         centroids: sampled pointcloud index, [B, npoint]
     """
+    # Each sample depends on the distances to the previous one, so there is one iteration per sampled point. Each
+    # iteration updates the distances of all the points and batches with a single vectorised minimum (no masked copies).
+    # The distances are computed as in the reference implementation, so the results are the same for the same seed.
     device = xyz.device
     B, N, C = xyz.shape
     centroids = torch.zeros(B, npoint, dtype=torch.long).to(device)
@@ -77,34 +80,35 @@ def farthest_point_sample(xyz, npoint):
     batch_indices = torch.arange(B, dtype=torch.long).to(device)
     for i in range(npoint):
         centroids[:, i] = farthest
-        centroid = xyz[batch_indices, farthest, :].view(B, 1, 3)
+        centroid = xyz[batch_indices, farthest, :].view(B, 1, C)
         dist = torch.sum((xyz - centroid) ** 2, -1)
-        mask = dist < distance
-        distance[mask] = dist[mask]
+        torch.minimum(distance, dist, out=distance)
         farthest = torch.max(distance, -1)[1]
     return centroids
 
 
-def query_ball_point(radius, nsample, xyz, new_xyz):
+def query_ball_point(radius, nsample, xyz, new_xyz, sqrdists=None):
     """
     Input:
         radius: local region radius
         nsample: max sample number in local region
         xyz: all points, [B, N, 3]
         new_xyz: query points, [B, S, 3]
+        sqrdists: (optional) square_distance(new_xyz, xyz), [B, S, N]. Provide it to share it between several radius
     Return:
         group_idx: grouped points index, [B, S, nsample]
     """
     device = xyz.device
     B, N, C = xyz.shape
     _, S, _ = new_xyz.shape
-    group_idx = torch.arange(N, dtype=torch.long).to(device).view(1, 1, N).repeat([B, S, 1])
-    sqrdists = square_distance(new_xyz, xyz)
-    group_idx[sqrdists > radius ** 2] = N
-    group_idx = group_idx.sort(dim=-1)[0][:, :, :nsample]
-    group_first = group_idx[:, :, 0].view(B, S, 1).repeat([1, 1, nsample])
-    mask = group_idx == N
-    group_idx[mask] = group_first[mask]
+    if sqrdists is None:
+        sqrdists = square_distance(new_xyz, xyz)
+    group_idx = torch.arange(N, dtype=torch.long, device=device).view(1, 1, N).expand(B, S, N)
+    group_idx = torch.where(sqrdists > radius ** 2, N, group_idx)
+    # the nsample smallest indexes inside the ball (partial selection instead of sorting all the N indexes)
+    group_idx = torch.topk(group_idx, min(nsample, N), dim=-1, largest=False, sorted=True)[0]
+    group_first = group_idx[:, :, :1].expand(-1, -1, group_idx.shape[-1])
+    group_idx = torch.where(group_idx == N, group_first, group_idx)
     return group_idx
 
 
@@ -238,10 +242,11 @@ class PointNetSetAbstractionMsg(nn.Module):
         B, N, C = xyz.shape
         S = self.npoint
         new_xyz = index_points(xyz, farthest_point_sample(xyz, S))
+        sqrdists = square_distance(new_xyz, xyz) # shared by all the radius
         new_points_list = []
         for i, radius in enumerate(self.radius_list):
             K = self.nsample_list[i]
-            group_idx = query_ball_point(radius, K, xyz, new_xyz)
+            group_idx = query_ball_point(radius, K, xyz, new_xyz, sqrdists=sqrdists)
             grouped_xyz = index_points(xyz, group_idx)
             grouped_xyz -= new_xyz.view(B, S, 1, C)
             if points is not None:
@@ -6,20 +6,38 @@ from bubble_drawing.bubble_learning.models.pointnet.pointnet_loading_utils impor
 
 
 class PointNetObjectEmbedding(nn.Module):
-    def __init__(self, obj_embedding_size, freeze_pointnet=True):
+    def __init__(self, obj_embedding_size, freeze_pointnet=True, eval_frozen_pointnet=False):
+        """
+        :param freeze_pointnet: if True, the pointnet weights are not trained
+        :param eval_frozen_pointnet: if True (and freeze_pointnet), the pointnet is kept in eval mode also when the module
+            trains (no dropout and fixed batch norm statistics), so its features only depend on the input
+        """
         super().__init__()
         self.obj_embedding_size = obj_embedding_size
+        self.freeze_pointnet = freeze_pointnet
+        self.eval_frozen_pointnet = eval_frozen_pointnet
         self.pointnet_classifier = get_pretrained_pointnet_classifier(freeze=freeze_pointnet)
         self.embedding_fc = nn.Linear(256, self.obj_embedding_size)
 
     def forward(self, x):
+        x = self.get_features(x)
+        out = self.embedding_fc(x)  # Returns a B x obj_embedding_size
+        return out
+
+    def get_features(self, x):
+        # pointnet features before the embedding layer. (B, N, K) -> (B, 256)
         x = x.transpose(-2, -1)  # reshape to (B, K, N)
         x, _, _ = self.pointnet_classifier.base(x)
         # apply cassifier except last linear layer and dropout:
         for i, layer_i in enumerate(self.pointnet_classifier.classifier[:-2]):
             x = layer_i(x)
-        out = self.embedding_fc(x)  # Returns a B x 40
-        return out
+        return x
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.freeze_pointnet and self.eval_frozen_pointnet:
+            self.pointnet_classifier.eval()
+        return self
 
 
 # Debug:
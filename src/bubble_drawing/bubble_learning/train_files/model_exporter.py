@@ -0,0 +1,27 @@
+import argparse
+import torch
+
+from bubble_drawing.bubble_learning.models.bubble_dynamics_model import BubbleDynamicsModel
+from bubble_drawing.bubble_learning.models.bubble_linear_dynamics_model import BubbleLinearDynamicsModel
+from bubble_drawing.bubble_learning.models.object_pose_dynamics_model import ObjectPoseDynamicsModel
+from bubble_drawing.bubble_learning.models.icp_approximation_model import ICPApproximationModel
+from bubble_drawing.bubble_learning.aux.load_model import export_model_version
+
+
+if __name__ == '__main__':
+    # Export a trained model version as a traced inference artifact. load_model_version(..., prefer_exported=True) loads it instead of the checkpoint.
+    models = [BubbleDynamicsModel, BubbleLinearDynamicsModel, ObjectPoseDynamicsModel, ICPApproximationModel]
+    model_names = [m.get_name() for m in models]
+    parser = argparse.ArgumentParser('model_exporter')
+    parser.add_argument('model_name', type=str, help='model to export. (Possible options: {})'.format(model_names))
+    parser.add_argument('data_name', type=str, help='path to the data the model was trained on (containing tb_logs)')
+    parser.add_argument('--load_version', type=int, default=0, help='model version to export')
+    parser.add_argument('--no_gpu', action='store_true', help='export the model on the cpu even when a gpu is available')
+    args = parser.parse_args()
+
+    if args.model_name not in model_names:
+        raise AttributeError('Model name {} not supported. We support: {}'.format(args.model_name, model_names))
+    Model = models[model_names.index(args.model_name)]
+    device = torch.device('cuda' if torch.cuda.is_available() and not args.no_gpu else 'cpu')
+    exported_path = export_model_version(Model, args.data_name, args.load_version, device=device)
+    print('Model {} version {} exported to {}'.format(args.model_name, args.load_version, exported_path))
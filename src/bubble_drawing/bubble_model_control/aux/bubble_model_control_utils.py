@@ -5,33 +5,62 @@ import copy
 import tf.transformations as tr
 import pytorch3d.transforms as batched_trs
 
+from bubble_drawing.bubble_model_control.aux.frame_graph import FrameGraph, rigid_tr_inverse
+
 
 def convert_all_tfs_to_tensors(all_tfs):
     """
     Convert a DataFrame object containing the tfs with respect a common frame into a dictionary of tensor transformation matrices
     :param all_tfs: DataFrame
-    :return:
+    :return: dict frame_name -> (4, 4) homogeneous transformation
     """
+    converted_all_tfs = _convert_all_tfs_to_tensors(all_tfs)
+    return converted_all_tfs
+
+
+def _convert_all_tfs_to_tensors(all_tfs):
     # Transform a DF into a dictionary of homogeneous transformations matrices (4x4)
-    converted_all_tfs = {}
     parent_frame = all_tfs['parent_frame'][0] # Assume that are all teh same
-    child_frames = all_tfs['child_frame']
-    converted_all_tfs[parent_frame] = np.eye(4) # Transformation to itself is the identity
-    all_poses = all_tfs[['x', 'y', 'z', 'qx', 'qy', 'qz', 'qw']]
+    child_frames = list(all_tfs['child_frame'])
+    all_poses = all_tfs[['x', 'y', 'z', 'qx', 'qy', 'qz', 'qw']].values.astype(np.float64)  # (n_frames, 7)
+    Xs = np.zeros((len(child_frames) + 1, 4, 4))
+    Xs[0] = np.eye(4) # Transformation to itself is the identity
+    Xs[1:, :3, :3] = _quaternions_to_matrices(all_poses[:, 3:])
+    Xs[1:, :3, 3] = all_poses[:, :3]
+    Xs[1:, 3, 3] = 1.
+    converted_all_tfs = {parent_frame: Xs[0]}
     for i, child_frame_i in enumerate(child_frames):
-        pose_i = all_poses.iloc[i]
-        X_i = tr.quaternion_matrix(pose_i[3:])
-        X_i[:3, 3] = pose_i[:3]
-        converted_all_tfs[child_frame_i] = X_i
+        converted_all_tfs[child_frame_i] = Xs[i + 1]
     return converted_all_tfs
 
 
+def _quaternions_to_matrices(quats):
+    """
+    Vectorized version of tf.transformations.quaternion_matrix
+    :param quats: (N, 4) array of quaternions (qx, qy, qz, qw). They do not need to be normalized
+    :return: (N, 3, 3) array of rotation matrices
+    """
+    norms_sq = np.sum(quats * quats, axis=-1)
+    valid = norms_sq >= np.finfo(float).eps * 4.0 # tf.transformations returns the identity for zero quaternions
+    q = quats * np.sqrt(2.0 / np.where(valid, norms_sq, 1.))[:, None]
+    q = np.where(valid[:, None], q, 0.)
+    qx, qy, qz, qw = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    Rs = np.stack([
+        1.0 - qy * qy - qz * qz, qx * qy - qz * qw, qx * qz + qy * qw,
+        qx * qy + qz * qw, 1.0 - qx * qx - qz * qz, qy * qz - qx * qw,
+        qx * qz - qy * qw, qy * qz + qx * qw, 1.0 - qx * qx - qy * qy,
+    ], axis=-1).reshape(-1, 3, 3)
+    return Rs
+
+
 def tr_frame(all_tfs, frame_name, X, fixed_frame_names):
     # Apply tf to the frame_name and modify all other tf for the fixed frames to that tf frame
     # all_tfs: dict of tfs
     # frame_name: str for the frame to apply X
     # X (aka fn_X_fn_new) trasformation to be applied along frame_name
     # fixed_frame_names: list of strs containing the names of the frames that we also need to transform because they are rigid to the frame_name frame.
+    if isinstance(all_tfs, FrameGraph):
+        return all_tfs.tr_frame(frame_name, X, fixed_frame_names) # single batched op, returns a new FrameGraph
     new_tfs = {}
     w_X_fn = all_tfs[frame_name]
     w_X_fn_new = w_X_fn @ X
@@ -49,41 +78,52 @@ def tr_frame(all_tfs, frame_name, X, fixed_frame_names):
 
 
 def get_transformation_matrix(all_tfs, source_frame, target_frame):
+    if isinstance(all_tfs, FrameGraph):
+        return all_tfs.get_transformation_matrix(source_frame, target_frame)
     w_X_sf = all_tfs[source_frame]
     w_X_tf = all_tfs[target_frame]
-    sf_X_w = torch.linalg.inv(w_X_sf)
+    sf_X_w = rigid_tr_inverse(w_X_sf) # tfs are rigid, no need for a general inverse
     sf_X_tf = sf_X_w @ w_X_tf
     return sf_X_tf
 
 
-def batched_tensor_sample(sample, batch_size=None, device=None):
+def batched_tensor_sample(sample, batch_size=None, device=None, broadcast=False):
     # sample is a dictionary of
+    # broadcast: if True, the values are expanded to the batch_size instead of repeated (no memory copy). Use it only if the batched values are not modified in place.
     if device is None:
         device = torch.device('cpu')
     batched_sample = {}
     for k_i, v_i in sample.items():
         if type(v_i) is dict:
-            batched_sample_i = batched_tensor_sample(v_i, batch_size=batch_size, device=device)
+            batched_sample_i = batched_tensor_sample(v_i, batch_size=batch_size, device=device, broadcast=broadcast)
             batched_sample[k_i] = batched_sample_i
         elif type(v_i) is np.ndarray:
             batched_sample_i = torch.tensor(v_i).to(device)
             if batch_size is not None:
-                batched_sample_i = batched_sample_i.unsqueeze(0).repeat_interleave(batch_size, dim=0)
+                batched_sample_i = _batch_tensor(batched_sample_i, batch_size, broadcast=broadcast)
             batched_sample[k_i] = batched_sample_i
         elif type(v_i) in [int, float]:
             batched_sample_i = torch.tensor([v_i]).to(device)
             if batch_size is not None:
-                batched_sample_i = batched_sample_i.unsqueeze(0).repeat_interleave(batch_size, dim=0)
+                batched_sample_i = _batch_tensor(batched_sample_i, batch_size, broadcast=broadcast)
             batched_sample[k_i] = batched_sample_i
         elif type(v_i) is torch.Tensor:
             batched_sample_i = v_i.to(device)
             if batch_size is not None:
-                batched_sample_i = batched_sample_i.unsqueeze(0).repeat_interleave(batch_size, dim=0)
+                batched_sample_i = _batch_tensor(batched_sample_i, batch_size, broadcast=broadcast)
             batched_sample[k_i] = batched_sample_i.to(device)
         else:
             batched_sample[k_i] = v_i
     return batched_sample
 
+
+def _batch_tensor(tensor, batch_size, broadcast=False):
+    if broadcast:
+        batched_tensor = tensor.unsqueeze(0).expand(batch_size, *tensor.shape)
+    else:
+        batched_tensor = tensor.unsqueeze(0).repeat_interleave(batch_size, dim=0)
+    return batched_tensor
+
 def batched_matrix_to_euler_corrected(batched_matrix):
     # Transform a batched matrix into euler angles with 'sxyz' convention
     euler_unordered = batched_trs.matrix_to_euler_angles(batched_matrix, 'ZYX')
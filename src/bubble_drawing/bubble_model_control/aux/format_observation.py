@@ -1,8 +1,11 @@
 import numpy as np
 from bubble_utils.bubble_tools.bubble_img_tools import process_bubble_img
 from bubble_drawing.bubble_learning.aux.orientation_trs import QuaternionToAxis
+from bubble_drawing.bubble_learning.aux.reference_frame_store import compress_reference_frame
 
-def format_observation_sample(obs_sample):
+def format_observation_sample(obs_sample, reference_store=None):
+    # reference_store: ReferenceFrameStore. If provided, the reference depths and camera infos are replaced by a ReferenceFrame
+    # (key 'reference_frame') so the reference is only stored (and converted to tensors) once while it does not change.
     formatted_obs_sample = {}
     # add imprints: -------
     init_imprint_r = obs_sample['bubble_depth_img_right_reference'] - obs_sample['bubble_depth_img_right']
@@ -31,6 +34,8 @@ def format_observation_sample(obs_sample):
     }
     for k_old, k_new in key_map.items():
         formatted_obs_sample[k_new] = obs_sample[k_old]
-    
+    if reference_store is not None:
+        formatted_obs_sample = compress_reference_frame(formatted_obs_sample, reference_store)
+
     # apply the key_map
     return formatted_obs_sample
\ No newline at end of file
@@ -0,0 +1,149 @@
+import torch
+import numpy as np
+
+
+def rigid_tr_inverse(X):
+    """
+    Closed-form inverse of rigid homogeneous transformations: [R, t]^-1 = [R^T, -R^T t]
+    :param X: (..., 4, 4) tensor
+    :return: (..., 4, 4) tensor
+    """
+    R_inv = X[..., :3, :3].transpose(-1, -2)
+    t_inv = -torch.einsum('...ij,...j->...i', R_inv, X[..., :3, 3])
+    X_inv = torch.zeros_like(X)
+    X_inv[..., :3, :3] = R_inv
+    X_inv[..., :3, 3] = t_inv
+    X_inv[..., 3, 3] = 1.
+    return X_inv
+
+
+class FrameGraph(object):
+    """
+    Batched transformations from a common (world) frame to a set of named frames.
+    All frames are stored in a single (K, n_frames, 4, 4) tensor, so moving a frame together with its rigidly attached
+    frames is a single batched operation.
+    It behaves as the all_tfs dict (frame_name -> (K, 4, 4) tensor) for reading. It is immutable: tr_frame returns a
+    new FrameGraph, so copies are free.
+    """
+    def __init__(self, tfs, frame_names, rigid_groups=None):
+        """
+        :param tfs: (K, n_frames, 4, 4) tensor
+        :param frame_names: list of the n_frames names
+        :param rigid_groups: dict frame_name -> list of frame names rigidly attached to it
+        """
+        self.tfs = tfs
+        self.frame_names = list(frame_names)
+        self.frame_indxs = {fn: i for i, fn in enumerate(self.frame_names)}
+        if rigid_groups is None:
+            rigid_groups = {}
+        self.rigid_groups = rigid_groups
+        self._group_indxs = {} # index tensors of the moved frames. Key: (frame_name, fixed_frame_names)
+
+    @classmethod
+    def from_dict(cls, all_tfs, rigid_groups=None, device=None, dtype=None):
+        """
+        :param all_tfs: dict frame_name -> (4, 4) or (K, 4, 4) array/tensor
+        :return: FrameGraph
+        """
+        frame_names = list(all_tfs.keys())
+        tfs = [torch.as_tensor(np.asarray(v) if not torch.is_tensor(v) else v) for v in all_tfs.values()]
+        if dtype is None:
+            dtype = tfs[0].dtype
+        if device is None:
+            device = tfs[0].device
+        tfs = [tf_i.to(device=device, dtype=dtype) for tf_i in tfs]
+        batch_size = max([tf_i.shape[0] if tf_i.ndim == 3 else 1 for tf_i in tfs])
+        tfs = torch.stack([tf_i.expand(batch_size, 4, 4) for tf_i in tfs], dim=1) # (K, n_frames, 4, 4)
+        return cls(tfs, frame_names, rigid_groups=rigid_groups)
+
+    def to_dict(self):
+        return {fn: self[fn] for fn in self.frame_names}
+
+    @property
+    def batch_size(self):
+        return self.tfs.shape[0]
+
+    @property
+    def dtype(self):
+        return self.tfs.dtype
+
+    @property
+    def device(self):
+        return self.tfs.device
+
+    def expand(self, batch_size):
+        """
+        Broadcast a graph with batch size 1 to batch_size (no memory copy)
+        """
+        return self._new(self.tfs.expand(batch_size, *self.tfs.shape[1:]))
+
+    def to(self, device):
+        return self._new(self.tfs.to(device))
+
+    def copy(self):
+        return self._new(self.tfs)
+
+    def keys(self):
+        return list(self.frame_names)
+
+    def values(self):
+        return [self[fn] for fn in self.frame_names]
+
+    def items(self):
+        return [(fn, self[fn]) for fn in self.frame_names]
+
+    def __getitem__(self, frame_name):
+        # (K, 4, 4) view
+        return self.tfs[:, self.frame_indxs[frame_name]]
+
+    def __contains__(self, frame_name):
+        return frame_name in self.frame_indxs
+
+    def __iter__(self):
+        return iter(self.frame_names)
+
+    def __len__(self):
+        return len(self.frame_names)
+
+    def get_transformation_matrix(self, source_frame, target_frame):
+        """
+        :return: sf_X_tf (K, 4, 4) tensor
+        """
+        w_X_sf = self[source_frame]
+        w_X_tf = self[target_frame]
+        sf_X_tf = rigid_tr_inverse(w_X_sf) @ w_X_tf
+        return sf_X_tf
+
+    def tr_frame(self, frame_name, X, fixed_frame_names=None):
+        """
+        Apply X (aka fn_X_fn_new) to the frame_name frame and move the frames rigidly attached to it accordingly.
+        :param frame_name: name of the frame to move
+        :param X: (K, 4, 4) tensor
+        :param fixed_frame_names: frames rigid to frame_name. Default: the rigid group of frame_name
+        :return: new FrameGraph
+        """
+        if fixed_frame_names is None:
+            fixed_frame_names = self.rigid_groups.get(frame_name, [])
+        indxs = self._get_group_indxs(frame_name, fixed_frame_names)
+        w_X_fn = self[frame_name]
+        # w_X_ff_new = w_X_fn_new @ fn_X_ff = (w_X_fn @ X @ fn_X_w) @ w_X_ff for the frame and all its fixed frames
+        w_X_w_new = w_X_fn @ X.type(self.dtype) @ rigid_tr_inverse(w_X_fn)  # (K, 4, 4)
+        moved_tfs = w_X_w_new.unsqueeze(1) @ self.tfs[:, indxs]  # (K, n_moved, 4, 4)
+        new_tfs = self.tfs.index_copy(1, indxs, moved_tfs)
+        return self._new(new_tfs)
+
+    def _get_group_indxs(self, frame_name, fixed_frame_names):
+        group_key = (frame_name, tuple(fixed_frame_names))
+        if group_key not in self._group_indxs:
+            moved_frames = [frame_name] + [ff_i for ff_i in fixed_frame_names if ff_i != frame_name]
+            self._group_indxs[group_key] = torch.tensor([self.frame_indxs[fn] for fn in moved_frames], dtype=torch.long, device=self.device)
+        return self._group_indxs[group_key]
+
+    def _new(self, tfs):
+        new_graph = FrameGraph.__new__(FrameGraph)
+        new_graph.tfs = tfs
+        new_graph.frame_names = self.frame_names
+        new_graph.frame_indxs = self.frame_indxs
+        new_graph.rigid_groups = self.rigid_groups
+        new_graph._group_indxs = self._group_indxs if tfs.device == self.device else {}
+        return new_graph
@@ -0,0 +1,66 @@
+import torch
+
+
+class MPPIRolloutBuffers(object):
+    """
+    Preallocated buffers for the MPPI rollouts.
+    The buffers are allocated once for (horizon, num_samples) and reused across the timesteps of each control() call
+    and across control() calls. Call reset() before each rollout.
+    """
+    def __init__(self, num_samples, horizon, state_size, action_size, device=None, dtype=torch.float):
+        if device is None:
+            device = torch.device('cpu')
+        self.num_samples = num_samples
+        self.horizon = horizon
+        self.state_size = state_size
+        self.action_size = action_size
+        self.device = device
+        self.dtype = dtype
+        self.states = torch.zeros((horizon, num_samples, state_size), device=device, dtype=dtype)  # (T, K, state_size)
+        self.actions = torch.zeros((horizon, num_samples, action_size), device=device, dtype=dtype)  # (T, K, action_size)
+        self.costs = torch.zeros((horizon, num_samples), device=device, dtype=dtype)  # (T, K)
+        self.state_step = 0
+        self.cost_step = 0
+
+    def reset(self):
+        self.state_step = 0
+        self.cost_step = 0
+
+    def is_rollout_batch(self, batch_size, step):
+        # Only the rollouts queried by the MPPI fit in the buffers (e.g. debug queries with a single sample do not)
+        return batch_size == self.num_samples and step < self.horizon
+
+    def get_next_state_buffer(self, batch_size, dtype, device):
+        """
+        Return the buffer where the next state for the current step has to be written.
+        :return: (K, state_size) tensor or None if the query is not part of the rollout
+        """
+        if not self.is_rollout_batch(batch_size, self.state_step) or dtype != self.dtype or device != self.states.device:
+            return None
+        next_state_buffer = self.states[self.state_step]
+        self.state_step += 1
+        return next_state_buffer
+
+    def record(self, actions, costs):
+        """
+        Write the actions and costs of the current step in place.
+        :param actions: (K, action_size) tensor
+        :param costs: (K,) tensor
+        :return: costs (K,) tensor -- view of the costs buffer if recorded, the provided costs otherwise
+        """
+        costs = costs.flatten()
+        if not self.is_rollout_batch(costs.shape[0], self.cost_step):
+            return costs
+        self.actions[self.cost_step].copy_(actions)
+        costs_t = self.costs[self.cost_step]
+        costs_t.copy_(costs)
+        self.cost_step += 1
+        return costs_t
+
+    def get_recorded_actions(self):
+        # (num_recorded_steps * K, action_size)
+        return self.actions[:self.cost_step].reshape(-1, self.action_size)
+
+    def get_recorded_costs(self):
+        # (num_recorded_steps * K,)
+        return self.costs[:self.cost_step].reshape(-1)
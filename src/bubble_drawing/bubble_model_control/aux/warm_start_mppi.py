@@ -0,0 +1,54 @@
+import torch
+from pytorch_mppi import mppi
+
+
+class WarmStartMPPI(mppi.MPPI):
+    """
+    MPPI with receding horizon sample reuse.
+    After each command, the elite_fraction best sampled action sequences are shifted one step (as the nominal trajectory)
+    and injected in the samples of the next command, so the good samples found on the previous control step are not lost.
+    The number of samples can be changed between commands (see set_num_samples).
+    """
+    def __init__(self, *args, elite_fraction=0., **kwargs):
+        """
+        :param elite_fraction: fraction of the num_samples kept for the next command. 0 behaves as the MPPI.
+        """
+        super().__init__(*args, **kwargs)
+        self.elite_fraction = elite_fraction
+        self.elite_actions = None # (num_elites, T, nu) shifted best action sequences of the last command
+
+    def set_num_samples(self, num_samples):
+        self.K = num_samples
+
+    def get_num_elites(self):
+        # at least one new sample is always drawn
+        return max(min(int(self.elite_fraction * self.K), self.K - 1), 0)
+
+    def command(self, state, *args, **kwargs):
+        action = super().command(state, *args, **kwargs)
+        self._update_elites()
+        return action
+
+    def reset(self):
+        super().reset()
+        self.elite_actions = None
+
+    def _update_elites(self):
+        num_elites = self.get_num_elites()
+        if num_elites == 0 or self.cost_total is None:
+            self.elite_actions = None
+            return
+        elite_indxs = torch.topk(self.cost_total, num_elites, largest=False).indices
+        elite_actions = torch.roll(self.perturbed_action[elite_indxs], -1, dims=1) # shift 1 time step
+        elite_actions[:, -1] = self.u_init
+        self.elite_actions = elite_actions
+
+    def _compute_perturbed_action_and_noise(self):
+        super()._compute_perturbed_action_and_noise()
+        if self.elite_actions is None or self.elite_actions.shape[1:] != self.perturbed_action.shape[1:]:
+            return # no elites or the horizon has changed
+        num_elites = min(self.elite_actions.shape[0], self.get_num_elites())
+        if num_elites > 0:
+            # replace the last samples (the first ones may be reserved for the null and specific actions)
+            self.perturbed_action[-num_elites:] = self.elite_actions[:num_elites]
+            self.noise = self.perturbed_action - self.U
@@ -0,0 +1,95 @@
+import argparse
+import time
+import numpy as np
+import torch
+import gym
+from collections import OrderedDict
+
+from bubble_drawing.bubble_learning.datasets.bubble_drawing_dataset import BubbleDrawingDataset
+from bubble_drawing.bubble_learning.aux.img_trs.block_downsampling_tr import BlockDownSamplingTr
+from bubble_drawing.bubble_learning.aux.orientation_trs import QuaternionToAxis
+from bubble_drawing.bubble_model_control.aux.bubble_dynamics_fixed_model import BubbleDynamicsFixedModel
+from bubble_drawing.bubble_model_control.model_output_object_pose_estimaton import \
+    BatchedModelOutputObjectPoseEstimation, ICPApproximationModelOutputObjectPoseEstimation
+from bubble_drawing.bubble_model_control.controllers.bubble_model_mppi_controler import BubbleModelMPPIController
+from bubble_drawing.bubble_model_control.drawing_action_models import drawing_action_model_one_dir, drawing_one_dir_grasp_pose_correction
+from bubble_drawing.bubble_model_control.cost_functions import vertical_tool_cost_function
+
+
+class BenchmarkDrawingEnv(object):
+    """
+    Minimal env exposing the action space of BubbleOneDirectionDrawingEnv, so the controller can be benchmarked without the robot.
+    """
+    def __init__(self, rotation_limits=(-np.pi*5/180, np.pi*5/180), drawing_length_limits=(0.01, 0.02), grasp_width_limits=(15, 25)):
+        action_space_dict = OrderedDict()
+        action_space_dict['rotation'] = gym.spaces.Box(low=rotation_limits[0], high=rotation_limits[1], shape=())
+        action_space_dict['length'] = gym.spaces.Box(low=drawing_length_limits[0], high=drawing_length_limits[1], shape=())
+        action_space_dict['grasp_width'] = gym.spaces.Box(low=grasp_width_limits[0], high=grasp_width_limits[1], shape=())
+        self.action_space = gym.spaces.Dict(action_space_dict)
+
+    def get_action(self):
+        action = self.action_space.sample()
+        valid_action = True
+        return action, valid_action
+
+
+def get_object_pose_estimation(ope_name, device):
+    if ope_name == 'icp':
+        ope = BatchedModelOutputObjectPoseEstimation(object_name='marker', factor_x=7, factor_y=7, method='bilinear', device=device,
+                                                     imprint_selection='percentile', imprint_percentile=0.005)
+    elif ope_name == 'fake_icp_approx':
+        ope = ICPApproximationModelOutputObjectPoseEstimation(model_name='fake_icp_approximation_model')
+    else:
+        raise NotImplementedError('Object pose estimation with name key {} NOT implemented yet. Available options: {}'.format(ope_name, ['icp', 'fake_icp_approx']))
+    return ope
+
+
+def benchmark_control_rate(controller, state_sample, num_warmup=2, num_iterations=10):
+    """
+    Measure the control loop rate (control calls per second) for the given controller
+    :return: mean rate (Hz), mean time per control call (s)
+    """
+    for i in range(num_warmup):
+        controller.control(state_sample)
+    times = []
+    for i in range(num_iterations):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        controller.control(state_sample)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start_time)
+    mean_time = np.mean(times)
+    return 1. / mean_time, mean_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark the MPPI control loop rate against the number of samples')
+    parser.add_argument('data_name', type=str, help='path to the drawing dataset used to load the reference state')
+    parser.add_argument('--num_samples', type=int, nargs='+', default=[10, 50, 100, 200, 500])
+    parser.add_argument('--horizon', type=int, default=2)
+    parser.add_argument('--ope', type=str, default='icp', help='object pose estimation: icp or fake_icp_approx')
+    parser.add_argument('--num_iterations', type=int, default=10)
+    parser.add_argument('--sample_indx', type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    dataset = BubbleDrawingDataset(data_name=args.data_name, wrench_frame='med_base', tf_frame='grasp_frame', transformation=[QuaternionToAxis()])
+    block_downsample_tr = BlockDownSamplingTr(factor_x=7, factor_y=7, reduction='mean', keys_to_tr=['init_imprint'])
+    state_sample = block_downsample_tr(dataset[args.sample_indx])
+
+    model = BubbleDynamicsFixedModel(device=device)  # fixed model, so we measure the controller and not the learned dynamics
+    ope = get_object_pose_estimation(args.ope, device)
+    env = BenchmarkDrawingEnv()
+
+    print('Control rate -- horizon: {}, ope: {}, device: {}'.format(args.horizon, args.ope, device))
+    print('{:>12} {:>12} {:>12}'.format('num_samples', 'rate (Hz)', 'time (s)'))
+    for num_samples in args.num_samples:
+        controller = BubbleModelMPPIController(model, env, ope, vertical_tool_cost_function,
+                                               action_model=drawing_action_model_one_dir,
+                                               grasp_pose_correction=drawing_one_dir_grasp_pose_correction,
+                                               num_samples=num_samples, horizon=args.horizon, noise_sigma=None, _noise_sigma_value=.3)
+        rate, mean_time = benchmark_control_rate(controller, state_sample, num_iterations=args.num_iterations)
+        print('{:>12} {:>12.3f} {:>12.4f}'.format(num_samples, rate, mean_time))
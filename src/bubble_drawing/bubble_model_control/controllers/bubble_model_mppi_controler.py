@@ -1,17 +1,21 @@
 import abc
+import time
 import torch
 import numpy as np
 import copy
 import tf.transformations as tr
-from pytorch_mppi import mppi
 import pytorch3d.transforms as batched_trs
 import matplotlib
 matplotlib.use('Qt5Agg')
 import matplotlib.pyplot as plt
 from bubble_drawing.bubble_model_control.controllers.bubble_controller_base import BubbleModelController
 from bubble_drawing.bubble_model_control.aux.bubble_model_control_utils import batched_tensor_sample, get_transformation_matrix, tr_frame, convert_all_tfs_to_tensors
+from bubble_drawing.bubble_model_control.aux.frame_graph import FrameGraph
 from bubble_pivoting.pivoting_model_control.aux.pivoting_geometry import get_angle_difference, check_goal_position, get_tool_axis, get_tool_angle_gf
 from bubble_drawing.bubble_model_control.aux.format_observation import format_observation_sample
+from bubble_drawing.bubble_model_control.aux.mppi_rollout_buffers import MPPIRolloutBuffers
+from bubble_drawing.bubble_model_control.aux.warm_start_mppi import WarmStartMPPI
+from bubble_drawing.aux.latency_profiler import profile_span
 import pdb
 
 def to_tensor(x, **kwargs):
@@ -29,7 +33,9 @@ class BubbleModelMPPIController(BubbleModelController):
     Batched controller with a batched pose estimation
     """
     def __init__(self, model, env, object_pose_estimator, cost_function, action_model, grasp_pose_correction=None, 
-                 state_trs=None, num_samples=100, horizon=2, lambda_=0.01, noise_sigma=None, _noise_sigma_value=0.2, debug=False):
+                 state_trs=None, num_samples=100, horizon=2, lambda_=0.01, noise_sigma=None, _noise_sigma_value=0.2, debug=False,
+                 latent_rollout=False, cost_steps=None, pose_tracker=None, elite_fraction=0., target_latency=None,
+                 min_num_samples=10, max_num_samples=1000, num_samples_step=10):
         """
         :param model:
         :param env:
@@ -44,6 +50,19 @@ class BubbleModelMPPIController(BubbleModelController):
         :param noise_sigma:
         :param _noise_sigma_value:
         :param debug:
+        :param latent_rollout: if True, the rollouts are done on the model imprint embedding space. The imprints are only decoded
+            at the cost_steps, where the poses are estimated and the costs are evaluated in one batched call at the end of the horizon.
+            It requires a model implementing encode, decode and latent_forward (e.g. BubbleDynamicsModel).
+        :param cost_steps: list of horizon steps where the cost is evaluated when latent_rollout is True. Default: only the terminal step.
+        :param pose_tracker: (optional) ToolPoseTracker. If provided, the tool pose is tracked across control steps and the
+            tracked pose warm-starts the ICP of the object pose estimator (on the observed state and on the rollouts).
+        :param elite_fraction: fraction of the best sampled action sequences of a control call that are shifted and reused
+            as samples on the next call (see WarmStartMPPI).
+        :param target_latency: (optional) time budget (s) for each control call. If provided, num_samples is adapted after
+            every call so the controller runs at 1/target_latency Hz.
+        :param min_num_samples: lower limit of the adapted num_samples
+        :param max_num_samples: upper limit of the adapted num_samples
+        :param num_samples_step: num_samples is adapted in multiples of num_samples_step, so the buffers are not reallocated on every call
         """
         self.action_model = action_model
         self.grasp_pose_correction = grasp_pose_correction
@@ -51,7 +70,11 @@ class BubbleModelMPPIController(BubbleModelController):
             self.grasp_pose_correction = default_grasp_pose_correction
         self.num_samples = num_samples
         self.horizon = horizon
+        self.latent_rollout = latent_rollout
+        self.cost_steps = self._get_cost_steps(cost_steps)
         super().__init__(model, env, object_pose_estimator, cost_function, state_trs=state_trs)
+        if self.latent_rollout and not all(hasattr(self.model, m) for m in ['encode', 'decode', 'latent_forward']):
+            raise AttributeError('Model {} does not support latent rollouts. It must implement encode, decode and latent_forward'.format(self.model.__class__.__name__))
         self.action_space = self.env.action_space
         self.u_mu = None
         self.noise_sigma = noise_sigma
@@ -59,6 +82,15 @@ class BubbleModelMPPIController(BubbleModelController):
         self.lambda_ = lambda_
         self.device = self.model.device
         self.debug = debug
+        self.pose_tracker = pose_tracker
+        self.tool_init_pose = None # filtered tool pose on the grasp frame of the current control call. It warm-starts the rollout pose estimations
+        self.elite_fraction = elite_fraction
+        self.target_latency = target_latency
+        self.min_num_samples = min_num_samples
+        self.max_num_samples = max_num_samples
+        self.num_samples_step = num_samples_step
+        self.last_control_latency = None # time (s) spent on the last controller command
+        self._last_converted_tfs = (None, None) # (all_tfs DataFrame, converted_all_tfs) of the last conversion of this controller
         self.action_container = self._get_action_container()
         self.u_min, self.u_max = self._get_action_space_limits()
         self.U_init = None # Initial trajectory. We initialize it as the mean of the action space. Actions will be drawin as a gaussian noise added to this values.
@@ -72,7 +104,12 @@ class BubbleModelMPPIController(BubbleModelController):
         self.controller = None # controller not initialized yet
         self.actions = None
         self.costs = None
-        
+        self.rollout_buffers = None # Preallocated rollout states, actions and costs. Initialized with the controller
+        self._batched_reference_samples = {} # reference sample broadcasted to each batch size. Reset at every control call.
+        self.latent_state_key = 'init_imprint' # state key encoded when doing latent rollouts
+        self._rollout_step = 0 # horizon step of the latent rollout
+        self._cost_queries = [] # (state_t, action_t) at the cost_steps, evaluated together at the end of the latent rollout
+
     def compute_cost(self, state_t, action_t):
         """
         Compute the dynamics
@@ -80,38 +117,84 @@ class BubbleModelMPPIController(BubbleModelController):
         :param action: (K, action_size) tensor
         :return: cost: (K, 1) tensor
         """
+        if self.latent_rollout:
+            costs_t = self._compute_latent_rollout_cost(state_t, action_t)
+        else:
+            costs_t = self._compute_step_cost(state_t, action_t)
+        if self.rollout_buffers is not None:
+            costs_t = self.rollout_buffers.record(action_t, costs_t)  # costs are written in place
+            self.actions = self.rollout_buffers.get_recorded_actions()
+            self.costs = self.rollout_buffers.get_recorded_costs()
+        return costs_t
+
+    def _compute_step_cost(self, state_t, action_t):
+        """
+        Compute the cost for a batch of states and actions
+        :param state_t: (B, state_size) tensor
+        :param action_t: (B, action_size) tensor
+        :return: cost: (B,) tensor
+        """
         # State_t is already next state but state_sample still has old tfs until we apply pack_state_to_sample and action_correction
         states = self._unpack_state_tensor(state_t)
         actions = self._unpack_action_tensor(action_t)
         state_samples = self._pack_state_to_sample(states, self.sample)
-        prev_state_samples = {'all_tfs': copy.deepcopy(state_samples['all_tfs'])}
-        state_samples = self._action_correction(state_samples, actions) # apply the action model
-        estimated_poses = self._estimate_poses(state_samples, actions)
-        costs = self.cost_function(estimated_poses, state_samples, prev_state_samples, actions)
-        if self.actions is None:
-            self.actions = actions
-            self.costs = costs
-        else:
-            self.actions = torch.cat((self.actions, actions), dim=0)
-            self.costs = torch.cat((self.costs, costs), dim=0)
-            
+        prev_state_samples = {'all_tfs': state_samples['all_tfs'].copy()} # No deepcopy needed: FrameGraph is not modified in place
+        with profile_span('action_model'):
+            state_samples = self._action_correction(state_samples, actions) # apply the action model
+        with profile_span('pose_estimation'):
+            estimated_poses = self._estimate_poses(state_samples, actions)
+        with profile_span('cost'):
+            costs = self.cost_function(estimated_poses, state_samples, prev_state_samples, actions)
         costs_t = to_tensor(costs)
         costs_t = costs_t.flatten()  # This fixes the error on mppi _compute_rollout_costs, although the documentation says that cost should be a (K,1)
         return costs_t
 
+    def _compute_latent_rollout_cost(self, state_t, action_t):
+        """
+        Store the states at the cost steps and evaluate them all together at the last step of the horizon.
+        The intermediate steps return zero cost, so the total rollout cost is the sum of the costs at the cost steps.
+        :param state_t: (K, state_size) tensor
+        :param action_t: (K, action_size) tensor
+        :return: cost: (K,) tensor
+        """
+        step = self._rollout_step
+        self._rollout_step += 1
+        if step in self.cost_steps:
+            self._cost_queries.append((state_t, action_t))
+        if step < self.horizon - 1 or len(self._cost_queries) == 0:
+            return torch.zeros(state_t.shape[0], dtype=state_t.dtype, device=state_t.device)
+        # Decode, estimate poses and compute the costs for all cost steps in one batched call
+        num_queries = len(self._cost_queries)
+        states_t = torch.cat([q[0] for q in self._cost_queries], dim=0)  # (num_queries*K, state_size)
+        actions_t = torch.cat([q[1] for q in self._cost_queries], dim=0)  # (num_queries*K, action_size)
+        self._cost_queries = []
+        costs_t = self._compute_step_cost(states_t, actions_t)
+        costs_t = costs_t.reshape(num_queries, -1).sum(dim=0)  # (K,)
+        return costs_t
+
+    def _get_cost_steps(self, cost_steps):
+        if cost_steps is None:
+            cost_steps = [-1] # only terminal step
+        cost_steps = sorted(set([int(s) % self.horizon for s in cost_steps]))
+        return cost_steps
+
     def _estimate_poses(self, state_samples, actions):
-        estimated_poses = self.object_pose_estimator.estimate_pose(state_samples) # Batched case
+        estimated_poses = self.object_pose_estimator.estimate_pose(state_samples, init_pose=self.tool_init_pose) # Batched case
         return estimated_poses
 
-    def _pack_state_to_tensor(self, state):
+    def _pack_state_to_tensor(self, state, out=None):
         """
         Transform state into a tensor (K, state_size)
         :param state: tuple of tensors representing the state (expected input to the model)
+        :param out: (K, state_size) tensor where to write the state. If None, a new tensor is allocated
         :return: state tensor
         """
         flattened_state_shapes = self._get_flattened_state_sizes()
         state_t = [to_tensor(s).reshape(-1, flattened_state_shapes[i]) for i, s in enumerate(state)]
-        state_t = torch.cat(state_t, dim=-1)
+        if out is not None and all(s.dtype == out.dtype and not s.requires_grad for s in state_t):
+            state_t = torch.cat(state_t, dim=-1, out=out)
+        else:
+            state_t = torch.cat(state_t, dim=-1)
         return state_t
 
     def _pack_state_to_sample(self, state, sample_ref):
@@ -121,14 +204,12 @@ class BubbleModelMPPIController(BubbleModelController):
         :param sample_ref:
         :return: sample containing the state
         """
-        sample = sample_ref.copy()  # No copy
+        if self.latent_rollout:
+            state = self._decode_state(state)
         batch_size = state[0].shape[0]
         device = state[0].device
-        # convert all_tfs to tensors
-        sample['all_tfs'] = self._convert_all_tfs_to_tensors(sample['all_tfs'])
-        # convert samples to tensors
-        batched_sample = batched_tensor_sample(sample, batch_size=batch_size, device=device)
-        # and repeat the batch size (at least for camera_info_{r,l}['K'], undef_depth_{r,l}, all_tfs
+        batched_sample = self._get_batched_reference_sample(sample_ref, batch_size, device).copy()
+        batched_sample['all_tfs'] = batched_sample['all_tfs'].copy() # FrameGraph copies share the tfs tensor (the action model returns new graphs)
 
         # put the state to the sample
         for i, key in enumerate(self.state_keys):
@@ -140,6 +221,45 @@ class BubbleModelMPPIController(BubbleModelController):
             batched_sample[new_key] = state_i
         return batched_sample
 
+    def _get_batched_reference_sample(self, sample_ref, batch_size, device):
+        """
+        Convert the reference sample to tensors and broadcast it to the batch size.
+        Since the reference does not change during the rollouts, we compute it only once per control call.
+        The values are broadcasted (not copied), so they must not be modified in place.
+        """
+        cache_key = (batch_size, device)
+        if sample_ref is not self.sample or cache_key not in self._batched_reference_samples:
+            sample = sample_ref.copy()  # No copy
+            # convert all_tfs to a FrameGraph, a single (batch_size, n_frames, 4, 4) tensor broadcasted to the batch size
+            sample['all_tfs'] = FrameGraph.from_dict(self._convert_all_tfs_to_tensors(sample['all_tfs']), device=device).expand(batch_size)
+            # convert samples to tensors and broadcast them to the batch size (at least for camera_info_{r,l}['K'], undef_depth_{r,l}
+            batched_sample = batched_tensor_sample(sample, batch_size=batch_size, device=device, broadcast=True)
+            if sample_ref is not self.sample:
+                return batched_sample
+            self._batched_reference_samples[cache_key] = batched_sample
+        return self._batched_reference_samples[cache_key]
+
+    def _set_reference_object_model(self, state):
+        """
+        Replace the object model of the state by the one of the reference sample, broadcasted to the batch size.
+        The object model does not change during the rollouts, and passing the same tensor on all the steps of the control
+        call lets the model reuse its object embedding without reading the object model values.
+        :param state: tuple of batched tensors
+        :return: state with the reference object model
+        """
+        key = 'object_model'
+        if self.sample is None or key not in self.state_keys or key in self.model_output_keys or key not in self.sample:
+            return state
+        indx = self.state_keys.index(key)
+        batch_size, dtype, device = state[indx].shape[0], state[indx].dtype, state[indx].device
+        cache_key = (key, batch_size, dtype, device)
+        if cache_key not in self._batched_reference_samples:
+            object_model = self._get_batched_reference_sample(self.sample, batch_size, device)[key]
+            self._batched_reference_samples[cache_key] = object_model.type(dtype).reshape(state[indx].shape)
+        state = list(state)
+        state[indx] = self._batched_reference_samples[cache_key]
+        return tuple(state)
+
     def _unpack_state_tensor(self, state_t):
         """
         Transform back the state.
@@ -156,6 +276,31 @@ class BubbleModelMPPIController(BubbleModelController):
         state = tuple(state)
         return state
 
+    def _encode_state(self, state):
+        """
+        Encode the imprint of a non-batched state into the model imprint embedding space
+        :param state: tuple of non-batched tensors or arrays
+        :return: state with the encoded imprint (1, imprint_emb_size)
+        """
+        latent_indx = self.state_keys.index(self.latent_state_key)
+        state = list(state)
+        imprint = to_tensor(state[latent_indx]).type(torch.float).to(self.device).unsqueeze(0)
+        with torch.no_grad():
+            state[latent_indx] = self.model.encode(imprint).cpu() # the controller moves the state to the device
+        return tuple(state)
+
+    def _decode_state(self, state):
+        """
+        Decode the imprint embedding of a batched state
+        :param state: tuple of batched tensors with the encoded imprint (B, imprint_emb_size)
+        :return: state with the decoded imprint
+        """
+        latent_indx = self.state_keys.index(self.latent_state_key)
+        state = list(state)
+        with torch.no_grad():
+            state[latent_indx] = self.model.decode(state[latent_indx].type(torch.float).to(self.device))
+        return tuple(state)
+
     def _unpack_state_sample(self, state_sample):
         """
         Extract the state from a sample
@@ -215,6 +360,17 @@ class BubbleModelMPPIController(BubbleModelController):
                 break
         return self.action_container
 
+    def reset(self):
+        """
+        Forget the state carried between control calls (tracked tool pose and MPPI warm start).
+        Call it when a new episode starts or the tool is moved without the controller (e.g. regrasp or reorientation).
+        """
+        if self.pose_tracker is not None:
+            self.pose_tracker.reset()
+        self.tool_init_pose = None
+        if self.controller is not None:
+            self.controller.reset()
+
     def dynamics(self, state_t, action_t):
         """
         Compute the dynamics by querying the model
@@ -223,15 +379,32 @@ class BubbleModelMPPIController(BubbleModelController):
         :return: next_state: (K, state_size) tensor
         """
         state = self._unpack_state_tensor(state_t)
+        state = self._set_reference_object_model(state)
         action = self._unpack_action_tensor(action_t)
         model_input = self._extract_input_from_state(state)
-        output = self.model(*model_input, action)
+        with torch.no_grad(), profile_span('model_forward'):
+            if self.latent_rollout:
+                output = self.model.latent_forward(*model_input, action)
+            else:
+                output = self.model(*model_input, action)
         if self.debug and action.shape[0] < 2:
             self.state_prev = state
             self.prediction = copy.deepcopy([o.detach() for o in output])
             self.pred_input = copy.deepcopy([mi.detach() for mi in model_input])
+            if self.latent_rollout:
+                # decode the imprints for visualization
+                self.state_prev = self._decode_state(state)
+                with torch.no_grad():
+                    output_indx = self.model_output_keys.index(self.latent_state_key)
+                    self.prediction[output_indx] = self.model.decode(self.prediction[output_indx])
+                    input_indx = [k for k in self.state_keys if k in self.input_keys].index(self.latent_state_key)
+                    self.pred_input[input_indx] = self.model.decode(self.pred_input[input_indx])
         next_state = self._expand_output_to_state(output, state, action)
-        next_state_t = self._pack_state_to_tensor(next_state)
+        next_state_buffer = None
+        if self.rollout_buffers is not None:
+            next_state_buffer = self.rollout_buffers.get_next_state_buffer(state_t.shape[0], dtype=state_t.dtype, device=state_t.device)
+        with profile_span('state_packing'):
+            next_state_t = self._pack_state_to_tensor(next_state, out=next_state_buffer)
         return next_state_t
 
     def _get_action_container(self):
@@ -267,32 +440,95 @@ class BubbleModelMPPIController(BubbleModelController):
 
     def _get_controller(self):
         self._init_params()
-        controller = mppi.MPPI(self.dynamics, self.compute_cost, self.state_size, self.noise_sigma,
-                               lambda_=self.lambda_, device=self.model.device,
-                               num_samples=self.num_samples, horizon=self.horizon, u_min=self.u_min, u_max=self.u_max, u_init=self.u_mu, U_init=self.U_init, noise_abs_cost=True)
+        controller = WarmStartMPPI(self.dynamics, self.compute_cost, self.state_size, self.noise_sigma,
+                                   lambda_=self.lambda_, device=self.model.device,
+                                   num_samples=self.num_samples, horizon=self.horizon, u_min=self.u_min, u_max=self.u_max, u_init=self.u_mu, U_init=self.U_init, noise_abs_cost=True,
+                                   elite_fraction=self.elite_fraction)
         return controller
 
     def _query_controller(self, state_sample):
         if not self.controller:
             # Initialize the controller
             self.original_state_shape = self._get_original_state_shape(state_sample)
+            if self.latent_rollout:
+                self.original_state_shape[self.latent_state_key] = torch.Size([self.model.img_embedding_size])
             self.state_size = self._get_state_size()
             self.controller = self._get_controller()
+            self.rollout_buffers = self._get_rollout_buffers()
         self.sample = state_sample
-        state = self._unpack_state_sample(state_sample)
-        state_t = self._pack_state_to_tensor(state)
-        action = self.controller.command(state_t)
+        self._reset_rollout()
+        self.tool_init_pose = None
+        if self.pose_tracker is not None:
+            with profile_span('pose_tracking'):
+                self.tool_init_pose = self._update_pose_tracker(state_sample)
+        with profile_span('state_packing'):
+            state = self._unpack_state_sample(state_sample)
+            if self.latent_rollout:
+                state = self._encode_state(state)
+            state_t = self._pack_state_to_tensor(state)
+        start_time = time.perf_counter()
+        with profile_span('mppi_command'):
+            action = self.controller.command(state_t)
+        self.last_control_latency = time.perf_counter() - start_time
+        if self.target_latency is not None:
+            self._adapt_num_samples(self.last_control_latency)
+        if self.pose_tracker is not None:
+            # predicted tool pose after the commanded action. It warm-starts the estimation on the next control step.
+            self.pose_tracker.predict(self._convert_all_tfs_to_tensors(state_sample['all_tfs']), action,
+                                      tool_name=self.object_pose_estimator.object_name)
         if self.debug:
             self._check_prediction(state_t, action)
         return action
 
+    def _update_pose_tracker(self, state_sample):
+        """
+        Estimate the tool pose on the observed imprint (warm-started with the tracker prediction) and filter it.
+        The filtered pose is then used to warm-start the pose estimation of all the rollouts: the action model moves the tool
+        rigidly with the grasp frame, so its pose on the grasp frame is the same for all of them.
+        :return: (4, 4) filtered tool pose on the grasp frame
+        """
+        tool_name = self.object_pose_estimator.object_name
+        all_tfs = self._convert_all_tfs_to_tensors(state_sample['all_tfs'])
+        batched_sample = self._get_batched_reference_sample(state_sample, 1, self.device).copy()
+        batched_sample['final_imprint'] = to_tensor(state_sample['init_imprint']).type(torch.float).to(self.device).unsqueeze(0)
+        prior_pose = self.pose_tracker.get_prior(tool_name, frame_name='grasp_frame', all_tfs=all_tfs) # None for the first step
+        estimated_pose = self.object_pose_estimator.estimate_pose(batched_sample, init_pose=prior_pose)[0].detach().cpu().numpy() # [x, y, z, qx, qy, qz, qw] on med_base
+        wf_X_tool = tr.quaternion_matrix(estimated_pose[3:])
+        wf_X_tool[:3, 3] = estimated_pose[:3]
+        self.pose_tracker.update(wf_X_tool, tool_name=tool_name, frame_name='med_base', all_tfs=all_tfs)
+        return self.pose_tracker.get_pose(tool_name, frame_name='grasp_frame', all_tfs=all_tfs)
+
+    def _adapt_num_samples(self, latency):
+        """
+        Scale num_samples so the next control call takes target_latency. The rollout cost is about linear on num_samples.
+        The change per call is limited to a factor of 2 to filter out latency spikes.
+        """
+        scale = np.clip(self.target_latency / max(latency, 1e-6), 0.5, 2.)
+        num_samples = int(round(self.num_samples * scale / self.num_samples_step)) * self.num_samples_step
+        num_samples = int(np.clip(num_samples, self.min_num_samples, self.max_num_samples))
+        if num_samples != self.num_samples:
+            self.num_samples = num_samples
+            self.controller.set_num_samples(num_samples)
+            self.rollout_buffers = self._get_rollout_buffers()
+
+    def _get_rollout_buffers(self):
+        rollout_buffers = MPPIRolloutBuffers(num_samples=self.num_samples, horizon=self.horizon, state_size=int(self.state_size),
+                                             action_size=self.u_max.shape[0], device=self.u_max.device, dtype=self.controller.dtype)
+        return rollout_buffers
+
+    def _reset_rollout(self):
+        self.rollout_buffers.reset()
+        self._batched_reference_samples = {}
+        self._rollout_step = 0
+        self._cost_queries = []
+
     def _check_prediction(self, state_t, action):
         action_t = action.unsqueeze(0).repeat_interleave(state_t.shape[0], dim=0)
         next_state_t = self.dynamics(state_t.type(torch.float), action_t)
         next_state = self._unpack_state_tensor(next_state_t)
         next_state_sample = self._pack_state_to_sample(next_state, self.sample)
         next_state_sample = self._action_correction(next_state_sample, action_t)
-        estimated_pose = self.object_pose_estimator.estimate_pose(next_state_sample)
+        estimated_pose = self.object_pose_estimator.estimate_pose(next_state_sample, init_pose=self.tool_init_pose)
         tool_angle_gf = get_tool_angle_gf(estimated_pose, next_state_sample)
         print('Predicted estimated tool angle gf after action: ', tool_angle_gf)
         action_ind = (torch.norm(self.actions - action, dim=1) < 0.01).nonzero(as_tuple=True)[0]
@@ -328,8 +564,10 @@ class BubbleModelMPPIController(BubbleModelController):
         obs_sample['all_tfs']['med_base'] = torch.from_numpy(obs_sample['all_tfs']['med_base']).unsqueeze(0)
         obs_sample['all_tfs']['grasp_frame'] = torch.from_numpy(obs_sample['all_tfs']['grasp_frame']).unsqueeze(0)
         obs_sample['final_imprint'] = torch.from_numpy(obs_sample['init_imprint']).unsqueeze(0)
-        obs_sample['undef_depth_r'] = torch.from_numpy(obs_sample['undef_depth_r']).unsqueeze(0)
-        obs_sample['undef_depth_l'] = torch.from_numpy(obs_sample['undef_depth_l']).unsqueeze(0)
+        if 'reference_frame' not in obs_sample:
+            # with a reference_frame the reference depths are resolved (and cached) by the object pose estimator
+            obs_sample['undef_depth_r'] = torch.from_numpy(obs_sample['undef_depth_r']).unsqueeze(0)
+            obs_sample['undef_depth_l'] = torch.from_numpy(obs_sample['undef_depth_l']).unsqueeze(0)
         return obs_sample        
 
     def _action_correction(self, state_samples, actions):
@@ -339,10 +577,15 @@ class BubbleModelMPPIController(BubbleModelController):
 
     def _convert_all_tfs_to_tensors(self, all_tfs):
         """
+        The conversion is memoized for the last DataFrame of this controller, so converting the same sample again (e.g. on every rollout) is cheap.
         :param all_tfs: DataFrame
-        :return:
+        :return: dict frame_name -> (4, 4) homogeneous transformation. The dict and the matrices are copies owned by the caller.
         """
-        converted_all_tfs = convert_all_tfs_to_tensors(all_tfs)
+        last_all_tfs, last_converted_all_tfs = self._last_converted_tfs
+        if last_all_tfs is not all_tfs:
+            last_converted_all_tfs = convert_all_tfs_to_tensors(all_tfs)
+            self._last_converted_tfs = (all_tfs, last_converted_all_tfs) # keep a reference to all_tfs so its identity is not reused
+        converted_all_tfs = {frame_name: X.copy() for frame_name, X in last_converted_all_tfs.items()}
         return converted_all_tfs
 
     def _get_original_state_shape(self, state_sample):
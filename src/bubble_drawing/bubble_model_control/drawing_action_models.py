@@ -6,8 +6,17 @@ import tf.transformations as tr
 import pytorch3d.transforms as batched_trs
 
 from bubble_drawing.bubble_model_control.aux.bubble_model_control_utils import batched_tensor_sample, get_transformation_matrix, tr_frame, convert_all_tfs_to_tensors
+from bubble_drawing.bubble_model_control.aux.frame_graph import FrameGraph
 from bubble_drawing.bubble_learning.aux.orientation_trs import QuaternionToAxis
 
+# Frames rigidly attached to each of the frames moved by the drawing actions
+DRAWING_RIGID_GROUPS = {
+    'grasp_frame': ['grasp_frame', 'med_kuka_link_ee', 'wsg50_finger_left', 'pico_flexx_left_link',
+                    'pico_flexx_left_optical_frame', 'pico_flexx_right_link', 'pico_flexx_right_optical_frame'],
+    'wsg50_finger_left': ['pico_flexx_left_link', 'pico_flexx_left_optical_frame'],
+    'wsg50_finger_right': ['pico_flexx_right_link', 'pico_flexx_right_optical_frame'],
+}
+
 
 def drawing_one_dir_grasp_pose_correction(position, orientation, action):
     # NOTE: Orientations can either be quaternions or axis-angle
@@ -51,45 +60,41 @@ def drawing_action_model_one_dir(state_samples, actions):
     # Length is a translation motion of length 'length' of the grasp_frame on the xy med_base plane along the intersection with teh yz grasp frame plane
     # grasp_width is the width of the
     all_tfs = state_samples_corrected['all_tfs']  # Tfs from world frame ('med_base') to the each of teh frame names
-    frame_names = all_tfs.keys()
-
-    rigid_ee_frames = ['grasp_frame', 'med_kuka_link_ee', 'wsg50_finger_left', 'pico_flexx_left_link',
-                       'pico_flexx_left_optical_frame', 'pico_flexx_right_link', 'pico_flexx_right_optical_frame']
+    if not isinstance(all_tfs, FrameGraph):
+        all_tfs = FrameGraph.from_dict(all_tfs, rigid_groups=DRAWING_RIGID_GROUPS)
+    batch_size = actions.shape[0]
+    dtype = all_tfs.dtype
+    device = all_tfs.device
     wf_X_gf = all_tfs['grasp_frame']
     # Move Gripper:
     # (move wsg_50_finger_{right,left} along x direction)
-    gf_X_fl = get_transformation_matrix(all_tfs, 'grasp_frame', 'wsg50_finger_left')
-    gf_X_fr = get_transformation_matrix(all_tfs, 'grasp_frame', 'wsg50_finger_right')
-    X_finger_left = torch.eye(4).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double)
-    X_finger_right = torch.eye(4).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double)
+    gf_X_fl = all_tfs.get_transformation_matrix('grasp_frame', 'wsg50_finger_left')
+    gf_X_fr = all_tfs.get_transformation_matrix('grasp_frame', 'wsg50_finger_right')
+    X_finger_left = torch.eye(4, dtype=dtype, device=device).unsqueeze(0).repeat_interleave(batch_size, dim=0)
+    X_finger_right = torch.eye(4, dtype=dtype, device=device).unsqueeze(0).repeat_interleave(batch_size, dim=0)
     current_half_width_l = -gf_X_fl[..., 0, 3] - 0.009
     current_half_width_r = gf_X_fr[..., 0, 3] - 0.009
-    X_finger_left[..., 0, 3] = -(0.5 * grasp_widths - current_half_width_l).type(torch.double)
-    X_finger_right[..., 0, 3] = -(0.5 * grasp_widths - current_half_width_r).type(torch.double)
-    all_tfs = tr_frame(all_tfs, 'wsg50_finger_left', X_finger_left,
-                       ['pico_flexx_left_link', 'pico_flexx_left_optical_frame'])
-    all_tfs = tr_frame(all_tfs, 'wsg50_finger_right', X_finger_right,
-                       ['pico_flexx_right_link', 'pico_flexx_right_optical_frame'])
+    X_finger_left[..., 0, 3] = -(0.5 * grasp_widths - current_half_width_l).type(dtype)
+    X_finger_right[..., 0, 3] = -(0.5 * grasp_widths - current_half_width_r).type(dtype)
+    all_tfs = all_tfs.tr_frame('wsg50_finger_left', X_finger_left, DRAWING_RIGID_GROUPS['wsg50_finger_left'])
+    all_tfs = all_tfs.tr_frame('wsg50_finger_right', X_finger_right, DRAWING_RIGID_GROUPS['wsg50_finger_right'])
     # Move Grasp frame on the plane amount 'length; and rotate the Grasp frame along x direction a 'rotation'  amount
-    rot_axis = torch.tensor([1, 0, 0]).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double)
-    angle_axis = rotations.unsqueeze(-1).repeat_interleave(3, dim=-1) * rot_axis
-    X_gf_rot = torch.eye(4).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double)
-    X_gf_rot[..., :3, :3] = batched_trs.axis_angle_to_matrix(angle_axis)  # rotation along x axis
+    rot_axis = torch.tensor([1, 0, 0], dtype=dtype, device=device).unsqueeze(0).repeat_interleave(batch_size, dim=0)
+    angle_axis = rotations.unsqueeze(-1).type(dtype).to(device) * rot_axis
     # compute translation
-    z_axis = torch.tensor([0, 0, 1]).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double)
-    y_dir_gf = torch.tensor([0, -1, 0]).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double)
+    z_axis = torch.tensor([0, 0, 1], dtype=dtype, device=device).unsqueeze(0).repeat_interleave(batch_size, dim=0)
+    y_dir_gf = torch.tensor([0, -1, 0], dtype=dtype, device=device).unsqueeze(0).repeat_interleave(batch_size, dim=0)
     y_dir_wf = torch.einsum('kij,kj->ki', wf_X_gf[..., :3, :3], y_dir_gf)
-    y_dir_wf_perp = torch.einsum('ki,ki->k', y_dir_wf, z_axis).unsqueeze(-1).repeat_interleave(3, dim=-1) * z_axis
+    y_dir_wf_perp = torch.einsum('ki,ki->k', y_dir_wf, z_axis).unsqueeze(-1) * z_axis
     drawing_dir_wf = y_dir_wf - y_dir_wf_perp
-    drawing_dir_wf = drawing_dir_wf / torch.linalg.norm(drawing_dir_wf, dim=1).unsqueeze(-1).repeat_interleave(3,
-                                                                                                               dim=-1)  # normalize
-    drawing_dir_gf = torch.einsum('kij,kj->ki', torch.linalg.inv(wf_X_gf[..., :3, :3]), drawing_dir_wf)
-    trans_gf = lengths.unsqueeze(-1).repeat_interleave(3, dim=-1) * drawing_dir_gf
-    X_gf_trans = torch.eye(4).unsqueeze(0).repeat_interleave(actions.shape[0], dim=0).type(torch.double).type(
-        torch.double)
-    X_gf_trans[..., :3, 3] = trans_gf
-    all_tfs = tr_frame(all_tfs, 'grasp_frame', X_gf_trans, rigid_ee_frames)
-    all_tfs = tr_frame(all_tfs, 'grasp_frame', X_gf_rot, rigid_ee_frames)
+    drawing_dir_wf = drawing_dir_wf / torch.linalg.norm(drawing_dir_wf, dim=1).unsqueeze(-1)  # normalize
+    drawing_dir_gf = torch.einsum('kji,kj->ki', wf_X_gf[..., :3, :3], drawing_dir_wf) # R^-1 = R^T
+    trans_gf = lengths.unsqueeze(-1).type(dtype).to(device) * drawing_dir_gf
+    # translation followed by the rotation along x axis: X_gf = X_gf_trans @ X_gf_rot (applied in a single step)
+    X_gf = torch.eye(4, dtype=dtype, device=device).unsqueeze(0).repeat_interleave(batch_size, dim=0)
+    X_gf[..., :3, :3] = batched_trs.axis_angle_to_matrix(angle_axis)
+    X_gf[..., :3, 3] = trans_gf
+    all_tfs = all_tfs.tr_frame('grasp_frame', X_gf, DRAWING_RIGID_GROUPS['grasp_frame'])
     state_samples_corrected['all_tfs'] = all_tfs
 
     return state_samples_corrected
\ No newline at end of file
@@ -9,31 +9,38 @@ from bubble_drawing.aux.load_confs import load_bubble_reconstruction_params, loa
 from bubble_utils.bubble_tools.bubble_img_tools import unprocess_bubble_img
 
 from bubble_drawing.bubble_pose_estimation.batched_pytorch_icp import icp_2d_masked, pc_batched_tr
+from bubble_drawing.bubble_model_control.aux.bubble_model_control_utils import get_transformation_matrix
 from mmint_camera_utils.camera_utils.camera_utils import project_depth_image
 from mmint_camera_utils.camera_utils.point_cloud_utils import project_pc, get_projection_tr
 from bubble_utils.bubble_tools.bubble_pc_tools import get_imprint_mask
+from bubble_drawing.bubble_pose_estimation.cone_filter import get_cone_filter_pixel_mask
 from bubble_drawing.bubble_learning.aux.load_model import load_model_version
 from bubble_drawing.bubble_learning.models.icp_approximation_model import ICPApproximationModel, FakeICPApproximationModel
 from bubble_drawing.bubble_learning.aux.orientation_trs import QuaternionToAxis
+from bubble_drawing.bubble_learning.aux.reference_frame_store import ReferenceFrame
+from bubble_drawing.aux.latency_profiler import profile_span
 
 
 class ModelOutputObjectPoseEstimationBase(object):
     def __init__(self):
         pass
 
-    def estimate_pose(self, sample):
-        # upsample the imprints
-        estimated_pose = self._estimate_pose(sample)
+    def estimate_pose(self, sample, init_pose=None):
+        """
+        :param init_pose: (optional) (4, 4) or (N, 4, 4) object pose on the grasp frame to warm-start the estimation (e.g.
+            ToolPoseTracker.get_prior). Only used by the estimators that iterate (ICP). It only applies to this call.
+        """
+        estimated_pose = self._estimate_pose(sample, init_pose=init_pose)
         return estimated_pose
 
     @abstractmethod
-    def _estimate_pose(self, sample):
+    def _estimate_pose(self, sample, init_pose=None):
         # Return estimated object pose [x, y, z, qx, qy, qz, qw]
         pass
 
 
 class BatchedModelOutputObjectPoseEstimationBase(ModelOutputObjectPoseEstimationBase):
-    def _estimate_pose(self, batched_sample):
+    def _estimate_pose(self, batched_sample, init_pose=None):
         """
         Estimate the object pose from the imprints using icp 2D. We compute it in parallel on batched operations
         :param sample: The sample is expected to be batched, i.e. all values (batch_size, original_size_1, ..., original_size_n)
@@ -41,7 +48,7 @@ class BatchedModelOutputObjectPoseEstimationBase(ModelOutputObjectPoseEstimation
         """
         all_tfs = batched_sample['all_tfs']
 
-        gf_X_objpose = self._estimate_object_pose(batched_sample)
+        gf_X_objpose = self._estimate_object_pose(batched_sample, init_pose=init_pose)
 
         # Compute object pose in world frame
         wf_X_gf = self._get_transformation_matrix(all_tfs, 'med_base', 'grasp_frame').type(gf_X_objpose.dtype)
@@ -55,14 +62,11 @@ class BatchedModelOutputObjectPoseEstimationBase(ModelOutputObjectPoseEstimation
         return estimated_poses
 
     def _get_transformation_matrix(self, all_tfs, source_frame, target_frame):
-        w_X_sf = all_tfs[source_frame]
-        w_X_tf = all_tfs[target_frame]
-        sf_X_w = torch.linalg.inv(w_X_sf)
-        sf_X_tf = sf_X_w @ w_X_tf
+        sf_X_tf = get_transformation_matrix(all_tfs, source_frame, target_frame)
         return sf_X_tf
 
     @abstractmethod
-    def _estimate_object_pose(self, batched_sample):
+    def _estimate_object_pose(self, batched_sample, init_pose=None):
         # returns the objec_pose estimation on the grasp frame.
         # Pose encoded as a 4x4 homogeneous transforamtion gf_X_objpose.
         # output_shape: (batched_size, 4, 4)
@@ -88,7 +92,7 @@ class End2EndModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimat
     """
     ObjectPoseEstimation for pose-to-pose dynamics model
     """
-    def _estimate_object_pose(self, sample):
+    def _estimate_object_pose(self, sample, init_pose=None):
         estimated_pose_axis_angle_gf = sample['final_object_pose']  # final_object_pose in grasp frame. It is also encoded as axis-angle
         gf_X_objpose =  axis_angle_pose_to_homogeneous_pose(estimated_pose_axis_angle_gf)
         return gf_X_objpose
@@ -105,7 +109,7 @@ class ICPApproximationModelOutputObjectPoseEstimation(BatchedModelOutputObjectPo
         super().__init__(*args, **kwargs)
         self.icp_approx_model = self._load_icp_approx_model()
 
-    def _estimate_object_pose(self, batched_sample):
+    def _estimate_object_pose(self, batched_sample, init_pose=None):
         predicted_imprint = batched_sample['final_imprint']
         estimated_pose_axis_angle_gf = self.icp_approx_model(predicted_imprint)
         gf_X_objpose = axis_angle_pose_to_homogeneous_pose(estimated_pose_axis_angle_gf)
@@ -131,9 +135,15 @@ class ICPApproximationModelOutputObjectPoseEstimation(BatchedModelOutputObjectPo
 
 class BatchedModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimationBase):
     """ ICP POSE ESTIMATION. Work with pytorch tensors"""
-    def __init__(self, *args, device=None, imprint_selection='threshold', imprint_percentile=0.1, object_name='marker', factor_x=1, factor_y=1, method='bilinear', **kwargs):
+    def __init__(self, *args, device=None, imprint_selection='threshold', imprint_percentile=0.1, object_name='marker', factor_x=1, factor_y=1, method='bilinear',
+                 num_icp_iterations=20, icp_tolerance=None, icp_memory_budget=None, projection_axis=(1, 0, 0), model_downsample=20, cone_filter=False, **kwargs):
         self.imprint_selection = imprint_selection
         self.imprint_percentile = imprint_percentile
+        self.num_icp_iterations = num_icp_iterations
+        self.icp_tolerance = icp_tolerance # If provided, ICP stops early for the samples that have converged
+        self.icp_memory_budget = icp_memory_budget # Max bytes for the ICP correspondence distances (None: no limit). It bounds the memory for large num_samples
+        self.cone_filter = cone_filter # If True, discard the pixels outside the bubble view cone (same filter as BubblePCReconstructorBase.filter_pc)
+        self.last_icp_info = None # Contains the number of ICP iterations and residuals of the last estimation (only when icp_tolerance is provided)
         if device is None:
             device = torch.device('cpu')
         self.device = device
@@ -144,16 +154,66 @@ class BatchedModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimat
         self.icp_threshold = self.object_params['icp_th']
         self.block_upsample_tr = BlockUpSamplingTr(factor_x=factor_x, factor_y=factor_y, method=method,
                                                    keys_to_tr=['final_imprint'])
+        self.projection_axis = tuple(projection_axis)
+        self.model_downsample = model_downsample
         super().__init__(*args, **kwargs)
         self.model_pcs = load_object_models()
+        self.projection_tr = torch.tensor(get_projection_tr(self.projection_axis)).type(torch.float)  # (4,4)
+        self.unproject_tr = torch.linalg.inv(self.projection_tr)
+        self._projected_model_pcs = {} # cache of the projected 2d object models. Key: (object_name, projection_axis, device, dtype, downsample)
+        self._get_projected_model_pc(self.object_name, device=self.device, dtype=torch.float) # build the model used by default
+        self._reference_tensors = {} # resolved reference frames as tensors. Key: (ref_id, device)
+
+    def _get_batched_reference(self, batched_sample, batch_size, device):
+        """
+        Get the reference depths and camera infos of the batched sample.
+        If the sample contains a ReferenceFrame (key 'reference_frame') it is resolved only once and broadcasted to the batch_size (no copies).
+        :return: dict containing 'undef_depth_r', 'undef_depth_l', 'camera_info_r', 'camera_info_l'
+        """
+        if 'reference_frame' not in batched_sample:
+            return batched_sample
+        reference_frame = batched_sample['reference_frame']
+        if not isinstance(reference_frame, ReferenceFrame):
+            # list of reference frames (one per sample)
+            if any([rf_i != reference_frame[0] for rf_i in reference_frame]):
+                references = [self._get_reference_tensors(rf_i, device) for rf_i in reference_frame]
+                return {
+                    'undef_depth_r': torch.cat([ref_i['undef_depth_r'] for ref_i in references], dim=0),
+                    'undef_depth_l': torch.cat([ref_i['undef_depth_l'] for ref_i in references], dim=0),
+                    'camera_info_r': {'K': torch.cat([ref_i['camera_info_r']['K'] for ref_i in references], dim=0)},
+                    'camera_info_l': {'K': torch.cat([ref_i['camera_info_l']['K'] for ref_i in references], dim=0)},
+                }
+            reference_frame = reference_frame[0]
+        reference = self._get_reference_tensors(reference_frame, device)
+        batched_reference = {
+            'undef_depth_r': reference['undef_depth_r'].expand(batch_size, *reference['undef_depth_r'].shape[1:]),
+            'undef_depth_l': reference['undef_depth_l'].expand(batch_size, *reference['undef_depth_l'].shape[1:]),
+            'camera_info_r': {'K': reference['camera_info_r']['K'].expand(batch_size, -1, -1)},
+            'camera_info_l': {'K': reference['camera_info_l']['K'].expand(batch_size, -1, -1)},
+        }
+        return batched_reference
+
+    def _get_reference_tensors(self, reference_frame, device):
+        # Resolve the reference frame and convert it to tensors with batch size 1
+        cache_key = (reference_frame.ref_id, str(device))
+        if cache_key not in self._reference_tensors:
+            reference = reference_frame.resolve()
+            self._reference_tensors[cache_key] = {
+                'undef_depth_r': torch.as_tensor(np.asarray(reference['undef_depth_r'])).unsqueeze(0).to(device),  # (1, w, h, 1)
+                'undef_depth_l': torch.as_tensor(np.asarray(reference['undef_depth_l'])).unsqueeze(0).to(device),  # (1, w, h, 1)
+                'camera_info_r': {'K': torch.as_tensor(np.asarray(reference['camera_info_r']['K'])).unsqueeze(0).to(device)},  # (1, 3, 3)
+                'camera_info_l': {'K': torch.as_tensor(np.asarray(reference['camera_info_l']['K'])).unsqueeze(0).to(device)},  # (1, 3, 3)
+            }
+        return self._reference_tensors[cache_key]
 
     def _upsample_sample(self, sample):
         # Upsample output
         sample_up = self.block_upsample_tr(sample)
         return sample_up
 
-    def _estimate_object_pose(self, batched_sample_raw):
-        batched_sample = self._upsample_sample(batched_sample_raw)
+    def _estimate_object_pose(self, batched_sample_raw, init_pose=None):
+        with profile_span('imprint_upsampling'):
+            batched_sample = self._upsample_sample(batched_sample_raw)
         all_tfs = batched_sample['all_tfs']
 
         # Get imprints from sample
@@ -167,16 +227,18 @@ class BatchedModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimat
         imprint_frame_r = 'pico_flexx_right_optical_frame'
         imprint_frame_l = 'pico_flexx_left_optical_frame'
 
-        depth_ref_r = batched_sample['undef_depth_r'].squeeze(-1)  # (N, w, h)
-        depth_ref_l = batched_sample['undef_depth_l'].squeeze(-1)  # (N, w, h)
+        reference = self._get_batched_reference(batched_sample, batch_size=predicted_imprint.shape[0], device=predicted_imprint.device)
+        depth_ref_r = reference['undef_depth_r'].squeeze(-1)  # (N, w, h)
+        depth_ref_l = reference['undef_depth_l'].squeeze(-1)  # (N, w, h)
         depth_def_r = depth_ref_r - imprint_pred_r  # CAREFUL: Imprint is defined as undef_depth_img - def_depth_img
         depth_def_l = depth_ref_l - imprint_pred_l  # CAREFUL: Imprint is defined as undef_depth_img - def_depth_img
 
         # Project imprints to get point coordinates
-        Ks_r = batched_sample['camera_info_r']['K']
-        Ks_l = batched_sample['camera_info_l']['K']
-        pc_r = project_depth_image(depth_def_r, Ks_r)  # (N, w, h, n_coords) -- n_coords=3
-        pc_l = project_depth_image(depth_def_l, Ks_l)  # (N, w, h, n_coords) -- n_coords=3
+        Ks_r = reference['camera_info_r']['K']
+        Ks_l = reference['camera_info_l']['K']
+        with profile_span('depth_unprojection'):
+            pc_r = project_depth_image(depth_def_r, Ks_r)  # (N, w, h, n_coords) -- n_coords=3
+            pc_l = project_depth_image(depth_def_l, Ks_l)  # (N, w, h, n_coords) -- n_coords=3
 
         # Convert imprint point coordinates to grasp frame
         gf_X_ifr = self._get_transformation_matrix(all_tfs, 'grasp_frame', imprint_frame_r)
@@ -188,37 +250,40 @@ class BatchedModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimat
                                 gf_X_ifl[..., :3, 3]).view(pc_shape)
         pc_gf = torch.stack([pc_r_gf, pc_l_gf], dim=1)  # (N, n_impr, w, h, n_coords)
 
-        # Load object model model
-        model_pc = np.asarray(self.model_pcs[self.object_name].points)
-        model_pc = torch.tensor(model_pc).to(predicted_imprint.device)
-
         # Project points to 2d
-        projection_axis = (1, 0, 0)
-        projection_tr = torch.tensor(get_projection_tr(projection_axis))  # (4,4)
-        pc_gf_projected = project_pc(pc_gf, projection_axis)  # (N, n_impr, w, h, n_coords)
+        pc_gf_projected = project_pc(pc_gf, self.projection_axis)  # (N, n_impr, w, h, n_coords)
         pc_gf_2d = pc_gf_projected[..., :2]  # only 2d coordinates
-        pc_model_projected = project_pc(model_pc, projection_axis).unsqueeze(0).repeat_interleave(pc_gf.shape[0], dim=0)
 
         # Apply ICP 2d
-        num_iterations = 20
         pc_scene = pc_gf_2d  # pc_scene: (N, n_impr, w, h, n_coords)
         # Compute mask -- filter out points
         depth_ref = torch.stack([depth_ref_r, depth_ref_l], dim=1)  # (N, n_impr, w, h)
         depth_def = torch.stack([depth_def_r, depth_def_l], dim=1)  # (N, n_impr, w, h)
-        pc_scene_mask = self._get_pc_mask(depth_def, depth_ref)
+        pixel_mask = None
+        if self.cone_filter:
+            pixel_mask = self._get_cone_filter_pixel_mask(Ks_r, Ks_l, depth_ref.shape[-2:], device=depth_ref.device)  # (n_impr, w, h)
+        pc_scene_mask = self._get_pc_mask(depth_def, depth_ref, pixel_mask=pixel_mask)
         pc_scene_mask = pc_scene_mask.unsqueeze(-1).repeat_interleave(2, dim=-1)  # (N, n_impr, w, h, n_coords)
-        pc_model_projected_2d = pc_model_projected[..., :2]  # pc_model: (N, n_model_points, n_coords)
 
         # Apply ICP:
         device = self.device
-        pc_model_projected_2d = self._filter_model_pc(pc_model_projected_2d)
+        pc_model_projected_2d = self._get_projected_model_pc(self.object_name, device=device, dtype=torch.float)  # (1, n_model_points, n_coords)
+        pc_model_projected_2d = pc_model_projected_2d.expand(pc_gf.shape[0], -1, -1)  # pc_model: (N, n_model_points, n_coords) -- broadcasted, not copied
         pc_scene, pc_scene_mask = self._filter_scene_pc(pc_scene, pc_scene_mask)
         # print(torch.sum(pc_scene_mask.reshape(pc_scene_mask.shape[0], -1), dim=1)) # report number of points per scene
-        pc_model_projected_2d = pc_model_projected_2d.type(torch.float).to(device)  # This call takes almost 2 sec
         pc_scene = pc_scene.type(torch.float).to(device)
         pc_scene_mask = pc_scene_mask.to(device)
 
-        Rs, ts = icp_2d_masked(pc_model_projected_2d, pc_scene, pc_scene_mask, num_iter=num_iterations)
+        R_init, t_init = self._get_icp_init(init_pose, pc_scene.shape[0], device=device, dtype=pc_scene.dtype)
+        with profile_span('icp'):
+            if self.icp_tolerance is None:
+                Rs, ts = icp_2d_masked(pc_model_projected_2d, pc_scene, pc_scene_mask, num_iter=self.num_icp_iterations,
+                                       memory_budget=self.icp_memory_budget, R_init=R_init, t_init=t_init)
+            else:
+                Rs, ts, self.last_icp_info = icp_2d_masked(pc_model_projected_2d, pc_scene, pc_scene_mask,
+                                                           num_iter=self.num_icp_iterations, tolerance=self.icp_tolerance,
+                                                           return_info=True, memory_budget=self.icp_memory_budget,
+                                                           R_init=R_init, t_init=t_init)
         Rs = Rs.cpu()
         ts = ts.cpu()
         # Obtain object pose in grasp frame
@@ -227,15 +292,40 @@ class BatchedModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimat
         projected_ic_tr[..., :2, 3] = ts
         projected_ic_tr[..., 2, 2] = 1
         projected_ic_tr[..., 3, 3] = 1
-        projection_tr = projection_tr.type(torch.float)
-        unproject_tr = torch.linalg.inv(projection_tr)
-        gf_X_objpose = torch.einsum('ji,kil->kjl', unproject_tr,
-                                    torch.einsum('kij,jl->kil', projected_ic_tr, projection_tr))
+        gf_X_objpose = torch.einsum('ji,kil->kjl', self.unproject_tr,
+                                    torch.einsum('kij,jl->kil', projected_ic_tr, self.projection_tr))
         return gf_X_objpose
 
+    def _get_icp_init(self, init_pose, batch_size, device, dtype):
+        """
+        Project the init_pose to the 2d space where the ICP is solved
+        :param init_pose: (4, 4) or (N, 4, 4) object pose on the grasp frame. If None, the ICP starts at the mean of the scene
+        :return: R_init (N, 2, 2), t_init (N, 2). None, None if there is no init_pose
+        """
+        if init_pose is None:
+            return None, None
+        gf_X_objpose = torch.as_tensor(np.asarray(init_pose) if not torch.is_tensor(init_pose) else init_pose).type(torch.float)
+        projected_init_tr = self.projection_tr @ gf_X_objpose.cpu() @ self.unproject_tr  # (4, 4) or (N, 4, 4)
+        R_init = projected_init_tr[..., :2, :2].reshape(-1, 2, 2).expand(batch_size, -1, -1)
+        t_init = projected_init_tr[..., :2, 3].reshape(-1, 2).expand(batch_size, -1)
+        return R_init.to(device=device, dtype=dtype).contiguous(), t_init.to(device=device, dtype=dtype).contiguous()
+
+    def _get_projected_model_pc(self, object_name, device, dtype):
+        """
+        Return the object model projected to 2d. It is computed only once for each configuration and then cached.
+        :return: projected model (1, num_model_points, 2)
+        """
+        cache_key = (object_name, self.projection_axis, device, dtype, self.model_downsample)
+        if cache_key not in self._projected_model_pcs:
+            model_pc = torch.tensor(np.asarray(self.model_pcs[object_name].points))  # (num_model_points, 3)
+            pc_model_projected = project_pc(model_pc, self.projection_axis).unsqueeze(0)  # (1, num_model_points, 3)
+            pc_model_projected_2d = self._filter_model_pc(pc_model_projected[..., :2])
+            self._projected_model_pcs[cache_key] = pc_model_projected_2d.type(dtype).to(device).contiguous()
+        return self._projected_model_pcs[cache_key]
+
     def _filter_model_pc(self, model_pc):
         # model_pc (N, num_model_points, space_dim)
-        model_pc = model_pc[:, ::20, :] # TODO: Find a better way to downsample the model
+        model_pc = model_pc[:, ::self.model_downsample, :] # TODO: Find a better way to downsample the model
         return model_pc
 
     def _filter_scene_pc(self, pc_scene, pc_scene_mask):
@@ -258,15 +348,29 @@ class BatchedModelOutputObjectPoseEstimation(BatchedModelOutputObjectPoseEstimat
 
         return pc_scene, pc_scene_mask
 
-    def _get_pc_mask(self, depth_def, depth_ref):
+    def _get_cone_filter_pixel_mask(self, Ks_r, Ks_l, img_shape, device):
+        # The cameras intrinsics are the same for all the batch, so we use the first ones. Masks are precomputed per camera.
+        pixel_mask_r = get_cone_filter_pixel_mask(Ks_r[0].detach().cpu().numpy(), img_shape)
+        pixel_mask_l = get_cone_filter_pixel_mask(Ks_l[0].detach().cpu().numpy(), img_shape)
+        pixel_mask = torch.from_numpy(np.stack([pixel_mask_r, pixel_mask_l], axis=0)).to(device)  # (n_impr, w, h)
+        return pixel_mask
+
+    def _get_pc_mask(self, depth_def, depth_ref, pixel_mask=None):
         # depth_def: (N, n_impr, w, h)
         # depth_ref: (N, n_impr, w, h)
+        # pixel_mask: (n_impr, w, h) pixels that can be selected (None: all)
         if self.imprint_selection == 'threshold':
             imprint_threshold = self.imprint_threshold
             pc_scene_mask = torch.tensor(get_imprint_mask(depth_ref, depth_def, imprint_threshold))
+            if pixel_mask is not None:
+                pc_scene_mask = pc_scene_mask * pixel_mask.to(pc_scene_mask.device)
         elif self.imprint_selection == 'percentile':
             # select the points with larger deformation. In total will select top self.imprint_percentile*100%
-            delta_depth = einops.rearrange(depth_ref - depth_def, 'N n w h -> N (n w h)')
+            delta_depth = depth_ref - depth_def
+            if pixel_mask is not None:
+                # pixels out of the view cone are never selected
+                delta_depth = delta_depth.masked_fill(~pixel_mask.to(delta_depth.device), -float('inf'))
+            delta_depth = einops.rearrange(delta_depth, 'N n w h -> N (n w h)')
             num_points = np.prod(depth_def.shape[1:])
             k = int(np.floor(self.imprint_percentile * num_points))
             top_k_vals, top_k_indxs = torch.topk(delta_depth, k, dim=1)
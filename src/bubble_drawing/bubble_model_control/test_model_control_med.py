@@ -14,7 +14,9 @@ from bubble_drawing.bubble_envs.bubble_drawing_env import BubbleOneDirectionDraw
 from bubble_drawing.bubble_model_control.drawing_action_models import drawing_action_model_one_dir
 from bubble_drawing.bubble_learning.aux.load_model import load_model_version
 from bubble_drawing.bubble_model_control.aux.format_observation import format_observation_sample
+from bubble_drawing.bubble_learning.aux.reference_frame_store import ReferenceFrameStore
 from bubble_drawing.bubble_model_control.cost_functions import vertical_tool_cost_function
+from bubble_drawing.bubble_pose_estimation.tool_pose_tracker import ToolPoseTracker
 from victor_hardware_interface_msgs.msg import ControlMode
 
 
@@ -58,17 +60,21 @@ if __name__ == '__main__':
     ope = BatchedModelOutputObjectPoseEstimation(object_name=object_name, factor_x=7, factor_y=7, method='bilinear', device=torch.device('cuda'), imprint_selection='percentile', imprint_percentile=0.005) #percentile
 
 
-    controller = BubbleModelMPPIBatchedController(model, env, ope, vertical_tool_cost_function, action_model=drawing_action_model_one_dir, num_samples=num_samples, horizon=horizon, noise_sigma=None, _noise_sigma_value=.3)
+    reference_store = ReferenceFrameStore() # the reference only changes when the env re-references the bubbles
+    pose_tracker = ToolPoseTracker(action_model=drawing_action_model_one_dir) # warm-starts the ICP with the pose predicted from the last action
+    controller = BubbleModelMPPIBatchedController(model, env, ope, vertical_tool_cost_function, action_model=drawing_action_model_one_dir, num_samples=num_samples, horizon=horizon, noise_sigma=None, _noise_sigma_value=.3,
+                                                  pose_tracker=pose_tracker)
 
 
     # +++++++++++++++++++++++
     # DRAWING FUNCTION
     def draw_steps(num_steps):
+        controller.reset() # new drawing, do not warm-start from the previous one
         init_obs_sample = env.get_observation()
         obs_sample_raw = init_obs_sample.copy()
         for i in range(num_steps):
             action, valid_action = env.get_action()  # this is to get the action container to fill and therefore get the correct format.
-            obs_sample = format_observation_sample(obs_sample_raw)
+            obs_sample = format_observation_sample(obs_sample_raw, reference_store=reference_store)
             obs_sample = block_downsample_tr(obs_sample) # Downsample the sample
             if not random_action:
                 action_raw = controller.control(obs_sample).detach().cpu().numpy()
@@ -102,12 +108,13 @@ if __name__ == '__main__':
             env.med.set_control_mode(ControlMode.JOINT_POSITION, vel=0.1)
             env.med.rotation_along_axis_point_angle(axis=np.array([0, 0, 1]), point=current_planar_pos, angle=diff_angle, num_steps=1)
             env._set_cartesian_impedance()
+            controller.reset() # the tool pose prediction does not account for the reorientation
 
         init_obs_sample = env.get_observation()
         obs_sample_raw = init_obs_sample.copy()
         for i in range(max_num_steps):
             action, valid_action = env.get_action()  # this is to get the action container to fill and therefore get the correct format.
-            obs_sample = format_observation_sample(obs_sample_raw)
+            obs_sample = format_observation_sample(obs_sample_raw, reference_store=reference_store)
             obs_sample = block_downsample_tr(obs_sample)  # Downsample the sample
             if not random_action:
                 action_raw = controller.control(obs_sample).detach().cpu().numpy()
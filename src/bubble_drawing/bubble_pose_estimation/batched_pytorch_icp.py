@@ -3,31 +3,140 @@ import numpy as np
 from tqdm import tqdm
 
 
-def icp_2d_masked(pc_model, pc_scene, pc_scene_mask, num_iter=30):
+def icp_2d_masked(pc_model, pc_scene, pc_scene_mask, num_iter=30, tolerance=None, return_info=False, memory_budget=None, R_init=None, t_init=None,
+                  max_correspondence_distance=None):
     # ICP 2D:
     # pc_scene: (N, n_points, n_coords)
     # pc_scene_mask: (N, n_points, n_coords)
     # pc_model: (N, n_model_points, n_coords)
+    # tolerance: if provided, num_iter becomes the maximum number of iterations. Samples whose change on (R, t) is
+    #   smaller than tolerance are considered converged and removed from the following iterations.
+    # return_info: if True, also return a dict with the number of iterations per sample and their final residuals.
+    # memory_budget: maximum number of bytes for the correspondence distance tensors (None: no limit).
+    # R_init: (N, n_coords, n_coords) initial rotations (warm-start). Default: identity
+    # t_init: (N, n_coords) initial translations (warm-start). Default: mean of the scene
+    # max_correspondence_distance: if provided, scene points farther than it from their closest model point are ignored
+    #   on each step (as the Open3D ICP threshold). Default: all masked scene points are used
 
     N, n_points, n_coords = pc_scene.shape
     if len(pc_scene_mask.shape) == len(pc_scene_mask.shape)-1:
         pc_scene_mask = pc_scene_mask.unsqueeze(-1).repeat_interleave(n_coords, dim=-1)  # (N, n_scene_points, n_coords)
 
-    R_init = torch.eye(n_coords, device=pc_scene.device, dtype=pc_scene.dtype).unsqueeze(0).repeat_interleave(N, dim=0)  # (N, num_dims, num_dims)--- init all R as identyty
-    t_init = masked_tensor_mean(pc_scene.transpose(1, 2), pc_scene_mask.transpose(1, 2),
-                                start_dim=-1)  # mean of the scene
+    if R_init is None:
+        R_init = torch.eye(n_coords, device=pc_scene.device, dtype=pc_scene.dtype).unsqueeze(0).repeat_interleave(N, dim=0)  # (N, num_dims, num_dims)--- init all R as identyty
+    if t_init is None:
+        t_init = masked_tensor_mean(pc_scene.transpose(1, 2), pc_scene_mask.transpose(1, 2),
+                                    start_dim=-1)  # mean of the scene
 
-    R, t = R_init, t_init
-    for i in range(num_iter):
-        R, t = icp_2d_maksed_step(pc_model, pc_scene, pc_scene_mask, R_init, t_init)
+    if tolerance is None:
+        R, t = R_init, t_init
+        for i in range(num_iter):
+            R, t = icp_2d_maksed_step(pc_model, pc_scene, pc_scene_mask, R_init, t_init, memory_budget=memory_budget,
+                                      max_correspondence_distance=max_correspondence_distance)
 
-        R_init = R
-        t_init = t
+            R_init = R
+            t_init = t
+        num_iterations = torch.full((N,), num_iter, dtype=torch.long, device=pc_scene.device)
+    else:
+        R, t, num_iterations = icp_2d_masked_until_converged(pc_model, pc_scene, pc_scene_mask, R_init, t_init,
+                                                             max_iter=num_iter, tolerance=tolerance,
+                                                             memory_budget=memory_budget,
+                                                             max_correspondence_distance=max_correspondence_distance)
     # R: (N, n_coords, n_coords)
     # t: (N, n_coords)
+    if return_info:
+        info = {
+            'num_iterations': num_iterations,  # (N,)
+            'residuals': compute_masked_residuals(pc_model, pc_scene, pc_scene_mask, R, t, memory_budget=memory_budget),  # (N,)
+        }
+        return R, t, info
     return R, t
 
 
+# icp_2d_masked works for any number of coordinates (n_coords); the name only refers to its first use (planar ICP)
+icp_masked = icp_2d_masked
+
+
+def icp_2d_masked_until_converged(pc_model, pc_scene, pc_scene_mask, R_init, t_init, max_iter=30, tolerance=1e-6, memory_budget=None,
+                                  max_correspondence_distance=None):
+    """
+    Run the masked ICP steps only on the samples that have not converged yet.
+    A sample is converged when the change of its transformation between two consecutive steps
+    (||R_new - R||_F + ||t_new - t||) is smaller than tolerance.
+    :param pc_model: (N, n_model_points, n_coords)
+    :param pc_scene: (N, n_scene_points, n_coords)
+    :param pc_scene_mask: (N, n_scene_points, n_coords)
+    :param R_init: (N, n_coords, n_coords)
+    :param t_init: (N, n_coords)
+    :param memory_budget: maximum number of bytes for the correspondence distance tensors (None: no limit)
+    :param max_correspondence_distance: maximum distance of the correspondences used on each step (None: no limit)
+    :return: R (N, n_coords, n_coords), t (N, n_coords), num_iterations (N,) number of steps applied to each sample
+    """
+    N = pc_scene.shape[0]
+    R = R_init.clone()
+    t = t_init.clone()
+    num_iterations = torch.zeros(N, dtype=torch.long, device=pc_scene.device)
+    active_idxs = torch.arange(N, device=pc_scene.device)
+    for i in range(max_iter):
+        if active_idxs.shape[0] == 0:
+            break  # all samples have converged
+        R_a = R[active_idxs]
+        t_a = t[active_idxs]
+        R_new, t_new = icp_2d_maksed_step(pc_model[active_idxs], pc_scene[active_idxs], pc_scene_mask[active_idxs], R_a, t_a,
+                                          memory_budget=memory_budget, max_correspondence_distance=max_correspondence_distance)
+        delta = torch.linalg.norm((R_new - R_a).flatten(start_dim=1), dim=-1) + torch.linalg.norm(t_new - t_a, dim=-1)
+        R[active_idxs] = R_new
+        t[active_idxs] = t_new
+        num_iterations[active_idxs] += 1
+        # samples with non-finite transforms (e.g. empty scenes) will not improve, so we also stop them.
+        converged = (delta <= tolerance) | ~torch.isfinite(delta)
+        active_idxs = active_idxs[~converged]
+    return R, t, num_iterations
+
+
+def compute_masked_residuals(pc_model, pc_scene, pc_scene_mask, R, t, memory_budget=None):
+    """
+    Mean squared distance between the masked scene points and their closest point on the transformed model.
+    :param pc_model: (N, n_model_points, n_coords)
+    :param pc_scene: (N, n_scene_points, n_coords)
+    :param pc_scene_mask: (N, n_scene_points, n_coords)
+    :param R: (N, n_coords, n_coords)
+    :param t: (N, n_coords)
+    :param memory_budget: maximum number of bytes for the correspondence distance tensors (None: no limit)
+    :return: residuals (N,)
+    """
+    pc_model_tr = pc_batched_tr(pc_model, R, t)
+    batch_idxs, corr_indxs = estimate_correspondences_batched(pc_model_tr, pc_scene, pc_scene_mask, memory_budget=memory_budget)
+    sq_dists = torch.sum((pc_model_tr[batch_idxs, corr_indxs, :] - pc_scene) ** 2 * pc_scene_mask, dim=-1)  # (N, n_scene_points)
+    num_points = torch.sum(pc_scene_mask[..., 0], dim=-1)
+    residuals = torch.sum(sq_dists, dim=-1) / num_points
+    return residuals
+
+
+def compute_masked_fitness(pc_model, pc_scene, pc_scene_mask, R, t, threshold, memory_budget=None):
+    """
+    Registration quality (as Open3D fitness and inlier_rmse) measured on the masked scene points.
+    :param pc_model: (N, n_model_points, n_coords)
+    :param pc_scene: (N, n_scene_points, n_coords)
+    :param pc_scene_mask: (N, n_scene_points, n_coords)
+    :param R: (N, n_coords, n_coords)
+    :param t: (N, n_coords)
+    :param threshold: maximum distance between a scene point and its closest model point to be considered an inlier
+    :param memory_budget: maximum number of bytes for the correspondence distance tensors (None: no limit)
+    :return: fitness (N,) fraction of inlier scene points, inlier_rmse (N,) rmse of the inlier scene points
+    """
+    pc_model_tr = pc_batched_tr(pc_model, R, t)
+    batch_idxs, corr_indxs = estimate_correspondences_batched(pc_model_tr, pc_scene, pc_scene_mask, memory_budget=memory_budget)
+    sq_dists = torch.sum((pc_model_tr[batch_idxs, corr_indxs, :] - pc_scene) ** 2, dim=-1)  # (N, n_scene_points)
+    mask = pc_scene_mask[..., 0].to(torch.bool)
+    inliers = (sq_dists <= threshold ** 2) & mask
+    num_points = torch.sum(mask, dim=-1)
+    num_inliers = torch.sum(inliers, dim=-1)
+    fitness = num_inliers / num_points
+    inlier_rmse = torch.sqrt(torch.sum(sq_dists * inliers, dim=-1) / torch.clamp(num_inliers, min=1))
+    return fitness, inlier_rmse
+
+
 def icp_2d_masked_imprints(pc_model, pc_scene, pc_scene_mask, num_iter=30):
     # ICP 2D:
     # pc_scene: (N, n_impr, w, h, n_coords)
@@ -44,23 +153,37 @@ def icp_2d_masked_imprints(pc_model, pc_scene, pc_scene_mask, num_iter=30):
     return R, t
 
 
-def icp_2d_maksed_step(pc_model, pc_scene, pc_scene_mask, R_init, t_init):
+def icp_2d_maksed_step(pc_model, pc_scene, pc_scene_mask, R_init, t_init, memory_budget=None, max_correspondence_distance=None):
     # pc_model, shape (N, n_model_points, n_coords)
     # pc_scene, shape (N, n_scene_points, n_coords)
     # pc_scene_mask, shape (N, n_scene_points, n_coords) *** Here n_coords dimension is just repeated
     # t_init: (N, n_coords)
     # R_init: (N, n_coords, n_coords)
+    # memory_budget: maximum number of bytes for the correspondence distance tensors (None: no limit)
+    # max_correspondence_distance: scene points farther than it from their correspondence are not used (None: no limit).
+    #   Samples without any correspondence keep (R_init, t_init)
     # -------------------
     # transform init:
     pc_model_tr = pc_batched_tr(pc_model, R_init, t_init)
 
     # Estimate correspondences (only masked):
     # compute distances and get minimums
-    batch_idxs, corr_indxs = estimate_correspondences_batched(pc_model_tr, pc_scene, pc_scene_mask)
+    batch_idxs, corr_indxs = estimate_correspondences_batched(pc_model_tr, pc_scene, pc_scene_mask, memory_budget=memory_budget)
     pc_model_selected = pc_model[batch_idxs, corr_indxs, :]
+    if max_correspondence_distance is not None:
+        # reject the far correspondences
+        sq_dists = torch.sum((pc_model_tr[batch_idxs, corr_indxs, :] - pc_scene) ** 2, dim=-1)  # (N, n_scene_points)
+        inliers = (sq_dists <= max_correspondence_distance ** 2).unsqueeze(-1)  # (N, n_scene_points, 1)
+        pc_scene_mask = pc_scene_mask * inliers
+        has_correspondences = torch.any(pc_scene_mask.flatten(start_dim=1) != 0, dim=-1)  # (N,)
+        # samples without correspondences use all the points so the transform is finite, and it is discarded below
+        pc_scene_mask = torch.where(has_correspondences.unsqueeze(-1).unsqueeze(-1), pc_scene_mask, torch.ones_like(pc_scene_mask))
 
     # Compute new transform
     R_star, t_star = find_best_transform_batched_masked(pc_model_selected, pc_scene, pc_scene_mask)
+    if max_correspondence_distance is not None:
+        R_star = torch.where(has_correspondences.unsqueeze(-1).unsqueeze(-1), R_star, R_init)
+        t_star = torch.where(has_correspondences.unsqueeze(-1), t_star, t_init)
 
     return R_star, t_star
 
@@ -93,30 +216,68 @@ def reshape_pc(pc):
     return pc_r
 
 
-def estimate_correspondences_batched(a1, a2, a2_mask):
+def estimate_correspondences_batched(a1, a2, a2_mask, memory_budget=None):
     """
     Return for each point in the scene (a2) the closest point in the model (a1)
     :param a1: (N, n_1_points, n_coords) -- model
     :param a2: (N, n_2_points, n_coords) -- scene
     :param a2_mask: (N, n_2_points, n_coords)
+    :param memory_budget: maximum number of bytes to be used by the distance tensors. If provided, the scene points are
+        processed in chunks so we never build the full (N, n_2_points, n_1_points) distance tensor.
     :return: tensor containing the correspndent model points for each scene points (N, n_2_points, n_coords)
     """
     # Compute distances
     N1, n_1_points, n_coords_1 = a1.shape
     N2, n_2_points, n_coords_2 = a2.shape
 
-    dists = (torch.sum((a1 ** 2), dim=-1).unsqueeze(-1) -
-             torch.bmm(a1, a2.transpose(1, 2)) * 2 +
-             torch.sum((a2 ** 2), dim=-1).unsqueeze(-2)).transpose(1, 2)
+    if memory_budget is None:
+        dists = (torch.sum((a1 ** 2), dim=-1).unsqueeze(-1) -
+                 torch.bmm(a1, a2.transpose(1, 2)) * 2 +
+                 torch.sum((a2 ** 2), dim=-1).unsqueeze(-2)).transpose(1, 2)
 
-    # Get clossest point indxs
-    corr_indxs = torch.argmin(dists, axis=-1)  # get a1 index that minimizes distance to a2
+        # Get clossest point indxs
+        corr_indxs = torch.argmin(dists, axis=-1)  # get a1 index that minimizes distance to a2
+    else:
+        corr_indxs = _estimate_correspondence_indxs_chunked(a1, a2, memory_budget)
 
     # Apply correspondences
-    batch_idxs = torch.arange(0, corr_indxs.shape[0]).unsqueeze(-1).repeat_interleave(n_2_points, dim=-1)
+    batch_idxs = torch.arange(0, corr_indxs.shape[0], device=corr_indxs.device).unsqueeze(-1).repeat_interleave(n_2_points, dim=-1)
     return batch_idxs, corr_indxs
 
 
+def _estimate_correspondence_indxs_chunked(a1, a2, memory_budget):
+    # a1: (N, n_1_points, n_coords) -- model
+    # a2: (N, n_2_points, n_coords) -- scene
+    # Same distance computation as in estimate_correspondences_batched but tiled along the scene points.
+    N2, n_2_points, n_coords_2 = a2.shape
+    chunk_size = get_correspondence_chunk_size(a1, n_2_points, memory_budget)
+    a1_sq = torch.sum((a1 ** 2), dim=-1).unsqueeze(-1)  # (N, n_1_points, 1)
+    corr_indxs = torch.empty((N2, n_2_points), dtype=torch.long, device=a2.device)
+    for start_i in range(0, n_2_points, chunk_size):
+        a2_i = a2[:, start_i:start_i + chunk_size]  # (N, chunk_size, n_coords)
+        dists_i = (a1_sq -
+                   torch.bmm(a1, a2_i.transpose(1, 2)) * 2 +
+                   torch.sum((a2_i ** 2), dim=-1).unsqueeze(-2)).transpose(1, 2)  # (N, chunk_size, n_1_points)
+        corr_indxs[:, start_i:start_i + chunk_size] = torch.argmin(dists_i, axis=-1)
+    return corr_indxs
+
+
+def get_correspondence_chunk_size(a1, n_2_points, memory_budget):
+    """
+    Number of scene points that can be processed at once without exceeding the memory budget.
+    :param a1: (N, n_1_points, n_coords) -- model
+    :param n_2_points: number of scene points
+    :param memory_budget: maximum number of bytes to be used by the distance tensors
+    :return: chunk size (at least 1 point)
+    """
+    N1, n_1_points, n_coords_1 = a1.shape
+    # Computing the distances allocates ~3 tensors of shape (N, n_1_points, chunk_size) (product, sums and transposed result)
+    bytes_per_scene_point = 3 * N1 * n_1_points * a1.element_size()
+    chunk_size = int(memory_budget // max(bytes_per_scene_point, 1))
+    chunk_size = min(max(chunk_size, 1), n_2_points)
+    return chunk_size
+
+
 def find_best_transform_batched_masked(pc_model, pc_scene, pc_mask):
     # pc_model: (N, n_scene_points, n_coords) -- model
     # pc_scene: (N, n_scene_points, n_coords) -- scene
@@ -135,7 +296,7 @@ def find_best_transform_batched_masked(pc_model, pc_scene, pc_mask):
     U, S, Vh = torch.linalg.svd(W)
     R = U @ Vh
     detR = torch.det(R)  # (N,)
-    Vh[:, -1] = Vh[:, -1] * torch.stack([detR] * 2, dim=-1)
+    Vh[:, -1] = Vh[:, -1] * detR.unsqueeze(-1) # avoid reflections (valid for any n_coords)
     R_star = U @ Vh
     t_star = mu_s - torch.einsum('kij,kj->ki', R_star, mu_m)
     return R_star, t_star
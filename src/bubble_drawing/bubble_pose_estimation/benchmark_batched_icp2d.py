@@ -0,0 +1,54 @@
+import time
+import numpy as np
+import tf.transformations as tr
+from mmint_camera_utils.camera_utils.point_cloud_utils import pack_o3d_pcd
+
+from bubble_drawing.bubble_pose_estimation.pose_estimators import ICP2DPoseEstimator
+
+
+def get_marker_model(num_points=2000, radius=0.005, height=0.12):
+    # points on the surface of a cylinder aligned with the z axis
+    angles = np.random.uniform(0, 2 * np.pi, num_points)
+    zs = np.random.uniform(-0.5 * height, 0.5 * height, num_points)
+    model_points = np.stack([radius * np.cos(angles), radius * np.sin(angles), zs], axis=-1)
+    model = np.concatenate([model_points, np.zeros_like(model_points)], axis=-1)
+    return model
+
+
+def get_scenes(model, num_scenes, projection_axis, min_num_points=100, max_num_points=800, noise=0.0005):
+    # partial observations of the model after a random rotation about the projection axis
+    scenes = []
+    for i in range(num_scenes):
+        angle_i = np.random.uniform(-np.pi * 0.25, np.pi * 0.25)
+        X_i = tr.quaternion_matrix(tr.quaternion_about_axis(angle_i, projection_axis))
+        X_i[:3, 3] = np.random.uniform(-0.01, 0.01, 3)
+        num_points_i = np.random.randint(min_num_points, max_num_points)
+        points_i = model[np.random.choice(len(model), num_points_i, replace=False), :3]
+        points_i = points_i @ X_i[:3, :3].T + X_i[:3, 3] + noise * np.random.randn(num_points_i, 3)
+        scene_i = np.concatenate([points_i, np.zeros_like(points_i)], axis=-1)
+        scenes.append(scene_i)
+    return scenes
+
+
+if __name__ == '__main__':
+    projection_axis = np.array([1, 0, 0])
+    num_scenes_list = [1, 10, 100, 500]
+    model = get_marker_model()
+    pose_estimator = ICP2DPoseEstimator(obj_model=pack_o3d_pcd(model), projection_axis=projection_axis, max_num_iterations=20)
+
+    print('{:>10} {:>14} {:>14} {:>10} {:>14}'.format('num_scenes', 'loop (s)', 'batched (s)', 'speedup', 'max pose diff'))
+    for num_scenes in num_scenes_list:
+        scenes = get_scenes(model, num_scenes, projection_axis)
+        start_time = time.time()
+        poses_loop = []
+        for scene_i in scenes:
+            pose_estimator.last_tr = None
+            poses_loop.append(pose_estimator.estimate_pose(scene_i))
+        loop_time = time.time() - start_time
+
+        pose_estimator.last_tr = None
+        start_time = time.time()
+        poses_batched = pose_estimator.estimate_poses(scenes)
+        batched_time = time.time() - start_time
+        max_diff = np.max([np.max(np.abs(p_l - p_b)) for p_l, p_b in zip(poses_loop, poses_batched)])
+        print('{:>10} {:>14.4f} {:>14.4f} {:>10.2f} {:>14.2e}'.format(num_scenes, loop_time, batched_time, loop_time / batched_time, max_diff))
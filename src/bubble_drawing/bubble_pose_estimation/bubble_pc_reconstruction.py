@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
 
 import rospy
+import copy
+import time
+import threading
 import numpy as np
 from scipy.spatial import KDTree
 import tf.transformations as tr
 import tf2_ros as tf2
-from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 import abc
 
 import sensor_msgs.point_cloud2 as pc2
@@ -16,10 +19,12 @@ from geometry_msgs.msg import TransformStamped
 from mmint_camera_utils.camera_utils.point_cloud_utils import pack_o3d_pcd, view_pointcloud, tr_pointcloud
 from bubble_utils.bubble_parsers.bubble_parser import BubbleParser
 from bubble_utils.bubble_tools.bubble_pc_tools import get_imprint_pc
-from bubble_drawing.bubble_pose_estimation.pose_estimators import ICP3DPoseEstimator, ICP2DPoseEstimator
+from bubble_drawing.bubble_pose_estimation.pose_estimators import ICP3DPoseEstimator, MultiHypothesisICP3DPoseEstimator, ICP2DPoseEstimator
+from bubble_drawing.bubble_pose_estimation.cone_filter import get_cone_filter_normals, get_cone_filter_mask, get_cone_filter_pixel_mask
 from mmint_camera_utils.ros_utils.publisher_wrapper import PublisherWrapper
 from mmint_utils.terminal_colors import term_colors
 from bubble_drawing.aux.load_confs import load_object_models
+from bubble_drawing.aux.latency_profiler import profile_span
 
 
 class BubblePCReconstructorBase(abc.ABC):
@@ -27,9 +32,10 @@ class BubblePCReconstructorBase(abc.ABC):
     Gets Imprint and estimates the object pose from it
     """
 
-    def __init__(self, reconstruction_frame='grasp_frame', threshold=0.005, percentile=None, object_name='allen', estimation_type='icp3d', view=False, verbose=False):
+    def __init__(self, reconstruction_frame='grasp_frame', threshold=0.005, percentile=None, object_name='allen', estimation_type='icp3d', icp_tolerance=None, view=False, verbose=False):
         self.object_name = object_name
         self.estimation_type = estimation_type
+        self.icp_tolerance = icp_tolerance # icp2d early stop. Set it when the ICP is warm-started (e.g. with a ToolPoseTracker)
         self.reconstruction_frame = reconstruction_frame
         self.threshold = threshold
         self.percentile = percentile
@@ -43,10 +49,12 @@ class BubblePCReconstructorBase(abc.ABC):
         }
         self.radius = 0.005
         self.height = 0.12
+        self.filter_normals = get_cone_filter_normals() # (3, 4) they do not change, so compute them only once
         self.object_model = self._get_object_model()
         self.pose_estimator = self._get_pose_estimator()
         self.tool_detected_publisher = PublisherWrapper(topic_name='tool_detected', msg_type=Bool)
         self.last_tr = None
+        self.tool_detection_latency = None # time (s) spent on the last tool detection
 
     @abc.abstractmethod
     def reference(self):
@@ -65,84 +73,83 @@ class BubblePCReconstructorBase(abc.ABC):
 
     def _get_pose_estimator(self):
         pose_estimator = None
-        available_esttimation_types = ['icp3d', 'icp2d']
+        available_esttimation_types = ['icp3d', 'icp3d_multi', 'icp2d']
         if self.estimation_type == 'icp3d':
             pose_estimator = ICP3DPoseEstimator(obj_model=self.object_model, view=self.view)
+        elif self.estimation_type == 'icp3d_multi':
+            pose_estimator = MultiHypothesisICP3DPoseEstimator(obj_model=self.object_model, view=self.view)
         elif self.estimation_type == 'icp2d':
-            pose_estimator = ICP2DPoseEstimator(obj_model=self.object_model, projection_axis=(1,0,0), max_num_iterations=20, view=self.view)
+            pose_estimator = ICP2DPoseEstimator(obj_model=self.object_model, projection_axis=(1,0,0), max_num_iterations=20, tolerance=self.icp_tolerance, view=self.view)
         else:
             raise NotImplementedError('pose estimation algorithm named "{}" not implemented yet. Available options: {}'.format(self.estimation_type, available_esttimation_types))
         return pose_estimator
 
     def filter_pc(self, pc):
         # Fiter the raw pointcloud from the bubbles to remove the noisy limits. We obtain a kind of a cone
-        angles = [10, -25, 20, -20]
-        angles = [np.deg2rad(a) for a in angles]
-        vectors = [np.array([0, 1, 0]), np.array([0, 1, 0]), np.array([1, 0, 0]), np.array([1, 0, 0])]
-        view_vector = np.array([0, 0, 1])
-        conditions = []
-        for angle_i, vector_i in zip(angles, vectors):
-            q_i = tr.quaternion_about_axis(angle_i, axis=vector_i)
-            R = tr.quaternion_matrix(q_i)[:3, :3]
-            v_i = R @ view_vector
-            q_perp = tr.quaternion_about_axis(-np.pi*0.5*np.sign(angle_i), axis=vector_i)
-            R_perp = tr.quaternion_matrix(q_perp)[:3, :3]
-            normal_i = R_perp @ v_i
-            condition_i = np.dot(pc[:, :3], normal_i) >= 0
-            conditions.append(condition_i)
-        good_indxs = np.where(reduce((lambda x, y: x & y), conditions)) # aggregate all conditions
+        good_indxs = np.where(get_cone_filter_mask(pc[:, :3], self.filter_normals)) # all planes tested at once
         filtered_pc = pc[good_indxs]
         return filtered_pc
 
-    def estimate_pose(self, threshold, view=False, verbose=False, tool_detection=True):
+    def get_filter_pixel_mask(self, K, img_shape):
+        # filter_pc as a (precomputed) per-pixel mask to be applied on the depth images before unprojecting them
+        return get_cone_filter_pixel_mask(K, img_shape, normals=self.filter_normals)
+
+    def estimate_pose(self, threshold, view=False, verbose=False, tool_detection=True, init_pose=None):
+        """
+        :param threshold: icp threshold
+        :param init_pose: initial object pose on the reconstruction_frame (4x4) to warm-start the ICP, e.g. ToolPoseTracker.get_prior
+        :return: estimated object pose on the reconstruction_frame (4x4)
+        """
         if tool_detection:
-            imprint, imprint_r, imprint_l = self.get_imprint(view=view, separate=True)
-            imprint_pcd_r = pack_o3d_pcd(imprint_r)
-            imprint_pcd_l = pack_o3d_pcd(imprint_l)
-            distance_bubbles = None
-            # Detect tool:
-            if len(imprint_pcd_r.points) < 5 or len(imprint_pcd_l.points) < 5:
-                # No tool detected
+            with profile_span('get_imprint'):
+                imprint, imprint_r, imprint_l = self.get_imprint(view=view, separate=True)
+            with profile_span('tool_detection'):
+                self.tool_detected_publisher.data = self.detect_tool(imprint_r, imprint_l, verbose=verbose)
+        else:
+            with profile_span('get_imprint'):
+                imprint = self.get_imprint(view=view)
+        with profile_span('icp'):
+            estimated_pose = self._estimate_pose(imprint, threshold, verbose=verbose, init_pose=init_pose)
+        return estimated_pose
+
+    def detect_tool(self, imprint_r, imprint_l, verbose=False, min_num_points=5, max_abs_x=0.02, min_distance_x=0.01):
+        """
+        Detect if there is a tool between the bubbles from the imprints. It works directly on the imprint arrays.
+        The tool is detected if both imprints have enough points and the imprints (without outliers) are separated at least
+        min_distance_x along the x axis. The detection time is stored on self.tool_detection_latency (s).
+        :param imprint_r: (N_r, n) array of the right imprint points (x, y, z, ...)
+        :param imprint_l: (N_l, n) array of the left imprint points (x, y, z, ...)
+        :return: True if the tool is detected
+        """
+        start_time = time.perf_counter()
+        tool_detected = True
+        if len(imprint_r) < min_num_points or len(imprint_l) < min_num_points:
+            # No tool detected
+            if verbose:
+                print(f"{term_colors.WARNING}Warning: Not enough scene points provided (r: {len(imprint_r)}, l:{len(imprint_l)}){term_colors.ENDC}")
+            tool_detected = False
+        else:
+            # Filter out outliers
+            x_r = imprint_r[:, 0][np.abs(imprint_r[:, 0]) < max_abs_x]
+            x_l = imprint_l[:, 0][np.abs(imprint_l[:, 0]) < max_abs_x]
+            if x_r.shape[0] == 0 or x_l.shape[0] == 0:
                 if verbose:
-                    print(f"{term_colors.WARNING}Warning: Not enough scene points provided (r: {len(imprint_pcd_r.points)}, l:{len(imprint_pcd_l.points)}){term_colors.ENDC}")
-                self.tool_detected_publisher.data = False
+                    print(f"{term_colors.WARNING}Warning: No scene points after filtering out outliers (r: {x_r.shape[0]}, l:{x_l.shape[0]}){term_colors.ENDC}")
+                tool_detected = False
             else:
-                tree = KDTree(imprint_pcd_r.points)
-                corr_distances, _ = tree.query(imprint_pcd_l.points)
-                distance_bubbles = np.max(corr_distances)
-                
-                imprint_pcd_l.paint_uniform_color(np.array([1,0,0]))
-                imprint_r_array = np.asarray(imprint_pcd_r.points)
-                imprint_l_array = np.asarray(imprint_pcd_l.points)
-                # Filter out outliers
-                imprint_r_array = imprint_r_array[np.where(np.abs(imprint_r_array[:, 0]) < 0.02)]
-                imprint_l_array = imprint_l_array[np.where(np.abs(imprint_l_array[:, 0]) < 0.02)]
-                if imprint_r_array.shape[0] == 0 or imprint_l_array.shape[0] == 0:
+                # Find the two points further apart in the x axis
+                distance_bubbles_x = np.abs(np.max(x_r) - np.min(x_l))
+                if distance_bubbles_x < min_distance_x:
                     if verbose:
-                        print(f"{term_colors.WARNING}Warning: No scene points after filtering out outliers (r: {imprint_r_array.shape[0]}, l:{imprint_l_array.shape[0]}){term_colors.ENDC}")
-                    self.tool_detected_publisher.data = False   
-                else:
-                    # Find the two points further apart in the x axis                 
-                    x_max_r = np.max(imprint_r_array[:, 0])
-                    x_min_l = np.min(imprint_l_array[:, 0])
-                    distance_bubbles_x = np.abs(x_max_r - x_min_l)
-                    
-                    #view_pointcloud([imprint_pcd_l,imprint_pcd_r], frame=True)
-                    if (distance_bubbles is not None and distance_bubbles_x < 0.01):
-                        if verbose:
-                            print(f"{term_colors.WARNING}Warning: No tool detected{term_colors.ENDC}")
-                        self.tool_detected_publisher.data = False
-                    else:
-                        self.tool_detected_publisher.data = True
-        else:
-            imprint = self.get_imprint(view=view)
-        estimated_pose = self._estimate_pose(imprint, threshold, verbose=verbose)
-        return estimated_pose
+                        print(f"{term_colors.WARNING}Warning: No tool detected{term_colors.ENDC}")
+                    tool_detected = False
+        self.tool_detection_latency = time.perf_counter() - start_time
+        return tool_detected
 
-    def _estimate_pose(self, imprint, threshold, verbose=False):
+    def _estimate_pose(self, imprint, threshold, verbose=False, init_pose=None):
         self.pose_estimator.threshold = threshold
         self.pose_estimator.verbose = verbose
-        estimated_pose = self.pose_estimator.estimate_pose(imprint)
+        estimated_pose = self.pose_estimator.estimate_pose(imprint, init_pose=init_pose)
         return estimated_pose
 
 
@@ -151,14 +158,116 @@ class BubblePCReconstructorROSBase(BubblePCReconstructorBase):
     It adds the broadcasting and reading from ROS network.
     """
 
-    def __init__(self, *args, broadcast_imprint=False, verbose=False, **kwargs):
+    def __init__(self, *args, broadcast_imprint=False, verbose=False, stream_rate=10., **kwargs):
         self.broadcast_imprint = broadcast_imprint
         self.verbose = verbose
+        self.stream_rate = stream_rate # rate (Hz) at which the streaming mode estimates the pose. Set it to the camera frame rate.
         self.left_parser = BubbleParser(camera_name='pico_flexx_left', verbose=self.verbose)
         self.right_parser = BubbleParser(camera_name='pico_flexx_right', verbose=self.verbose)
+        self.parsers = {
+            'left': self.left_parser,
+            'right': self.right_parser,
+        }
         self.imprint_broadcaster = rospy.Publisher('imprint_pc', PointCloud2, queue_size=100)
+        self.camera_executor = ThreadPoolExecutor(max_workers=2) # process left and right cameras concurrently
+        self.estimation_lock = threading.RLock() # estimations and references can not happen at the same time
+        self.stream_lock = threading.Lock()
+        self.streaming_thread = None
+        self.streaming = False
+        self.latest_pose = None
+        self.latest_pose_stamp = None # time when the depth images of the latest pose were read
+        self.stream_last_error = None # last exception raised by a streaming estimation (None if the last one succeeded)
         super().__init__(*args, verbose=verbose, **kwargs)
 
+    def estimate_pose(self, *args, **kwargs):
+        estimated_pose, _ = self._estimate_pose_stamped(*args, **kwargs)
+        return estimated_pose
+
+    def start_streaming(self, threshold, rate=None, tool_detection=True, verbose=False):
+        """
+        Estimate the pose continuously on a background thread. The freshest estimation is read with get_latest_pose.
+        Failed estimations are reported and skipped, the thread keeps running until stop_streaming.
+        :param threshold: icp threshold
+        :param rate: estimation rate (Hz). Default: self.stream_rate
+        """
+        if rate is None:
+            rate = self.stream_rate
+        with self.stream_lock:
+            if self.streaming_thread is not None:
+                return
+            self.streaming = True
+            self.streaming_thread = threading.Thread(target=self._streaming_loop, args=(threshold, rate, tool_detection, verbose), daemon=True)
+            self.streaming_thread.start()
+
+    def stop_streaming(self):
+        with self.stream_lock:
+            self.streaming = False
+            streaming_thread = self.streaming_thread
+        if streaming_thread is not None:
+            streaming_thread.join()
+
+    def is_streaming(self):
+        with self.stream_lock:
+            return self.streaming_thread is not None and self.streaming_thread.is_alive()
+
+    def get_latest_pose(self, return_stamp=False, max_age=None):
+        """
+        Non-blocking access to the last pose estimated on streaming mode.
+        :param max_age: (optional) maximum age (s) of the pose, measured from when its depth images were read. Older poses,
+            or any pose if the streaming thread is not running, are returned as None.
+        :return: estimated pose as a 4x4 homogeneous matrix on the reconstruction_frame (None if no valid pose is available)
+        """
+        with self.stream_lock:
+            latest_pose = copy.deepcopy(self.latest_pose)
+            latest_pose_stamp = self.latest_pose_stamp
+            is_streaming = self.streaming_thread is not None and self.streaming_thread.is_alive()
+        if max_age is not None and latest_pose is not None:
+            if not is_streaming or (rospy.Time.now() - latest_pose_stamp).to_sec() > max_age:
+                latest_pose = None
+        if return_stamp:
+            return latest_pose, latest_pose_stamp
+        return latest_pose
+
+    def _estimate_pose_stamped(self, *args, **kwargs):
+        with self.estimation_lock:
+            # stamp the estimation when the depth images are read, not when the estimation finishes
+            stamp = rospy.Time.now()
+            estimated_pose = super().estimate_pose(*args, **kwargs)
+        return estimated_pose, stamp
+
+    def _streaming_loop(self, threshold, rate, tool_detection, verbose):
+        stream_rate = rospy.Rate(rate)
+        try:
+            while not rospy.is_shutdown():
+                with self.stream_lock:
+                    if not self.streaming:
+                        break
+                try:
+                    estimated_pose, stamp = self._estimate_pose_stamped(threshold, tool_detection=tool_detection, verbose=verbose)
+                except rospy.ROSInterruptException:
+                    break
+                except Exception as e:
+                    # e.g. empty imprint, tf lookup or degenerate icp. Skip this estimation, the next frames may be fine
+                    if self.stream_last_error is None:
+                        print(f"{term_colors.WARNING}Warning: Streaming pose estimation failed ({type(e).__name__}: {e}). Retrying{term_colors.ENDC}")
+                    self.stream_last_error = e
+                else:
+                    if self.stream_last_error is not None and verbose:
+                        print('Streaming pose estimation recovered')
+                    self.stream_last_error = None
+                    with self.stream_lock:
+                        self.latest_pose = estimated_pose
+                        self.latest_pose_stamp = stamp
+                try:
+                    stream_rate.sleep()
+                except rospy.ROSInterruptException:
+                    break
+        finally:
+            with self.stream_lock:
+                self.streaming = False
+                if self.streaming_thread is threading.current_thread():
+                    self.streaming_thread = None
+
     def _broadcast_imprint(self, imprint):
         header = Header()
         header.frame_id = self.reconstruction_frame
@@ -166,42 +275,76 @@ class BubblePCReconstructorROSBase(BubblePCReconstructorBase):
         pc2_msg = pc2.create_cloud_xyz32(header, xyz_points)
         self.imprint_broadcaster.publish(pc2_msg)
 
-    def _estimate_pose(self, imprint, threshold, verbose=False):
+    def _estimate_pose(self, imprint, threshold, verbose=False, init_pose=None):
         if self.broadcast_imprint:
             self._broadcast_imprint(imprint)
-        return super()._estimate_pose(imprint, threshold, verbose=verbose)
+        return super()._estimate_pose(imprint, threshold, verbose=verbose, init_pose=init_pose)
 
 
 class BubblePCReconsturctorTreeSearch(BubblePCReconstructorROSBase):
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, search_mode='tree', window_size=0, **kwargs):
+        """
+        :param search_mode: how the points far from the reference are found:
+            - 'tree': nearest reference point using a KDTree
+            - 'image': per pixel, comparing each point with the reference points on the same pixel (or a window around it).
+                Only valid for organized point clouds. If the camera info has no image size or the clouds do not match
+                it, it falls back to 'tree' with a warning. The mode in use on each camera is on self.active_search_modes.
+        :param window_size: (only 'image' mode) half size of the pixel window. 0 only compares the same pixel, i.e. the depth difference along the ray.
+        """
+        self.search_mode = search_mode
+        self.window_size = window_size
         super().__init__(*args, **kwargs)
         self.trees = {
             'right': None,
             'left': None,
         }
+        self.organized_references = {
+            'right': None,
+            'left': None,
+        }
+        self.img_shapes = {
+            'right': None,
+            'left': None,
+        } # (height, width) of the depth images
+        self.active_search_modes = {
+            'right': 'tree',
+            'left': 'tree',
+        } # search mode used on the last imprint of each camera
+        self._reported_fallbacks = set() # (key, reason) of the fallbacks to 'tree' already warned
+        if self.search_mode == 'image':
+            for key, parser in self.parsers.items():
+                camera_info = parser.get_camera_info_depth()
+                if 'height' in camera_info and 'width' in camera_info:
+                    self.img_shapes[key] = (camera_info['height'], camera_info['width'])
+                    self.active_search_modes[key] = 'image'
+                else:
+                    self._warn_search_fallback(key, 'the camera info has no image height and width')
+        elif self.search_mode != 'tree':
+            raise ValueError('Search mode {} not supported. Available options: tree, image'.format(self.search_mode))
 
     def reference(self):
         pc_r, frame_r = self.right_parser.get_point_cloud(return_ref_frame=True)
         pc_l, frame_l = self.left_parser.get_point_cloud(return_ref_frame=True)
         pc_r_filtered = self.filter_pc(pc_r)
         pc_l_filtered = self.filter_pc(pc_l)
-        self.references['left'] = pc_l_filtered
-        self.references['right'] = pc_r_filtered
-        self.references['left_frame'] = frame_l
-        self.references['right_frame'] = frame_r
-        # Create the tree for improved performance
-        self.trees['right'] = KDTree(self.references['right'][:, :3])
-        self.trees['left'] = KDTree(self.references['left'][:, :3])
-        self.last_tr = None
+        with self.estimation_lock:
+            self.references['left'] = pc_l_filtered
+            self.references['right'] = pc_r_filtered
+            self.references['left_frame'] = frame_l
+            self.references['right_frame'] = frame_r
+            # Create the tree for improved performance
+            self.trees['right'] = KDTree(self.references['right'][:, :3])
+            self.trees['left'] = KDTree(self.references['left'][:, :3])
+            self.organized_references['right'] = self._get_organized_xyz(pc_r, key='right') if self.search_mode == 'image' else None
+            self.organized_references['left'] = self._get_organized_xyz(pc_l, key='left') if self.search_mode == 'image' else None
+            self.last_tr = None
 
     def get_imprint(self, view=False, separate=False):
         pc_r, frame_r = self.right_parser.get_point_cloud(return_ref_frame=True, ref_frame=self.references['right_frame'])
         pc_l, frame_l = self.left_parser.get_point_cloud(return_ref_frame=True, ref_frame=self.references['left_frame'])
-        pc_r = self.filter_pc(pc_r)
-        pc_l = self.filter_pc(pc_l)
-        pc_r_contact_indxs = self._get_far_points_indxs(pc_r, d_threshold=self.threshold, key='right')
-        pc_l_contact_indxs = self._get_far_points_indxs(pc_l, d_threshold=self.threshold, key='left')
+        pc_r, pc_r_contact_indxs = self._get_contact_points(pc_r, key='right')
+        pc_l, pc_l_contact_indxs = self._get_contact_points(pc_l, key='left')
         # pc_l_contact_indxs = get_far_points_indxs(self.reference_pcs['left'], pc_l, d_threshold=self.threshold)
         pc_r_tr = self.right_parser.transform_pc(pc_r, origin_frame=frame_r, target_frame=self.reconstruction_frame)
         pc_l_tr = self.left_parser.transform_pc(pc_l, origin_frame=frame_l, target_frame=self.reconstruction_frame)
@@ -224,6 +367,65 @@ class BubblePCReconsturctorTreeSearch(BubblePCReconstructorROSBase):
             return imprint, imprint_r, imprint_l
         return imprint
 
+    def _get_contact_points(self, pc, key):
+        """
+        Filter the point cloud and find the contact points (far from the reference)
+        :return: filtered point cloud, contact indxs (or boolean mask) on the filtered point cloud
+        """
+        qry_xyz = None
+        if self.img_shapes[key] is not None:
+            qry_xyz = self._get_organized_xyz(pc, key)
+            if self.organized_references[key] is None:
+                self._warn_search_fallback(key, 'the reference cloud size does not match the image size {}'.format(self.img_shapes[key]))
+                qry_xyz = None
+            elif qry_xyz is None:
+                self._warn_search_fallback(key, 'the cloud size does not match the image size {}'.format(self.img_shapes[key]))
+        self.active_search_modes[key] = 'tree' if qry_xyz is None else 'image'
+        if qry_xyz is None:
+            # KDTree search (fallback for non organized clouds)
+            pc_filtered = self.filter_pc(pc)
+            contact_indxs = self._get_far_points_indxs(pc_filtered, d_threshold=self.threshold, key=key)
+            return pc_filtered, contact_indxs
+        far_mask = self._get_far_points_mask(qry_xyz, d_threshold=self.threshold, key=key).reshape(-1)
+        filter_mask = get_cone_filter_mask(pc[:, :3], self.filter_normals)
+        return pc[filter_mask], far_mask[filter_mask]
+
+    def _warn_search_fallback(self, key, reason):
+        # warn only the first time each camera falls back for each reason
+        if (key, reason) in self._reported_fallbacks:
+            return
+        self._reported_fallbacks.add((key, reason))
+        print(f"{term_colors.WARNING}Warning: 'image' search mode not available for the {key} camera ({reason}). Using 'tree' search{term_colors.ENDC}")
+
+    def _get_organized_xyz(self, pc, key):
+        # (height, width, 3) point coordinates if the point cloud is organized, None otherwise
+        img_shape = self.img_shapes[key]
+        if img_shape is None or len(pc) != img_shape[0] * img_shape[1]:
+            return None
+        return pc[:, :3].reshape(*img_shape, 3)
+
+    def _get_far_points_mask(self, qry_xyz, d_threshold, key):
+        """
+        Image space version of _get_far_points_indxs. Each query point is only compared with the reference points on the
+        pixels of a (2*window_size+1)x(2*window_size+1) window around it.
+        Args:
+            qry_xyz: <np.ndarray> (height, width, 3) organized query point coordinates
+            d_threshold: <float> threshold distance to consider far if d>d_threshold
+        Returns:
+            - <np.ndarray> (height, width) boolean mask, True for the query points far from the reference
+        """
+        ref_xyz = self.organized_references[key]
+        k = self.window_size
+        height, width = ref_xyz.shape[:2]
+        padded_ref_xyz = np.pad(ref_xyz, ((k, k), (k, k), (0, 0)), constant_values=np.nan)
+        min_dist_sq = np.full((height, width), np.inf)
+        for di in range(2 * k + 1):
+            for dj in range(2 * k + 1):
+                dist_sq = np.sum((qry_xyz - padded_ref_xyz[di:di + height, dj:dj + width]) ** 2, axis=-1)
+                min_dist_sq = np.fmin(min_dist_sq, dist_sq) # invalid (nan) reference points are ignored
+        far_mask = (min_dist_sq > d_threshold ** 2) & np.all(np.isfinite(qry_xyz), axis=-1)
+        return far_mask
+
     def _get_far_points_indxs(self, query_pc, d_threshold, key):
         """
         Compare the query_pc with the ref_pc and return the points in query_pc that are farther than d_threshold from ref_pc
@@ -257,33 +459,19 @@ class BubblePCReconsturctorDepth(BubblePCReconstructorROSBase):
         # read refernce depth images
         depth_r = self.right_parser.get_image_depth()
         depth_l = self.left_parser.get_image_depth()
-        self.references['left'] = depth_l
-        self.references['right'] = depth_r
-        self.references['left_frame'] = self.right_parser.optical_frame['depth']
-        self.references['right_frame'] = self.left_parser.optical_frame['depth']
-        self.last_tr = None
+        with self.estimation_lock:
+            self.references['left'] = depth_l
+            self.references['right'] = depth_r
+            self.references['left_frame'] = self.right_parser.optical_frame['depth']
+            self.references['right_frame'] = self.left_parser.optical_frame['depth']
+            self.last_tr = None
 
     def get_imprint(self, view=False, separate=False):
-        depth_r = self.right_parser.get_image_depth()
-        depth_l = self.left_parser.get_image_depth()
-        imprint_r = get_imprint_pc(self.references['right'].squeeze(-1), depth_r.squeeze(-1), threshold=self.threshold, K=self.camera_info['right']['K'], percentile=self.percentile)
-        imprint_l = get_imprint_pc(self.references['left'].squeeze(-1), depth_l.squeeze(-1), threshold=self.threshold, K=self.camera_info['left']['K'], percentile=self.percentile)
-        frame_r = self.right_parser.optical_frame['depth']
-        frame_l = self.left_parser.optical_frame['depth']
-
-        filtered_imprint_r = self.filter_pc(imprint_r)
-        filtered_imprint_l = self.filter_pc(imprint_l)
-        
-        # pc_l_contact_indxs = get_far_points_indxs(self.reference_pcs['left'], pc_l, d_threshold=self.threshold)
-        imprint_r = self.right_parser.transform_pc(filtered_imprint_r, origin_frame=frame_r, target_frame=self.reconstruction_frame)
-        imprint_l = self.left_parser.transform_pc(filtered_imprint_l, origin_frame=frame_l, target_frame=self.reconstruction_frame)
-
-        if imprint_r is None:
-            print('No imprint detected in R, maybe we have a problem with the tfs')
-            imprint_r = np.empty((0, 6))
-        if imprint_l is None:
-            print('No imprint detected in L, maybe we have a problem with the tfs')
-            imprint_l = np.empty((0, 6))
+        # Process both cameras concurrently (most of the time is spent on numpy and waiting for the images and tfs)
+        future_r = self.camera_executor.submit(self._get_camera_imprint, 'right')
+        future_l = self.camera_executor.submit(self._get_camera_imprint, 'left')
+        imprint_r = future_r.result()
+        imprint_l = future_l.result()
 
         # if view:
         #     pc_r_tr[pc_r_contact_indxs, 3:6] = np.array([0, 1, 0])  # green
@@ -302,6 +490,19 @@ class BubblePCReconsturctorDepth(BubblePCReconstructorROSBase):
             return imprint, imprint_r, imprint_l
         return imprint
 
+    def _get_camera_imprint(self, camera_key):
+        # camera_key: 'right' or 'left'
+        parser = self.parsers[camera_key]
+        depth = parser.get_image_depth()
+        imprint = get_imprint_pc(self.references[camera_key].squeeze(-1), depth.squeeze(-1), threshold=self.threshold, K=self.camera_info[camera_key]['K'], percentile=self.percentile)
+        frame = parser.optical_frame['depth']
+        filtered_imprint = self.filter_pc(imprint)
+        imprint = parser.transform_pc(filtered_imprint, origin_frame=frame, target_frame=self.reconstruction_frame)
+        if imprint is None:
+            print('No imprint detected in {}, maybe we have a problem with the tfs'.format(camera_key[0].upper()))
+            imprint = np.empty((0, 6))
+        return imprint
+
 
 class BubblePCReconstructorOfflineDepth(BubblePCReconstructorBase):
     def __init__(self, *args, **kwargs):
@@ -329,6 +530,10 @@ class BubblePCReconstructorOfflineDepth(BubblePCReconstructorBase):
     def reference(self):
         pass
 
+    def reset_tfs(self):
+        # Clear all tfs. Needed when the reconstructor is reused for samples with different tfs, since the buffer does not overwrite tfs with the same stamp.
+        self.buffer = tf2.BufferCore()
+
     def add_tfs(self, tfs_df):
         for indx, row in tfs_df.iterrows():
             # pack the tf into a TrasformStamped message
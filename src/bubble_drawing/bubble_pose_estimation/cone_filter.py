@@ -0,0 +1,71 @@
+import numpy as np
+import tf.transformations as tr
+
+_pixel_masks = {} # cache of the cone filter pixel masks. Key: (K, img_shape, normals)
+
+
+def get_cone_filter_normals(angles=(10, -25, 20, -20)):
+    """
+    Normals of the planes (through the camera center) that bound the bubble view cone. The noisy limits of the bubble
+    are on the negative side of at least one of the planes.
+    :param angles: plane angles (deg) about the camera y, y, x and x axis respectively
+    :return: (3, n_planes) array, so all half-space tests are a single (N,3)@(3,n_planes) product
+    """
+    angles = [np.deg2rad(a) for a in angles]
+    vectors = [np.array([0, 1, 0]), np.array([0, 1, 0]), np.array([1, 0, 0]), np.array([1, 0, 0])]
+    view_vector = np.array([0, 0, 1])
+    normals = []
+    for angle_i, vector_i in zip(angles, vectors):
+        q_i = tr.quaternion_about_axis(angle_i, axis=vector_i)
+        R = tr.quaternion_matrix(q_i)[:3, :3]
+        v_i = R @ view_vector
+        q_perp = tr.quaternion_about_axis(-np.pi*0.5*np.sign(angle_i), axis=vector_i)
+        R_perp = tr.quaternion_matrix(q_perp)[:3, :3]
+        normal_i = R_perp @ v_i
+        normals.append(normal_i)
+    normals = np.stack(normals, axis=-1)  # (3, n_planes)
+    return normals
+
+
+def get_cone_filter_mask(points, normals):
+    """
+    :param points: (..., 3) array of points in the camera optical frame
+    :param normals: (3, n_planes) array
+    :return: (...) boolean array, True for the points inside the cone
+    """
+    return np.all(points @ normals >= 0, axis=-1)
+
+
+def get_pixel_rays(K, img_shape):
+    """
+    Directions of the rays through each pixel of a camera with intrinsics K, with z=1.
+    A point with depth d on pixel (i, j) is d * rays[i, j].
+    :param K: (3, 3) camera intrinsics
+    :param img_shape: (w, h) image shape (rows, columns)
+    :return: (w, h, 3) array
+    """
+    K = np.asarray(K).reshape(3, 3)
+    rows, cols = np.meshgrid(np.arange(img_shape[0]), np.arange(img_shape[1]), indexing='ij')
+    pixels = np.stack([cols, rows, np.ones_like(rows)], axis=-1).astype(np.float64)  # (u, v, 1)
+    rays = pixels @ np.linalg.inv(K).T
+    return rays
+
+
+def get_cone_filter_pixel_mask(K, img_shape, normals=None):
+    """
+    Cone filter as a per-pixel mask. Since the planes go through the camera center, for points with positive depth the
+    filter only depends on the pixel. Therefore it can be applied to the depth images before unprojecting them.
+    The masks are computed once per camera.
+    :param K: (3, 3) camera intrinsics
+    :param img_shape: (w, h) image shape
+    :param normals: (3, n_planes) array. Default: get_cone_filter_normals()
+    :return: (w, h) boolean array, True for the pixels inside the cone
+    """
+    if normals is None:
+        normals = get_cone_filter_normals()
+    K = np.asarray(K, dtype=np.float64).reshape(3, 3)
+    mask_key = (K.tobytes(), tuple(img_shape[:2]), normals.tobytes())
+    if mask_key not in _pixel_masks:
+        rays = get_pixel_rays(K, img_shape[:2])
+        _pixel_masks[mask_key] = get_cone_filter_mask(rays, normals)
+    return _pixel_masks[mask_key]
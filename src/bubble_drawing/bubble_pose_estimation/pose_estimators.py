@@ -1,4 +1,6 @@
+import time
 import numpy as np
+import torch
 import abc
 from mmint_camera_utils.camera_utils.point_cloud_utils import pack_o3d_pcd, view_pointcloud
 import open3d as o3d
@@ -6,6 +8,7 @@ import copy
 import tf.transformations as tr
 from scipy.spatial import KDTree
 from mmint_utils.terminal_colors import term_colors
+from bubble_drawing.bubble_pose_estimation.batched_pytorch_icp import icp_2d_masked, icp_masked, compute_masked_fitness
 
 
 class PCPoseEstimatorBase(abc.ABC):
@@ -30,9 +33,17 @@ class ICPPoseEstimator(PCPoseEstimatorBase):
         self.view = view
         self.verbose = verbose
 
-    def estimate_pose(self, target_pc, init_tr=None):
+    def estimate_pose(self, target_pc, init_tr=None, init_pose=None):
+        """
+        :param target_pc: (n_points, n_feats) target point cloud
+        :param init_tr: initial transformation, on the space where the icp is solved
+        :param init_pose: initial object pose (4x4, same frame as the estimated pose), e.g. a tracker prediction. Ignored if init_tr is provided
+        :return: estimated object pose (4x4)
+        """
         # target_pc = self._filter_input_pc(target_pc)
         target_pcd = pack_o3d_pcd(target_pc)
+        if init_tr is None and init_pose is not None:
+            init_tr = self._get_pose_init_tr(init_pose)
         if init_tr is None:
             init_tr = self._get_init_tr(target_pcd)
         if self.view:
@@ -78,6 +89,13 @@ class ICPPoseEstimator(PCPoseEstimatorBase):
             init_tr =  self.last_tr
         return init_tr
 
+    def _get_pose_init_tr(self, init_pose):
+        # transform an object pose to the space where the icp is solved
+        init_tr = np.asarray(init_pose, dtype=np.float64)
+        if self.is_model_target:
+            init_tr = np.linalg.inv(init_tr)
+        return init_tr
+
     @abc.abstractmethod
     def _icp(self, source_pcd, target_pcd, threshold, init_tr):
         pass
@@ -132,15 +150,208 @@ class ICP3DPoseEstimator(ICPPoseEstimator):
         return random_tr
 
 
+class MultiHypothesisICP3DPoseEstimator(ICP3DPoseEstimator):
+    """
+    Estimate the pose of the target_pc running ICP from several initial transformations at once (batched torch ICP).
+    The hypotheses are perturbations of the initial transformation (the last estimated pose), or random orientations
+    when the tracking is lost (no previous estimation, or its fitness is below min_tracking_fitness). The hypothesis
+    with the best fitness is returned.
+    Latency and fitness of the last estimation are stored on self.last_icp_info.
+    """
+    def __init__(self, *args, num_hypotheses=8, max_num_iterations=50, tolerance=1e-6, perturbation_angle=np.pi*0.1,
+                 device=None, memory_budget=2**28, min_tracking_fitness=0.3, **kwargs):
+        """
+        :param num_hypotheses: number of initial transformations (including the initial one)
+        :param max_num_iterations: maximum number of ICP iterations (the same for all hypotheses)
+        :param tolerance: hypotheses whose transformation changes less than tolerance between iterations stop iterating
+        :param perturbation_angle: max rotation angle (rad) of the perturbations around the initial transformation
+        :param device: torch device where the ICP runs. Default: cpu
+        :param memory_budget: maximum number of bytes for the ICP correspondence distances (None: no limit)
+        :param min_tracking_fitness: if the fitness of the last estimation is lower, the tracking is considered lost and
+            the next estimation starts from the scene mean with random orientations instead of the last estimated pose
+        """
+        self.num_hypotheses = num_hypotheses
+        self.max_num_iterations = max_num_iterations
+        self.tolerance = tolerance
+        self.perturbation_angle = perturbation_angle
+        if device is None:
+            device = torch.device('cpu')
+        self.device = device
+        self.memory_budget = memory_budget
+        self.min_tracking_fitness = min_tracking_fitness
+        self.last_icp_info = None
+        super().__init__(*args, **kwargs)
+        self._object_model_points = None # object model points on the device, converted only once
+
+    def _icp(self, source_pcd, target_pcd, threshold, init_tr):
+        start_time = time.perf_counter()
+        source_points = self._get_points(source_pcd)  # (n_source_points, 3)
+        target_points = self._get_points(target_pcd)  # (n_target_points, 3)
+        init_trs = torch.from_numpy(self._get_init_hypotheses(init_tr)).to(self.device)  # (K, 4, 4)
+        K = init_trs.shape[0]
+        # Here: model -> source, scene -> target. All hypotheses share the points (broadcasted, not copied)
+        pc_model = source_points.unsqueeze(0).expand(K, -1, -1)
+        pc_scene = target_points.unsqueeze(0).expand(K, -1, -1)
+        pc_scene_mask = torch.ones((1, 1, 1), dtype=torch.bool, device=self.device).expand(pc_scene.shape) # all scene points are valid
+        Rs, ts, info = icp_masked(pc_model, pc_scene, pc_scene_mask, num_iter=self.max_num_iterations, tolerance=self.tolerance,
+                                     return_info=True, memory_budget=self.memory_budget, R_init=init_trs[:, :3, :3], t_init=init_trs[:, :3, 3],
+                                     max_correspondence_distance=threshold) # same correspondences as the Open3D ICP and the fitness
+        fitness, inlier_rmse = compute_masked_fitness(pc_model, pc_scene, pc_scene_mask, Rs, ts, threshold, memory_budget=self.memory_budget)
+        # best fitness, ties broken by the lowest inlier rmse
+        fitness = torch.nan_to_num(fitness, nan=-1.)
+        inlier_rmse = torch.nan_to_num(inlier_rmse, nan=float('inf'))
+        best_candidates = torch.where(fitness == torch.max(fitness))[0]
+        best_indx = best_candidates[torch.argmin(inlier_rmse[best_candidates])]
+        icp_transformation = np.eye(4)
+        icp_transformation[:3, :3] = Rs[best_indx].cpu().numpy()
+        icp_transformation[:3, 3] = ts[best_indx].cpu().numpy()
+        self.last_icp_info = {
+            'latency': time.perf_counter() - start_time,
+            'fitness': fitness[best_indx].item(),
+            'inlier_rmse': inlier_rmse[best_indx].item(),
+            'num_iterations': info['num_iterations'][best_indx].item(),
+            'best_hypothesis': best_indx.item(),
+            'hypotheses_fitness': fitness.cpu().numpy(),
+        }
+        if self.verbose:
+            print('ICP {} hypotheses -- fitness: {:.4f}, inlier_rmse: {:.6f}, latency: {:.4f}s'.format(K, self.last_icp_info['fitness'], self.last_icp_info['inlier_rmse'], self.last_icp_info['latency']))
+        return icp_transformation
+
+    def _get_points(self, pcd):
+        # (n_points, 3) tensor on the device. The object model is only converted the first time
+        if pcd is self.object_model:
+            if self._object_model_points is None:
+                self._object_model_points = torch.from_numpy(np.asarray(pcd.points)).to(self.device)
+            return self._object_model_points
+        return torch.from_numpy(np.asarray(pcd.points)).to(self.device)
+
+    def is_tracking_lost(self):
+        if self.last_tr is None:
+            return True
+        return self.last_icp_info is not None and self.last_icp_info['fitness'] < self.min_tracking_fitness
+
+    def _get_init_tr(self, target_pcd):
+        if not self.is_tracking_lost():
+            return self.last_tr
+        # start from the scene mean, the orientations are explored by the hypotheses
+        init_tr = np.eye(4)
+        if not self.is_model_target:
+            init_tr[:3, 3] = np.mean(np.asarray(target_pcd.points), axis=0)
+        return init_tr
+
+    def _get_init_hypotheses(self, init_tr):
+        """
+        :param init_tr: (4, 4) initial transformation. It is always the first hypothesis
+        :return: (num_hypotheses, 4, 4) array of initial transformations
+        """
+        init_trs = [np.asarray(init_tr, dtype=np.float64)]
+        tracking_lost = self.is_tracking_lost()
+        for i in range(self.num_hypotheses - 1):
+            if tracking_lost:
+                # global search on the orientation
+                random_tr = self._sample_random_tr()
+            else:
+                _axis = np.random.uniform(-1, 1, 3)
+                axis = _axis / np.linalg.norm(_axis)
+                random_tr = tr.quaternion_matrix(tr.quaternion_about_axis(np.random.uniform(-self.perturbation_angle, self.perturbation_angle), axis))
+            init_tr_i = init_trs[0].copy()
+            init_tr_i[:3, :3] = init_trs[0][:3, :3] @ random_tr[:3, :3] # rotate the model about its origin
+            init_trs.append(init_tr_i)
+        return np.stack(init_trs, axis=0)
+
+
 class ICP2DPoseEstimator(ICPPoseEstimator):
     """
     Constrain the ICP to be on a plane
     """
-    def __init__(self, *args, projection_axis=(0,0,1), max_num_iterations=20, **kwargs):
+    def __init__(self, *args, projection_axis=(0,0,1), max_num_iterations=20, tolerance=None, **kwargs):
         self.projection_axis = np.asarray(projection_axis)
         self.projection_tr = self._get_projection_tr()
         self.max_num_iterations = max_num_iterations
+        self.tolerance = tolerance # If provided, the ICP stops when the change on the transformation is smaller than tolerance (useful when warm-started)
+        self.last_num_iterations = None # number of ICP iterations of the last estimate_pose
         super().__init__(*args, **kwargs)
+        self._projected_model_points = None # model projected to 2d, computed only once for the batched estimation
+
+    def estimate_poses(self, target_pcs, init_trs=None, memory_budget=2**30):
+        """
+        Batched version of estimate_pose. All target point clouds are padded and solved together with the torch batched ICP on CPU.
+        :param target_pcs: list of target point clouds, each of shape (n_points_i, n_feats)
+        :param init_trs: list of initial object poses (4x4, same frame as the estimated poses, e.g. last_tr) to warm-start each element.
+            Elements can be None to use the default initialization (scene mean)
+        :param memory_budget: maximum number of bytes for the ICP correspondence distances (None: no limit)
+        :return: list of estimated poses (4x4)
+        Targets with too few points fall back to their init_trs[i] (or the default initialization) and never to self.last_tr,
+        so each element is independent of the others in the batch.
+        self.last_tr is updated with the pose of the last element (in list order) that was estimated by ICP, and left unchanged if none was.
+        """
+        num_targets = len(target_pcs)
+        if init_trs is None:
+            init_trs = [None] * num_targets
+        if self.is_model_target or self.view:
+            # Not supported in batch, estimate them one by one
+            return [self.estimate_pose(target_pc, init_pose=init_tr) for target_pc, init_tr in zip(target_pcs, init_trs)]
+        target_points = [self._project_pc(np.asarray(target_pc)[:, :3]) for target_pc in target_pcs]
+        estimated_poses = [None] * num_targets
+        valid_indxs = []
+        for i, target_points_i in enumerate(target_points):
+            if len(target_points_i) < 4:
+                print(f"{term_colors.WARNING}Warning: No scene points provided (we only have {len(target_points_i)} points){term_colors.ENDC}")
+                if init_trs[i] is not None:
+                    estimated_poses[i] = init_trs[i]
+                else:
+                    estimated_poses[i] = self._get_init_tr(pack_o3d_pcd(target_pcs[i]))
+            else:
+                valid_indxs.append(i)
+        if len(valid_indxs) > 0:
+            # pad and mask the scenes
+            max_num_points = max([len(target_points[i]) for i in valid_indxs])
+            pc_scene = np.zeros((len(valid_indxs), max_num_points, 2))
+            pc_scene_mask = np.zeros((len(valid_indxs), max_num_points, 2), dtype=bool)
+            for j, i in enumerate(valid_indxs):
+                pc_scene[j, :len(target_points[i])] = target_points[i][:, :2]
+                pc_scene_mask[j, :len(target_points[i])] = True
+            pc_scene = torch.from_numpy(pc_scene)
+            pc_scene_mask = torch.from_numpy(pc_scene_mask)
+            pc_model = torch.from_numpy(self._get_projected_model_points()[:, :2]).unsqueeze(0).expand(len(valid_indxs), -1, -1)
+            R_init, t_init = self._get_batched_init(pc_scene, pc_scene_mask, [init_trs[i] for i in valid_indxs])
+            Rs, ts = icp_2d_masked(pc_model, pc_scene, pc_scene_mask, num_iter=self.max_num_iterations, tolerance=self.tolerance,
+                                   R_init=R_init, t_init=t_init, memory_budget=memory_budget)
+            unproject_tr = tr.inverse_matrix(self.projection_tr)
+            for j, i in enumerate(valid_indxs):
+                icp_tr = np.eye(4)
+                icp_tr[:2, :2] = Rs[j].numpy()
+                icp_tr[:2, 3] = ts[j].numpy()
+                estimated_poses[i] = unproject_tr @ icp_tr @ self.projection_tr
+            self.last_tr = estimated_poses[valid_indxs[-1]]
+        return estimated_poses
+
+    def _get_projected_model_points(self):
+        if self._projected_model_points is None:
+            self._projected_model_points = self._project_pc(np.asarray(self.object_model.points))
+        return self._projected_model_points
+
+    def _get_projected_init_tr(self, init_tr):
+        # transform an object pose to the projected space where the icp is solved
+        if init_tr is None:
+            return None
+        projected_init_tr = self.projection_tr @ init_tr @ tr.inverse_matrix(self.projection_tr)
+        return projected_init_tr
+
+    def _get_pose_init_tr(self, init_pose):
+        return self._get_projected_init_tr(super()._get_pose_init_tr(init_pose))
+
+    def _get_batched_init(self, pc_scene, pc_scene_mask, init_trs):
+        # Default initialization: no rotation and translation at the mean of the scene (as _get_init_tr)
+        N = pc_scene.shape[0]
+        R_init = torch.eye(2, dtype=pc_scene.dtype).unsqueeze(0).repeat_interleave(N, dim=0)  # (N, 2, 2)
+        t_init = torch.sum(pc_scene * pc_scene_mask, dim=1) / torch.sum(pc_scene_mask, dim=1)  # (N, 2)
+        for j, init_tr in enumerate(init_trs):
+            projected_init_tr = self._get_projected_init_tr(init_tr)
+            if projected_init_tr is not None:
+                R_init[j] = torch.from_numpy(projected_init_tr[:2, :2])
+                t_init[j] = torch.from_numpy(projected_init_tr[:2, 3])
+        return R_init, t_init
 
     def _get_projection_tr(self):
         self.projection_axis = self.projection_axis/np.linalg.norm(self.projection_axis)
@@ -196,6 +407,7 @@ class ICP2DPoseEstimator(ICPPoseEstimator):
                 return self.last_tr
             return init_tr
 
+        self.last_num_iterations = 0
         for i in range(self.max_num_iterations):
             # transform model
             source_tr = source_points @ icp_tr[:3, :3].T + icp_tr[:3, 3]
@@ -227,7 +439,11 @@ class ICP2DPoseEstimator(ICPPoseEstimator):
             _new_icp_tr[:2,3] = t_star
             new_icp_tr = _new_icp_tr
 
+            delta = np.linalg.norm(new_icp_tr[:2, :2] - icp_tr[:2, :2]) + np.linalg.norm(new_icp_tr[:2, 3] - icp_tr[:2, 3])
             icp_tr = new_icp_tr
+            self.last_num_iterations = i + 1
+            if self.tolerance is not None and delta < self.tolerance:
+                break
         if self.view:
             print('VIEW Fitted 2d pc on projected space')
             source_tr = source_points @ icp_tr[:3, :3].T + icp_tr[:3, 3]
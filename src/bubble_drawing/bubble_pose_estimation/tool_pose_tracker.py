@@ -0,0 +1,155 @@
+import numpy as np
+import torch
+import tf.transformations as tr
+
+from bubble_drawing.bubble_model_control.aux.frame_graph import FrameGraph
+
+
+class ToolPoseTracker(object):
+    """
+    Keeps a filtered pose (on the world frame) of each grasped tool across control steps.
+    The tool is assumed to move rigidly with the grasp frame, so the pose after an action is predicted by moving the grasp
+    frame with the action model (e.g. drawing_action_model_one_dir). The prediction is used to warm-start the ICP of the
+    next estimation and as the prior that the next measurement is filtered against.
+    """
+    def __init__(self, action_model=None, smoothing=0.3, max_translation_innovation=0.02, max_rotation_innovation=np.pi*0.25,
+                 max_num_rejections=3, grasp_frame='grasp_frame'):
+        """
+        :param action_model: function that updates the frames given an action: state_samples_corrected = action_model(state_samples, actions).
+            If None, the gripper is assumed not to move.
+        :param smoothing: weight of the prior on the filtered pose, in [0, 1). 0 means no filtering (the measurement is used as it is)
+        :param max_translation_innovation: measurements further (m) than this from the prior are considered outliers
+        :param max_rotation_innovation: measurements rotated more (rad) than this from the prior are considered outliers
+        :param max_num_rejections: number of consecutive rejected measurements before the track is reinitialized with the measurement
+        :param grasp_frame: frame the tool is rigidly attached to
+        """
+        self.action_model = action_model
+        self.smoothing = smoothing
+        self.max_translation_innovation = max_translation_innovation
+        self.max_rotation_innovation = max_rotation_innovation
+        self.max_num_rejections = max_num_rejections
+        self.grasp_frame = grasp_frame
+        self.tracks = {} # Key: tool_name. Value: dict with the filtered 'pose', the 'prediction' for the next step and the 'num_rejections'
+
+    def reset(self, tool_name=None):
+        if tool_name is None:
+            self.tracks = {}
+        else:
+            self.tracks.pop(tool_name, None)
+
+    def is_tracking(self, tool_name='marker'):
+        return tool_name in self.tracks
+
+    def get_pose(self, tool_name='marker', frame_name=None, all_tfs=None):
+        """
+        :param frame_name: frame where the pose is expressed. If None, the world frame (the all_tfs common frame)
+        :param all_tfs: tfs used to express the pose on frame_name
+        :return: (4, 4) filtered tool pose, None if the tool is not tracked
+        """
+        if tool_name not in self.tracks:
+            return None
+        return self._to_frame(self.tracks[tool_name]['pose'], frame_name, all_tfs)
+
+    def get_prior(self, tool_name='marker', frame_name=None, all_tfs=None):
+        """
+        Pose expected for the next measurement: the prediction if predict has been called since the last update, otherwise the filtered pose.
+        Use it to warm-start the next ICP.
+        :return: (4, 4) tool pose, None if the tool is not tracked
+        """
+        if tool_name not in self.tracks:
+            return None
+        track = self.tracks[tool_name]
+        prior = track['pose'] if track['prediction'] is None else track['prediction']
+        return self._to_frame(prior, frame_name, all_tfs)
+
+    def predict(self, all_tfs, action, tool_name='marker', frame_name=None):
+        """
+        Predict the tool pose after applying the action.
+        :param all_tfs: tfs (dict frame_name -> (4, 4) or FrameGraph with batch size 1) before the action
+        :param action: commanded action, (action_size,) array or tensor
+        :param frame_name: frame where the returned pose is expressed (on the predicted tfs). If None, the world frame
+        :return: (4, 4) predicted tool pose, None if the tool is not tracked
+        """
+        if tool_name not in self.tracks:
+            return None
+        track = self.tracks[tool_name]
+        wf_X_gf = self._get_frame_tr(all_tfs, self.grasp_frame)
+        gf_X_tool = tr.inverse_matrix(wf_X_gf) @ track['pose'] # the tool does not move with respect to the grasp
+        next_all_tfs = self._apply_action_model(all_tfs, action)
+        wf_X_gf_next = self._get_frame_tr(next_all_tfs, self.grasp_frame)
+        track['prediction'] = wf_X_gf_next @ gf_X_tool
+        return self._to_frame(track['prediction'], frame_name, next_all_tfs)
+
+    def update(self, measured_pose, tool_name='marker', frame_name=None, all_tfs=None):
+        """
+        Filter a new pose measurement with the prior (prediction or last filtered pose).
+        :param measured_pose: (4, 4) measured tool pose on frame_name
+        :param frame_name: frame of the measured pose. If None, the world frame
+        :param all_tfs: tfs used to express the measured pose on the world frame
+        :return: (4, 4) filtered tool pose on frame_name
+        """
+        wf_X_tool = self._from_frame(np.asarray(measured_pose, dtype=np.float64), frame_name, all_tfs)
+        if tool_name not in self.tracks:
+            self.tracks[tool_name] = {'pose': wf_X_tool, 'prediction': None, 'num_rejections': 0}
+            return self.get_pose(tool_name, frame_name=frame_name, all_tfs=all_tfs)
+        track = self.tracks[tool_name]
+        prior = self.get_prior(tool_name)
+        translation_innovation, rotation_innovation = self._get_innovation(prior, wf_X_tool)
+        if translation_innovation > self.max_translation_innovation or rotation_innovation > self.max_rotation_innovation:
+            track['num_rejections'] += 1
+            if track['num_rejections'] > self.max_num_rejections:
+                # The track is lost, restart it from the measurement
+                track['pose'] = wf_X_tool
+                track['num_rejections'] = 0
+            else:
+                track['pose'] = prior
+        else:
+            track['pose'] = self._interpolate(prior, wf_X_tool, 1. - self.smoothing)
+            track['num_rejections'] = 0
+        track['prediction'] = None
+        return self.get_pose(tool_name, frame_name=frame_name, all_tfs=all_tfs)
+
+    def _apply_action_model(self, all_tfs, action):
+        if self.action_model is None:
+            return all_tfs
+        if torch.is_tensor(action):
+            action = action.detach().cpu().numpy()
+        action_t = torch.as_tensor(np.asarray(action, dtype=np.float64)).reshape(1, -1)  # (1, action_size)
+        if not isinstance(all_tfs, FrameGraph):
+            all_tfs = {k: torch.as_tensor(np.asarray(v, dtype=np.float64)).reshape(1, 4, 4) for k, v in all_tfs.items()}
+        state_samples = self.action_model({'all_tfs': all_tfs}, action_t)
+        return state_samples['all_tfs']
+
+    def _get_frame_tr(self, all_tfs, frame_name):
+        # w_X_fn as a (4, 4) array
+        X = all_tfs[frame_name]
+        if torch.is_tensor(X):
+            X = X.detach().cpu().numpy()
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 3:
+            X = X[0]
+        return X
+
+    def _to_frame(self, wf_X_tool, frame_name, all_tfs):
+        if frame_name is None:
+            return wf_X_tool.copy()
+        return tr.inverse_matrix(self._get_frame_tr(all_tfs, frame_name)) @ wf_X_tool
+
+    def _from_frame(self, fn_X_tool, frame_name, all_tfs):
+        if frame_name is None:
+            return fn_X_tool.copy()
+        return self._get_frame_tr(all_tfs, frame_name) @ fn_X_tool
+
+    def _get_innovation(self, X_prior, X_measured):
+        translation_innovation = np.linalg.norm(X_measured[:3, 3] - X_prior[:3, 3])
+        q_prior = tr.quaternion_from_matrix(X_prior)
+        q_measured = tr.quaternion_from_matrix(X_measured)
+        rotation_innovation = 2 * np.arccos(np.clip(np.abs(np.dot(q_prior, q_measured)), 0., 1.))
+        return translation_innovation, rotation_innovation
+
+    def _interpolate(self, X_0, X_1, fraction):
+        # translation is interpolated linearly and rotation with slerp
+        q = tr.quaternion_slerp(tr.quaternion_from_matrix(X_0), tr.quaternion_from_matrix(X_1), fraction)
+        X = tr.quaternion_matrix(q)
+        X[:3, 3] = (1. - fraction) * X_0[:3, 3] + fraction * X_1[:3, 3]
+        return X
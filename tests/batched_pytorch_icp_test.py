@@ -0,0 +1,84 @@
+import pytest
+import torch
+
+from bubble_drawing.bubble_pose_estimation.batched_pytorch_icp import icp_2d_masked, icp_masked, compute_masked_fitness
+
+
+def _random_rotation(n_coords, generator, max_angle):
+    # exponential of a random skew-symmetric matrix: rotation of at most ~max_angle rad
+    A = (2 * torch.rand(n_coords, n_coords, generator=generator, dtype=torch.float64) - 1) * max_angle / n_coords
+    return torch.linalg.matrix_exp(A - A.T)
+
+
+def _get_scenes(num_scenes, n_coords, generator, max_angle=0.3):
+    # asymmetric model centered at the origin and scenes that are noisy rigid copies of most of its points (different sizes)
+    pc_model = torch.rand(200, n_coords, generator=generator, dtype=torch.float64) * torch.arange(1, n_coords + 1, dtype=torch.float64)
+    pc_model = pc_model - pc_model.mean(dim=0)
+    scenes = []
+    for i in range(num_scenes):
+        R = _random_rotation(n_coords, generator, max_angle)
+        t = 0.05 * torch.randn(n_coords, generator=generator, dtype=torch.float64)
+        num_points = 200 - 20 * i
+        idxs = torch.randperm(pc_model.shape[0], generator=generator)[:num_points]
+        scene = pc_model[idxs] @ R.T + t + 1e-3 * torch.randn(num_points, n_coords, generator=generator, dtype=torch.float64)
+        scenes.append(scene)
+    return pc_model, scenes
+
+
+def _pad_scenes(scenes):
+    n_coords = scenes[0].shape[-1]
+    max_num_points = max([len(scene) for scene in scenes])
+    pc_scene = torch.zeros((len(scenes), max_num_points, n_coords), dtype=torch.float64)
+    pc_scene_mask = torch.zeros((len(scenes), max_num_points, n_coords), dtype=torch.bool)
+    for i, scene in enumerate(scenes):
+        pc_scene[i, :len(scene)] = scene
+        pc_scene_mask[i, :len(scene)] = True
+    return pc_scene, pc_scene_mask
+
+
+@pytest.mark.parametrize('n_coords', [2, 3])
+@pytest.mark.parametrize('tolerance', [None, 1e-10])
+def test_batched_icp_matches_single_cloud_icp(n_coords, tolerance):
+    pc_model, scenes = _get_scenes(4, n_coords, torch.Generator().manual_seed(0))
+    pc_scene, pc_scene_mask = _pad_scenes(scenes)
+    pc_model_b = pc_model.unsqueeze(0).expand(len(scenes), -1, -1)
+    Rs, ts = icp_masked(pc_model_b, pc_scene, pc_scene_mask, num_iter=30, tolerance=tolerance)
+    for i, scene in enumerate(scenes):
+        # each scene alone, without padding
+        R_i, t_i = icp_masked(pc_model.unsqueeze(0), scene.unsqueeze(0), torch.ones_like(scene, dtype=torch.bool).unsqueeze(0),
+                              num_iter=30, tolerance=tolerance)
+        assert torch.allclose(Rs[i], R_i[0], atol=1e-8)
+        assert torch.allclose(ts[i], t_i[0], atol=1e-8)
+
+
+@pytest.mark.parametrize('n_coords', [2, 3])
+def test_batched_icp_registers_the_scenes(n_coords):
+    pc_model, scenes = _get_scenes(4, n_coords, torch.Generator().manual_seed(1))
+    pc_scene, pc_scene_mask = _pad_scenes(scenes)
+    pc_model_b = pc_model.unsqueeze(0).expand(len(scenes), -1, -1)
+    Rs, ts, info = icp_masked(pc_model_b, pc_scene, pc_scene_mask, num_iter=50, tolerance=1e-10, return_info=True)
+    fitness, inlier_rmse = compute_masked_fitness(pc_model_b, pc_scene, pc_scene_mask, Rs, ts, threshold=0.01)
+    assert torch.all(fitness == 1.)
+    assert torch.all(inlier_rmse < 5e-3)
+    assert torch.all(info['residuals'] < 1e-5)
+    assert torch.all(info['num_iterations'] <= 50)
+
+
+def test_chunked_correspondences_match():
+    pc_model, scenes = _get_scenes(3, 2, torch.Generator().manual_seed(2))
+    pc_scene, pc_scene_mask = _pad_scenes(scenes)
+    pc_model_b = pc_model.unsqueeze(0).expand(len(scenes), -1, -1)
+    R, t = icp_2d_masked(pc_model_b, pc_scene, pc_scene_mask, num_iter=10)
+    R_chunked, t_chunked = icp_2d_masked(pc_model_b, pc_scene, pc_scene_mask, num_iter=10, memory_budget=2**12)
+    assert torch.allclose(R, R_chunked)
+    assert torch.allclose(t, t_chunked)
+
+
+def test_large_max_correspondence_distance_does_not_change_the_result():
+    pc_model, scenes = _get_scenes(3, 2, torch.Generator().manual_seed(3))
+    pc_scene, pc_scene_mask = _pad_scenes(scenes)
+    pc_model_b = pc_model.unsqueeze(0).expand(len(scenes), -1, -1)
+    R, t = icp_2d_masked(pc_model_b, pc_scene, pc_scene_mask, num_iter=10)
+    R_thr, t_thr = icp_2d_masked(pc_model_b, pc_scene, pc_scene_mask, num_iter=10, max_correspondence_distance=100.)
+    assert torch.allclose(R, R_thr)
+    assert torch.allclose(t, t_thr)
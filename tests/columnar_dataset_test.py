@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+
+from bubble_drawing.bubble_learning.datasets.columnar_dataset import export_columnar_dataset, ColumnarDataset
+
+
+def _get_samples(num_samples=6):
+    rng = np.random.RandomState(0)
+    undef_depths = [rng.rand(4, 5).astype(np.float32) for i in range(2)]
+    samples = []
+    for i in range(num_samples):
+        sample_i = {
+            'init_imprint': torch.from_numpy(rng.rand(2, 4, 5).astype(np.float32)),
+            'init_wrench': rng.rand(12),
+            'action': rng.rand(3),
+            'object_code': i % 3,
+            'undef_depth_r': undef_depths[i % 2].copy(),
+            'all_tfs': {'grasp_frame': np.eye(4) * (i // 3 + 1)},
+            'object_name': 'marker',
+        }
+        samples.append(sample_i)
+    return samples
+
+
+def _assert_equal_samples(sample, sample_ref):
+    assert sample.keys() == sample_ref.keys()
+    for key, value_ref in sample_ref.items():
+        value = sample[key]
+        if torch.is_tensor(value_ref):
+            assert torch.is_tensor(value)
+            assert torch.equal(value, value_ref)
+        elif isinstance(value_ref, dict):
+            assert value.keys() == value_ref.keys()
+            for k in value_ref.keys():
+                np.testing.assert_array_equal(value[k], value_ref[k])
+        else:
+            np.testing.assert_array_equal(value, value_ref)
+
+
+def test_columnar_dataset_round_trip(tmp_path):
+    samples = _get_samples()
+    dataset = export_columnar_dataset(samples, str(tmp_path))
+    assert len(dataset) == len(samples)
+    for i, sample_ref in enumerate(samples):
+        _assert_equal_samples(dataset[i], sample_ref)
+    # reopen from disk
+    dataset = ColumnarDataset(str(tmp_path))
+    for i, sample_ref in enumerate(samples):
+        _assert_equal_samples(dataset[i], sample_ref)
+
+
+def test_static_values_are_deduplicated(tmp_path):
+    samples = _get_samples()
+    dataset = export_columnar_dataset(samples, str(tmp_path))
+    assert len(dataset.get_static_values('undef_depth_r')) == 2
+    assert len(dataset.get_static_values('all_tfs')) == 2
+    assert len(dataset.get_static_values('object_name')) == 1
+    np.testing.assert_array_equal(dataset.get_static_indxs('undef_depth_r'), [0, 1, 0, 1, 0, 1])
+
+
+def test_slices_are_batched_views(tmp_path):
+    samples = _get_samples()
+    export_columnar_dataset(samples, str(tmp_path))
+    dataset = ColumnarDataset(str(tmp_path), keys=['init_imprint', 'action', 'undef_depth_r'])
+    batch = dataset[1:4]
+    assert set(batch.keys()) == {'init_imprint', 'action', 'undef_depth_r'}
+    assert torch.equal(batch['init_imprint'], torch.stack([s['init_imprint'] for s in samples[1:4]]))
+    np.testing.assert_array_equal(batch['action'], np.stack([s['action'] for s in samples[1:4]]))
+    assert len(batch['undef_depth_r']) == 3
+    # the copy-on-write mapping does not modify the files
+    batch['action'][:] = 0.
+    np.testing.assert_array_equal(ColumnarDataset(str(tmp_path))[1]['action'], samples[1]['action'])
+
+
+def test_variable_shapes_are_not_exported_as_arrays(tmp_path):
+    samples = _get_samples()
+    samples[2]['action'] = np.zeros(4)
+    with pytest.raises(ValueError):
+        export_columnar_dataset(samples, str(tmp_path))
+    dataset = export_columnar_dataset(samples, str(tmp_path), static_keys=['action', 'undef_depth_r', 'all_tfs'])
+    np.testing.assert_array_equal(dataset[2]['action'], np.zeros(4))
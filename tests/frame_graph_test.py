@@ -0,0 +1,97 @@
+import pytest
+import torch
+
+from bubble_drawing.bubble_model_control.aux.frame_graph import FrameGraph, rigid_tr_inverse
+
+
+def _random_tfs(batch_size, generator):
+    A = torch.randn(batch_size, 3, 3, generator=generator, dtype=torch.float64)
+    X = torch.zeros(batch_size, 4, 4, dtype=torch.float64)
+    X[:, :3, :3] = torch.linalg.matrix_exp(A - A.transpose(-1, -2))
+    X[:, :3, 3] = torch.randn(batch_size, 3, generator=generator, dtype=torch.float64)
+    X[:, 3, 3] = 1.
+    return X
+
+
+@pytest.fixture
+def all_tfs():
+    generator = torch.Generator().manual_seed(0)
+    frame_names = ['med_base', 'grasp_frame', 'pico_flexx_left', 'pico_flexx_right', 'tool_frame']
+    all_tfs = {fn: _random_tfs(5, generator) for fn in frame_names}
+    all_tfs['med_base'] = torch.eye(4, dtype=torch.float64) # (4, 4) frames are broadcast to the batch size
+    return all_tfs
+
+
+def _dict_tr_frame(all_tfs, frame_name, X, fixed_frame_names):
+    # reference: one frame at a time on the dict of tfs
+    new_tfs = dict(all_tfs)
+    w_X_fn = all_tfs[frame_name]
+    w_X_fn_new = w_X_fn @ X
+    new_tfs[frame_name] = w_X_fn_new
+    for ff_i in fixed_frame_names:
+        if ff_i != frame_name:
+            new_tfs[ff_i] = w_X_fn_new @ torch.linalg.inv(w_X_fn) @ all_tfs[ff_i]
+    return new_tfs
+
+
+def test_rigid_tr_inverse(all_tfs):
+    X = all_tfs['grasp_frame']
+    assert torch.allclose(rigid_tr_inverse(X), torch.linalg.inv(X))
+
+
+def test_from_dict_reads_as_the_dict(all_tfs):
+    frame_graph = FrameGraph.from_dict(all_tfs)
+    assert frame_graph.batch_size == 5
+    assert frame_graph.keys() == list(all_tfs.keys())
+    assert torch.equal(frame_graph['med_base'], torch.eye(4, dtype=torch.float64).expand(5, 4, 4))
+    for fn in ['grasp_frame', 'tool_frame']:
+        assert torch.equal(frame_graph[fn], all_tfs[fn])
+    sf_X_tf = frame_graph.get_transformation_matrix('grasp_frame', 'tool_frame')
+    assert torch.allclose(sf_X_tf, torch.linalg.inv(all_tfs['grasp_frame']) @ all_tfs['tool_frame'])
+
+
+@pytest.mark.parametrize('fixed_frame_names', [[], ['pico_flexx_left', 'pico_flexx_right'], ['grasp_frame', 'tool_frame']])
+def test_tr_frame_matches_dict(all_tfs, fixed_frame_names):
+    X = _random_tfs(5, torch.Generator().manual_seed(1))
+    frame_graph = FrameGraph.from_dict(all_tfs)
+    new_frame_graph = frame_graph.tr_frame('grasp_frame', X, fixed_frame_names)
+    new_tfs = _dict_tr_frame(FrameGraph.from_dict(all_tfs).to_dict(), 'grasp_frame', X, fixed_frame_names)
+    for fn in all_tfs.keys():
+        assert torch.allclose(new_frame_graph[fn], new_tfs[fn])
+    # the original graph is not modified
+    for fn in ['grasp_frame', 'pico_flexx_left']:
+        assert torch.equal(frame_graph[fn], all_tfs[fn])
+
+
+def test_tr_frame_uses_the_rigid_groups(all_tfs):
+    X = _random_tfs(5, torch.Generator().manual_seed(2))
+    rigid_groups = {'grasp_frame': ['tool_frame']}
+    frame_graph = FrameGraph.from_dict(all_tfs, rigid_groups=rigid_groups)
+    new_frame_graph = frame_graph.tr_frame('grasp_frame', X)
+    assert torch.allclose(new_frame_graph.get_transformation_matrix('grasp_frame', 'tool_frame'),
+                          frame_graph.get_transformation_matrix('grasp_frame', 'tool_frame'))
+    assert torch.equal(new_frame_graph['pico_flexx_left'], frame_graph['pico_flexx_left'])
+
+
+def test_expand(all_tfs):
+    frame_graph = FrameGraph.from_dict({fn: X[0] for fn, X in all_tfs.items()})
+    assert frame_graph.batch_size == 1
+    expanded_frame_graph = frame_graph.expand(3)
+    assert expanded_frame_graph.batch_size == 3
+    for fn in all_tfs.keys():
+        assert torch.equal(expanded_frame_graph[fn][2], frame_graph[fn][0])
+
+
+@pytest.mark.parametrize('fixed_frame_names', [[], ['pico_flexx_left', 'pico_flexx_right', 'tool_frame']])
+def test_control_utils_match_on_dict_and_frame_graph(all_tfs, fixed_frame_names):
+    pytest.importorskip('tf.transformations')
+    pytest.importorskip('pytorch3d')
+    from bubble_drawing.bubble_model_control.aux.bubble_model_control_utils import tr_frame, get_transformation_matrix
+    X = _random_tfs(5, torch.Generator().manual_seed(3))
+    frame_graph = FrameGraph.from_dict(all_tfs)
+    new_frame_graph = tr_frame(frame_graph, 'grasp_frame', X, fixed_frame_names)
+    new_tfs = tr_frame(frame_graph.to_dict(), 'grasp_frame', X, fixed_frame_names)
+    for fn in all_tfs.keys():
+        assert torch.allclose(new_frame_graph[fn], new_tfs[fn])
+    assert torch.allclose(get_transformation_matrix(new_frame_graph, 'tool_frame', 'pico_flexx_left'),
+                          get_transformation_matrix(new_tfs, 'tool_frame', 'pico_flexx_left'))
@@ -0,0 +1,89 @@
+import pytest
+import torch
+import torch.nn as nn
+
+pytest.importorskip('pytorch_lightning')
+
+from bubble_drawing.bubble_learning.aux.model_export import export_model, load_exported_model, read_exported_metadata, ExportedModel
+from bubble_drawing.bubble_learning.aux.model_registry import ModelRegistry
+
+
+class ImprintRegressor(nn.Module):
+    # small model with the interface of ICPApproximationModel: model(imprint) -> pose
+    def __init__(self):
+        super().__init__()
+        self.input_sizes = {'init_imprint': (2, 8, 6)}
+        self.net = nn.Sequential(nn.Flatten(), nn.Linear(2 * 8 * 6, 16), nn.ReLU(), nn.Dropout(0.5), nn.Linear(16, 4))
+
+    @classmethod
+    def get_name(cls):
+        return 'imprint_regressor'
+
+    @property
+    def name(self):
+        return self.get_name()
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    @property
+    def dtype(self):
+        return next(self.parameters()).dtype
+
+    @classmethod
+    def load_from_checkpoint(cls, checkpoint_path, dataset_params=None):
+        model = cls()
+        model.load_state_dict(torch.load(checkpoint_path)['state_dict'])
+        return model
+
+    def get_input_keys(self):
+        return ['init_imprint']
+
+    def get_model_output_keys(self):
+        return ['init_object_pose']
+
+    def forward(self, imprint):
+        return self.net(imprint)
+
+
+def test_export_and_reload_parity(tmp_path):
+    torch.manual_seed(0)
+    model = ImprintRegressor()
+    model.train()
+    save_path = str(tmp_path / 'imprint_regressor.pt')
+    exported_model = export_model(model, save_path)
+    assert model.training # the training mode is restored
+    loaded_model = load_exported_model(save_path, device=torch.device('cpu'))
+    model.eval()
+    for batch_size in [1, 3, 7]:
+        imprint = torch.rand(batch_size, 2, 8, 6)
+        with torch.no_grad():
+            output = model(imprint)
+        assert torch.allclose(exported_model(imprint), output)
+        assert torch.allclose(loaded_model(imprint), output)
+    assert loaded_model.name == model.name
+    assert loaded_model.get_input_keys() == model.get_input_keys()
+    assert loaded_model.get_model_output_keys() == model.get_model_output_keys()
+    assert read_exported_metadata(save_path) == loaded_model.metadata
+    assert not any(param.requires_grad for param in loaded_model.traced_model.parameters())
+
+
+def test_registry_loads_the_exported_model_only_if_preferred(tmp_path):
+    torch.manual_seed(0)
+    model = ImprintRegressor().eval()
+    registry = ModelRegistry()
+    data_name = str(tmp_path)
+    checkpoints_path = tmp_path / 'tb_logs' / model.name / 'version_0' / 'checkpoints'
+    checkpoints_path.mkdir(parents=True)
+    torch.save({'epoch': 0, 'global_step': 10, 'state_dict': model.state_dict()}, str(checkpoints_path / 'epoch=0-step=10.ckpt'))
+    exported_path = registry.get_exported_model_path(ImprintRegressor, data_name, 0)
+    (tmp_path / 'tb_logs' / model.name / 'version_0' / 'exported').mkdir()
+    export_model(model, exported_path)
+    loaded_model = registry.load(ImprintRegressor, data_name, 0)
+    assert isinstance(loaded_model, ImprintRegressor)
+    exported_model = registry.load(ImprintRegressor, data_name, 0, prefer_exported=True)
+    assert isinstance(exported_model, ExportedModel)
+    imprint = torch.rand(4, 2, 8, 6)
+    with torch.no_grad():
+        assert torch.allclose(exported_model(imprint), loaded_model.eval()(imprint))
@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from bubble_drawing.bubble_learning.models.pointnet.benchmark_pointnet2_utils import reference_farthest_point_sample, \
+    reference_query_ball_point
+from bubble_drawing.bubble_learning.models.pointnet.pointnet2_utils import farthest_point_sample, query_ball_point
+
+
+@pytest.mark.parametrize('B, N, npoint', [(1, 1024, 512), (8, 512, 128), (3, 100, 100)])
+def test_farthest_point_sample_matches_reference(B, N, npoint):
+    xyz = torch.rand(B, N, 3, generator=torch.Generator().manual_seed(1))
+    torch.manual_seed(0)
+    reference_idxs = reference_farthest_point_sample(xyz, npoint)
+    torch.manual_seed(0)
+    idxs = farthest_point_sample(xyz, npoint)
+    assert torch.equal(idxs, reference_idxs)
+
+
+@pytest.mark.parametrize('radius, nsample', [(0.1, 16), (0.4, 128), (2., 600)])
+def test_query_ball_point_matches_reference(radius, nsample):
+    xyz = torch.rand(4, 512, 3, generator=torch.Generator().manual_seed(2))
+    new_xyz = xyz[:, :64]
+    assert torch.equal(query_ball_point(radius, min(nsample, 512), xyz, new_xyz),
+                       reference_query_ball_point(radius, min(nsample, 512), xyz, new_xyz))
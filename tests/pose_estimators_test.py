@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('open3d')
+pytest.importorskip('tf.transformations')
+pytest.importorskip('mmint_camera_utils.camera_utils.point_cloud_utils')
+
+import tf.transformations as tr
+from mmint_camera_utils.camera_utils.point_cloud_utils import pack_o3d_pcd
+
+from bubble_drawing.bubble_pose_estimation.pose_estimators import ICP2DPoseEstimator, MultiHypothesisICP3DPoseEstimator
+from bubble_drawing.bubble_pose_estimation.benchmark_batched_icp2d import get_marker_model, get_scenes
+
+
+@pytest.fixture
+def pose_estimator_and_scenes():
+    np.random.seed(0)
+    projection_axis = np.array([1, 0, 0])
+    model = get_marker_model(num_points=500)
+    scenes = get_scenes(model, 6, projection_axis, min_num_points=50, max_num_points=300)
+    pose_estimator = ICP2DPoseEstimator(obj_model=pack_o3d_pcd(model), projection_axis=projection_axis, max_num_iterations=20)
+    return pose_estimator, scenes
+
+
+def test_estimate_poses_matches_estimate_pose(pose_estimator_and_scenes):
+    pose_estimator, scenes = pose_estimator_and_scenes
+    poses = []
+    for scene in scenes:
+        pose_estimator.last_tr = None
+        poses.append(pose_estimator.estimate_pose(scene))
+    pose_estimator.last_tr = None
+    batched_poses = pose_estimator.estimate_poses(scenes)
+    for pose, batched_pose in zip(poses, batched_poses):
+        np.testing.assert_allclose(batched_pose, pose, atol=1e-6)
+
+
+def test_estimate_poses_fallbacks_do_not_depend_on_last_tr(pose_estimator_and_scenes):
+    pose_estimator, scenes = pose_estimator_and_scenes
+    init_tr = np.eye(4)
+    init_tr[:3, 3] = [0.1, 0.2, 0.3]
+    short_scene = scenes[0][:2]
+    pose_estimator.last_tr = np.full((4, 4), np.nan) # an unrelated previous estimate
+    poses = pose_estimator.estimate_poses([scenes[0], short_scene, short_scene, scenes[1], short_scene],
+                                          init_trs=[None, init_tr, None, None, None])
+    np.testing.assert_allclose(poses[1], init_tr)
+    np.testing.assert_allclose(poses[2][:3, :3], np.eye(3))
+    assert np.all(np.isfinite(poses[4]))
+    # last_tr is the pose of the last element estimated by ICP
+    np.testing.assert_allclose(pose_estimator.last_tr, poses[3])
+    pose_estimator.estimate_poses([short_scene])
+    np.testing.assert_allclose(pose_estimator.last_tr, poses[3])
+
+
+def test_multi_hypothesis_icp_recovers_the_pose_when_tracking_is_lost():
+    np.random.seed(0)
+    torch.manual_seed(0)
+    model = (np.random.rand(300, 3) - 0.5) * np.array([0.02, 0.04, 0.08])
+    pose_estimator = MultiHypothesisICP3DPoseEstimator(obj_model=pack_o3d_pcd(model), num_hypotheses=32)
+    pose_estimator.threshold = 0.002
+    X = np.eye(4)
+    X[:3, :3] = tr.euler_matrix(0.2, -0.1, 0.3)[:3, :3]
+    X[:3, 3] = [0.01, 0.02, -0.01]
+    scene = model @ X[:3, :3].T + X[:3, 3]
+    assert pose_estimator.is_tracking_lost()
+    np.testing.assert_allclose(pose_estimator.estimate_pose(scene), X, atol=1e-3)
+    assert not pose_estimator.is_tracking_lost()
+    model_points = pose_estimator._object_model_points
+    pose_estimator.estimate_pose(scene)
+    assert pose_estimator._object_model_points is model_points
+    # a wrong last estimate with low fitness is not used to warm-start the next estimation
+    pose_estimator.last_tr = np.eye(4)
+    pose_estimator.last_tr[:3, 3] = [1., 1., 1.]
+    pose_estimator.last_icp_info['fitness'] = 0.
+    assert pose_estimator.is_tracking_lost()
+    np.testing.assert_allclose(pose_estimator.estimate_pose(scene), X, atol=1e-3)
+    assert pose_estimator.last_icp_info['fitness'] == 1.
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+import torch
+
+pytest.importorskip('tf.transformations')
+
+from bubble_drawing.bubble_pose_estimation.tool_pose_tracker import ToolPoseTracker
+
+
+def _pose(translation, angle=0.):
+    X = np.eye(4)
+    X[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    X[:3, 3] = translation
+    return X
+
+
+def _translate_grasp_action_model(state_samples, actions):
+    # moves the grasp frame by the action (dx, dy, dz) on the world frame
+    all_tfs = dict(state_samples['all_tfs'])
+    X = all_tfs['grasp_frame'].clone()
+    X[:, :3, 3] += actions[:, :3]
+    all_tfs['grasp_frame'] = X
+    return {'all_tfs': all_tfs}
+
+
+def test_first_measurement_starts_the_track():
+    tracker = ToolPoseTracker(smoothing=0.5)
+    assert not tracker.is_tracking()
+    assert tracker.get_pose() is None
+    pose = _pose([0.1, 0., 0.])
+    np.testing.assert_allclose(tracker.update(pose), pose)
+    assert tracker.is_tracking()
+
+
+def test_inliers_are_smoothed():
+    tracker = ToolPoseTracker(smoothing=0.5, max_translation_innovation=0.02)
+    tracker.update(_pose([0., 0., 0.]))
+    filtered_pose = tracker.update(_pose([0.01, 0., 0.], angle=0.2))
+    np.testing.assert_allclose(filtered_pose, _pose([0.005, 0., 0.], angle=0.1), atol=1e-12)
+
+
+def test_outliers_are_rejected_until_the_track_is_lost():
+    tracker = ToolPoseTracker(smoothing=0.5, max_translation_innovation=0.02, max_rotation_innovation=0.5, max_num_rejections=2)
+    pose = _pose([0., 0., 0.])
+    tracker.update(pose)
+    far_pose = _pose([0.1, 0., 0.])
+    np.testing.assert_allclose(tracker.update(far_pose), pose) # translation outlier
+    np.testing.assert_allclose(tracker.update(_pose([0., 0., 0.], angle=1.)), pose) # rotation outlier
+    # a third consecutive outlier restarts the track from the measurement
+    np.testing.assert_allclose(tracker.update(far_pose), far_pose)
+    np.testing.assert_allclose(tracker.update(far_pose), far_pose)
+
+
+def test_inliers_reset_the_rejection_count():
+    tracker = ToolPoseTracker(smoothing=0., max_translation_innovation=0.02, max_num_rejections=1)
+    pose = _pose([0., 0., 0.])
+    tracker.update(pose)
+    far_pose = _pose([0.1, 0., 0.])
+    for i in range(3):
+        np.testing.assert_allclose(tracker.update(far_pose), pose)
+        np.testing.assert_allclose(tracker.update(pose), pose)
+
+
+def test_reset():
+    tracker = ToolPoseTracker()
+    tracker.update(_pose([0., 0., 0.]), tool_name='marker')
+    tracker.update(_pose([0., 0., 0.]), tool_name='pen')
+    tracker.reset('marker')
+    assert not tracker.is_tracking('marker')
+    assert tracker.is_tracking('pen')
+    tracker.reset()
+    assert not tracker.is_tracking('pen')
+    far_pose = _pose([1., 0., 0.])
+    np.testing.assert_allclose(tracker.update(far_pose, tool_name='pen'), far_pose) # new track, no outlier rejection
+
+
+def test_predict_moves_the_tool_with_the_grasp():
+    tracker = ToolPoseTracker(action_model=_translate_grasp_action_model, smoothing=0.5, max_translation_innovation=0.02)
+    all_tfs = {'med_base': np.eye(4), 'grasp_frame': _pose([0., 0., 0.5], angle=0.3)}
+    pose = _pose([0.1, 0., 0.4])
+    tracker.update(pose)
+    action = torch.tensor([0.05, 0., 0.])
+    predicted_pose = tracker.predict(all_tfs, action)
+    np.testing.assert_allclose(predicted_pose, _pose([0.15, 0., 0.4]), atol=1e-12)
+    np.testing.assert_allclose(tracker.get_prior(), predicted_pose)
+    np.testing.assert_allclose(tracker.get_pose(), pose) # the filtered pose is only updated by measurements
+    # the measurement is filtered against the prediction, not against the last filtered pose (0.05 m away)
+    np.testing.assert_allclose(tracker.update(predicted_pose), predicted_pose, atol=1e-12)
+    # poses on other frames
+    gf_X_tool = tracker.get_pose(frame_name='grasp_frame', all_tfs=all_tfs)
+    np.testing.assert_allclose(all_tfs['grasp_frame'] @ gf_X_tool, predicted_pose, atol=1e-12)